@@ -1,3 +1,5 @@
 from .main import main
 import asyncio
-asyncio.run(main())
+
+if __name__ == "__main__":
+    asyncio.run(main())
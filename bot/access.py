@@ -0,0 +1,85 @@
+# bot/access.py
+"""
+Контекст доступа пользователя (админ / бригадир / заблокирован) и его кеш.
+
+Флаги вычисляет AccessMiddleware один раз на апдейт и кладёт в data["access"].
+Кеш живёт ACCESS_CACHE_TTL секунд и явно сбрасывается там, где флаги меняются:
+set_brig_login, block/unblock_member, demote_brigadier, админ-вход/выход.
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .config import ACCESS_CACHE_TTL, ACCESS_CACHE_MAXSIZE
+
+
+@dataclass(frozen=True)
+class AccessContext:
+    tg_user_id: int
+    agent_id: int | None
+    is_admin: bool
+    is_brig: bool
+    is_blocked: bool
+
+
+class AccessCache:
+    """TTL-кеш AccessContext по Telegram ID."""
+
+    def __init__(self, ttl: float = ACCESS_CACHE_TTL, maxsize: int = ACCESS_CACHE_MAXSIZE) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items: dict[int, tuple[float, AccessContext]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tg_user_id: int) -> AccessContext | None:
+        item = self._items.get(tg_user_id)
+        if item is None or item[0] < time.monotonic():
+            self._items.pop(tg_user_id, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[1]
+
+    def put(self, ctx: AccessContext) -> None:
+        if len(self._items) >= self.maxsize:
+            now = time.monotonic()
+            self._items = {k: v for k, v in self._items.items() if v[0] >= now}
+            if len(self._items) >= self.maxsize:
+                # всё ещё полно — выкидываем самую старую запись
+                self._items.pop(next(iter(self._items)))
+        self._items[ctx.tg_user_id] = (time.monotonic() + self.ttl, ctx)
+
+    def invalidate(self, tg_user_id: int) -> None:
+        self._items.pop(int(tg_user_id), None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+access_cache = AccessCache()
+
+
+def invalidate_access(session, tg_user_id: int) -> None:
+    """
+    Сбросить кеш доступа пользователя: сразу и повторно после коммита сессии,
+    чтобы параллельный апдейт не закешировал состояние до коммита.
+    Откат транзакции отменяет отложенный сброс — следующий коммит сессии его не повторит.
+    """
+    access_cache.invalidate(tg_user_id)
+    session.info.setdefault("access_invalidate", set()).add(int(tg_user_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    for tg_user_id in session.info.pop("access_invalidate", ()):
+        access_cache.invalidate(tg_user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_after_rollback(session):
+    session.info.pop("access_invalidate", None)
@@ -0,0 +1,125 @@
+# bot/cli.py
+"""
+Служебные команды обслуживания БД (бот можно не останавливать):
+
+    python -m bot.cli rollup-rebuild   — пересобрать agent_day_stats и agent_day_cube по contact
+    python -m bot.cli rollup-check     — сверить agent_day_stats и agent_day_cube с contact
+                                         (код выхода 1 при расхождениях)
+    python -m bot.cli query-plans      — EXPLAIN QUERY PLAN запросов repo.py на временной базе
+                                         (код выхода 1, если какой-то запрос читает таблицу целиком)
+    python -m bot.cli mirror-rebuild   — пересобрать колоночное зеркало contact для выгрузок
+    python -m bot.cli mirror-check     — догнать зеркало и сверить его контрольные суммы с contact
+                                         (код выхода 1 при расхождениях)
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+
+from .db import init_db, async_session, engine
+from .repo import rebuild_agent_day_stats, check_agent_day_stats, rebuild_agent_day_cube, check_agent_day_cube
+from .utils.query_plans import check_query_plans
+from .utils.contact_mirror import contact_mirror
+
+
+_ROLLUPS = (
+    ("agent_day_stats", rebuild_agent_day_stats, check_agent_day_stats),
+    ("agent_day_cube", rebuild_agent_day_cube, check_agent_day_cube),
+)
+
+
+async def _rollup_rebuild(args) -> int:
+    async with async_session() as session:
+        counts = [(name, await rebuild(session)) for name, rebuild, _ in _ROLLUPS]
+        await session.commit()
+    for name, n in counts:
+        print(f"{name}: {n} rows rebuilt")
+    return 0
+
+
+async def _rollup_check(args) -> int:
+    failed = 0
+    for name, _, check in _ROLLUPS:
+        async with async_session() as session:
+            diffs = await check(session)
+        for d in diffs[: args.limit]:
+            print(f"agent={d['agent_id']} day={d['day']} expected={d['expected']} actual={d['actual']}")
+        if diffs:
+            print(f"{name}: {len(diffs)} mismatched rows")
+            failed = 1
+        else:
+            print(f"{name}: OK")
+    return failed
+
+
+async def _query_plans(args) -> int:
+    checked, problems = await check_query_plans()
+    for p in problems:
+        print(f"[{p.scenario}] {p.sql}")
+        for line in p.plan:
+            print(f"    {line}")
+    if problems:
+        print(f"query plans: {len(problems)} of {checked} queries scan a whole table")
+        return 1
+    print(f"query plans: {checked} queries OK")
+    return 0
+
+
+async def _mirror_rebuild(args) -> int:
+    async with async_session() as session:
+        meta = await contact_mirror.rebuild(session)
+    print(f"contact mirror: {meta['rows']} rows rebuilt")
+    return 0
+
+
+async def _mirror_check(args) -> int:
+    async with async_session() as session:
+        meta = await contact_mirror.sync(session)
+        diffs = await contact_mirror.check(session)
+    for col, expected, actual in diffs:
+        print(f"{col}: expected={expected} actual={actual}")
+    if diffs:
+        print(f"contact mirror: {len(diffs)} mismatched columns (python -m bot.cli mirror-rebuild)")
+        return 1
+    print(f"contact mirror: {meta['rows']} rows OK")
+    return 0
+
+
+async def _run(args) -> int:
+    if getattr(args, "standalone", False):
+        # своя временная база, рабочую не трогаем
+        return await args.func(args)
+    await init_db()
+    try:
+        return await args.func(args)
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(prog="python -m bot.cli", description="Agitator bot maintenance")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("rollup-rebuild", help="пересобрать agent_day_stats и agent_day_cube")
+    p.set_defaults(func=_rollup_rebuild)
+
+    p = sub.add_parser("rollup-check", help="сверить agent_day_stats и agent_day_cube с contact")
+    p.add_argument("--limit", type=int, default=20, help="сколько расхождений печатать")
+    p.set_defaults(func=_rollup_check)
+
+    p = sub.add_parser("query-plans", help="проверить планы запросов repo.py (временная база)")
+    p.set_defaults(func=_query_plans, standalone=True)
+
+    p = sub.add_parser("mirror-rebuild", help="пересобрать зеркало contact для выгрузок")
+    p.set_defaults(func=_mirror_rebuild)
+
+    p = sub.add_parser("mirror-check", help="сверить зеркало contact с БД")
+    p.set_defaults(func=_mirror_check)
+
+    args = ap.parse_args()
+    sys.exit(asyncio.run(_run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 # bot/config.py
+import os
 from dataclasses import dataclass
 from aiogram.client.default import DefaultBotProperties
 from pathlib import Path
 
 ROOT_DIR = Path(__file__).resolve().parent.parent
 DB_PATH = (ROOT_DIR / "data.db").as_posix()
+# состояния FSM (опрос в процессе) — отдельный файл, переживает перезапуск бота
+FSM_DB_PATH = (ROOT_DIR / "fsm.db").as_posix()
 
 @dataclass(frozen=True)
 class Settings:
@@ -24,8 +27,95 @@ settings = Settings(
     DEFAULT_BOT_PROPS=DefaultBotProperties(parse_mode="HTML"),
 )
 
+# --- SQLite data.db: PRAGMA на каждое новое соединение (bot/db.py) ---
+# Переопределяются переменными окружения с тем же именем (например, SQLITE_SYNCHRONOUS=FULL).
+SQLITE_JOURNAL_MODE       = os.getenv("SQLITE_JOURNAL_MODE", "WAL")     # читатели не блокируют писателя
+SQLITE_SYNCHRONOUS        = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")   # в WAL fsync только на checkpoint
+SQLITE_CACHE_KIB          = int(os.getenv("SQLITE_CACHE_KIB", 64 * 1024))          # страничный кеш на соединение
+SQLITE_MMAP_BYTES         = int(os.getenv("SQLITE_MMAP_BYTES", 256 * 1024 * 1024))  # 0 — без mmap
+SQLITE_TEMP_STORE         = os.getenv("SQLITE_TEMP_STORE", "MEMORY")    # сортировки/GROUP BY без временных файлов
+SQLITE_BUSY_TIMEOUT_MS    = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 10_000))       # ждать блокировку, а не падать
+SQLITE_JOURNAL_SIZE_LIMIT = int(os.getenv("SQLITE_JOURNAL_SIZE_LIMIT", 64 * 1024 * 1024))  # WAL после checkpoint
+
+# пул соединений: у aiosqlite на каждое соединение свой поток, держим их немного и постоянно.
+# Писатель (bot/write_queue.py) + outbox/уборщик + EXPORT_JOBS_CONCURRENCY потоковых чтений выгрузок
+# + чтения хендлеров; сверх пула — временные соединения.
+DB_POOL_SIZE     = int(os.getenv("DB_POOL_SIZE", 6))
+DB_POOL_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", 4))
+DB_POOL_TIMEOUT  = 30.0  # сек ожидания свободного соединения
+
 # --- внешнее API Stimul ---
-STIMUL_API_URL   = "https://stimul.app/pub-api/v1/arch/set-lottery-code"
+# STIMUL_API_URL можно переопределить переменной окружения — например, на локальную заглушку
+# (python -m bot.utils.stimul_stub), чтобы гонять доставку без сети.
+STIMUL_API_URL   = os.getenv("STIMUL_API_URL", "https://stimul.app/pub-api/v1/arch/set-lottery-code")
 STIMUL_API_TOKEN = None  # если нужен токен — положи сюда строку
 
-__all__ = ["settings", "STIMUL_API_URL", "STIMUL_API_TOKEN"]
+# --- кеш прав доступа (админ/бригадир/блокировка) ---
+ACCESS_CACHE_TTL     = 60.0    # сек
+ACCESS_CACHE_MAXSIZE = 10_000  # пользователей
+
+# --- FSM: записи в памяти и уборка брошенных опросов ---
+FSM_CACHE_TTL        = 30 * 60     # сек без обращений — запись уходит из памяти (остаётся в fsm.db)
+FSM_CACHE_MAXSIZE    = 5_000       # записей FSM в памяти
+SURVEY_ABANDON_AFTER = 12 * 3600   # сек; опрос без движения дольше — брошен (FSM стирается, визит/карточка закрываются)
+SWEEP_INTERVAL       = 600.0       # сек между проходами уборщика
+SWEEP_BATCH          = 500         # строк за один UPDATE
+
+# --- групповой коммит записей опроса (bot/write_queue.py) ---
+WRITE_BATCH_WINDOW   = 0.005   # сек: сколько ждать попутчиков после первой записи
+WRITE_BATCH_MAX      = 200     # записей в одной транзакции
+WRITE_QUEUE_MAXSIZE  = 10_000  # ожидающих записей; дальше хендлеры ждут места в очереди
+
+# --- HTTP-клиент Stimul (один на процесс, keep-alive) ---
+STIMUL_POOL_LIMIT          = 20     # соединений всего
+STIMUL_POOL_LIMIT_PER_HOST = 8      # соединений на хост (не меньше OUTBOX_CONCURRENCY)
+STIMUL_DNS_CACHE_TTL       = 300    # сек
+STIMUL_KEEPALIVE_TIMEOUT   = 30.0   # сек простоя, после которых соединение закрывается
+
+# --- доставка вебхуков через outbox ---
+OUTBOX_CONCURRENCY   = 4      # одновременных запросов к Stimul
+OUTBOX_BATCH         = 50     # строк за одну выборку из очереди
+OUTBOX_POLL_INTERVAL = 5.0    # сек между опросами очереди, если никто не разбудил
+OUTBOX_MAX_ATTEMPTS  = 8      # после стольких неудач строка уходит в DEAD
+OUTBOX_BACKOFF_BASE  = 5.0    # сек; задержка растёт как base * 2^(attempt-1)
+OUTBOX_BACKOFF_MAX   = 900.0  # сек; потолок задержки
+
+# --- выгрузки ---
+EXPORT_CHUNK_SIZE   = 2_000  # строк за одну выборку серверного курсора при экспорте
+EXPORT_POOL_WORKERS = 2      # процессов рендера выгрузок (CSV/XLSX) вне event loop
+
+# --- очередь заданий на выгрузку ---
+EXPORT_JOBS_CONCURRENCY  = 2    # заданий в работе одновременно (на весь бот)
+EXPORT_JOBS_PER_USER     = 2    # заданий одного пользователя в очереди и в работе
+EXPORT_JOBS_MAX_QUEUED   = 20   # сверх этого новые задания отклоняются
+EXPORT_PROGRESS_INTERVAL = 2.0  # сек между правками статус-сообщения
+
+# --- кеш готовых выгрузок (повтор без изменений данных уходит по file_id) ---
+EXPORT_CACHE_DIR       = (ROOT_DIR / "export_cache").as_posix()
+EXPORT_CACHE_MAX_BYTES = 200 * 1024 * 1024  # байт на диске, сверх — вытеснение LRU
+
+# --- временные файлы и упаковка выгрузок (лимит документа у Bot API — 50 МБ) ---
+EXPORT_TMP_DIR            = (ROOT_DIR / "export_tmp").as_posix()  # каталоги заданий, чистятся после отправки
+EXPORT_PART_BYTES         = 45 * 1024 * 1024  # больше — zip режется на нумерованные части
+EXPORT_COMPRESS_MIN_BYTES = 1 * 1024 * 1024   # несжатые файлы (CSV) крупнее этого отправляются в zip
+
+# --- колоночное зеркало contact для выгрузок (numpy-файлы, дозаливается по id/updated_at) ---
+MIRROR_DIR = (ROOT_DIR / "contact_mirror").as_posix()
+
+__all__ = [
+    "settings", "FSM_DB_PATH", "STIMUL_API_URL", "STIMUL_API_TOKEN",
+    "SQLITE_JOURNAL_MODE", "SQLITE_SYNCHRONOUS", "SQLITE_CACHE_KIB", "SQLITE_MMAP_BYTES",
+    "SQLITE_TEMP_STORE", "SQLITE_BUSY_TIMEOUT_MS", "SQLITE_JOURNAL_SIZE_LIMIT",
+    "DB_POOL_SIZE", "DB_POOL_OVERFLOW", "DB_POOL_TIMEOUT",
+    "ACCESS_CACHE_TTL", "ACCESS_CACHE_MAXSIZE",
+    "FSM_CACHE_TTL", "FSM_CACHE_MAXSIZE", "SURVEY_ABANDON_AFTER", "SWEEP_INTERVAL", "SWEEP_BATCH",
+    "WRITE_BATCH_WINDOW", "WRITE_BATCH_MAX", "WRITE_QUEUE_MAXSIZE",
+    "STIMUL_POOL_LIMIT", "STIMUL_POOL_LIMIT_PER_HOST", "STIMUL_DNS_CACHE_TTL", "STIMUL_KEEPALIVE_TIMEOUT",
+    "OUTBOX_CONCURRENCY", "OUTBOX_BATCH", "OUTBOX_POLL_INTERVAL",
+    "OUTBOX_MAX_ATTEMPTS", "OUTBOX_BACKOFF_BASE", "OUTBOX_BACKOFF_MAX",
+    "EXPORT_CHUNK_SIZE", "EXPORT_POOL_WORKERS",
+    "EXPORT_JOBS_CONCURRENCY", "EXPORT_JOBS_PER_USER", "EXPORT_JOBS_MAX_QUEUED", "EXPORT_PROGRESS_INTERVAL",
+    "EXPORT_CACHE_DIR", "EXPORT_CACHE_MAX_BYTES",
+    "EXPORT_TMP_DIR", "EXPORT_PART_BYTES", "EXPORT_COMPRESS_MIN_BYTES",
+    "MIRROR_DIR",
+]
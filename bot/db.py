@@ -1,41 +1,125 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import text
-from .config import settings
+from contextvars import ContextVar
+from dataclasses import dataclass
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+from sqlalchemy.orm import DeclarativeBase, Session
+from sqlalchemy import text, event
+from .config import (
+    settings,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_CACHE_KIB, SQLITE_MMAP_BYTES,
+    SQLITE_TEMP_STORE, SQLITE_BUSY_TIMEOUT_MS, SQLITE_JOURNAL_SIZE_LIMIT,
+    DB_POOL_SIZE, DB_POOL_OVERFLOW, DB_POOL_TIMEOUT,
+)
 
 class Base(DeclarativeBase):
     pass
 
-engine = create_async_engine(settings.DATABASE_URL, echo=False, future=True)
+# ---------- профиль SQLite на каждое новое соединение ----------
+
+def sqlite_pragmas() -> list[str]:
+    """PRAGMA из config.py в порядке применения (busy_timeout — первым: journal_mode=WAL берёт блокировку)."""
+    return [
+        f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}",
+        f"PRAGMA cache_size=-{SQLITE_CACHE_KIB}",
+        f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}",
+        f"PRAGMA temp_store={SQLITE_TEMP_STORE}",
+        f"PRAGMA journal_size_limit={SQLITE_JOURNAL_SIZE_LIMIT}",
+    ]
+
+def install_sqlite_hooks(engine: AsyncEngine, *, pragmas: bool = True) -> None:
+    """
+    Транзакции — под управлением SQLAlchemy, а не драйвера. pysqlite сам открывает транзакцию
+    только перед INSERT/UPDATE/DELETE и не перед SAVEPOINT: первый begin_nested() начинал
+    транзакцию SAVEPOINT'ом, а его RELEASE её коммитил (групповой коммит bot/write_queue.py
+    превращался в коммит на каждую запись). Поэтому автокоммит драйвера выключен, BEGIN —
+    явный (рецепт из документации SQLAlchemy для pysqlite/aiosqlite).
+    pragmas=True — ещё и профиль sqlite_pragmas() на каждое новое соединение.
+    """
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_conn, conn_record):
+        dbapi_conn.isolation_level = None
+        if pragmas:
+            cursor = dbapi_conn.cursor()
+            try:
+                for pragma in sqlite_pragmas():
+                    cursor.execute(pragma)
+            finally:
+                cursor.close()
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def _on_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+engine = create_async_engine(
+    settings.DATABASE_URL,
+    echo=False,
+    future=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_POOL_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+)
+install_sqlite_hooks(engine)
 async_session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
-async def init_db():
-    from . import models  # noqa
-    async with engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
-    await _ensure_schema()
+# ---------- учёт работы с БД на один апдейт ----------
+
+@dataclass
+class DbCounters:
+    sessions: int = 0
+    connections: int = 0
+    commits: int = 0
+
+# выставляется middleware на время обработки апдейта (bot/middlewares.py)
+current_db_counters: ContextVar[DbCounters | None] = ContextVar("current_db_counters", default=None)
+
+_READ_VERBS = ("SELECT", "PRAGMA", "WITH", "EXPLAIN")
+
+def session_has_writes(session: AsyncSession) -> bool:
+    """Есть ли в текущей транзакции сессии незакоммиченные изменения."""
+    return bool(session.info.get("writes")) or bool(session.new or session.dirty or session.deleted)
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _count_checkout(dbapi_conn, conn_record, conn_proxy):
+    c = current_db_counters.get()
+    if c is not None:
+        c.connections += 1
+
+@event.listens_for(Session, "after_begin")
+def _count_session(session, transaction, connection):
+    c = current_db_counters.get()
+    if c is not None and not session.info.get("counted"):
+        session.info["counted"] = True
+        c.sessions += 1
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_writes(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["writes"] = True
+    elif not state.is_select:
+        # text(...) не размечен как select/insert — смотрим на первое слово
+        sql = str(getattr(state.statement, "text", "")).lstrip()
+        if not sql.upper().startswith(_READ_VERBS):
+            state.session.info["writes"] = True
+
+@event.listens_for(Session, "after_flush")
+def _track_flush(session, flush_context):
+    session.info["writes"] = True
+
+@event.listens_for(Session, "after_commit")
+def _count_commit(session):
+    session.info["writes"] = False
+    c = current_db_counters.get()
+    if c is not None:
+        c.commits += 1
+
+@event.listens_for(Session, "after_rollback")
+def _reset_writes(session):
+    session.info["writes"] = False
 
 async def init_db():
+    """Создать недостающие таблицы и применить миграции (bot/migrations.py)."""
+    from . import models  # noqa
+    from .migrations import run_migrations
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        # уникальный индекс на flyer_number, но только когда он не NULL
-        await conn.execute(text(
-            "CREATE UNIQUE INDEX IF NOT EXISTS ux_contact_flyer "
-            "ON contact(flyer_number) WHERE flyer_number IS NOT NULL;"
-        ))
-
-async def _ensure_schema():
-    """Мягкие миграции для SQLite: добавляем недостающие колонки в agent."""
-    async with engine.begin() as conn:
-        res = await conn.execute(text("PRAGMA table_info(agent)"))
-        cols = [row[1] for row in res]
-        if "admin_logged_in" not in cols:
-            try:
-                await conn.execute(text("ALTER TABLE agent ADD COLUMN admin_logged_in BOOLEAN DEFAULT 0"))
-            except Exception:
-                pass
-        if "username" not in cols:
-            try:
-                await conn.execute(text("ALTER TABLE agent ADD COLUMN username VARCHAR(255)"))
-            except Exception:
-                pass
+        await run_migrations(conn)
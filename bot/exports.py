@@ -0,0 +1,424 @@
+# bot/exports.py
+"""
+Очередь заданий на выгрузки (XLSX/CSV) админа, бригадира и агента.
+
+Хендлер не собирает файл сам, а ставит задание через export_jobs.submit() и сразу
+отвечает. Одновременно выполняется не больше EXPORT_JOBS_CONCURRENCY заданий, у
+одного пользователя — не больше EXPORT_JOBS_PER_USER в очереди и в работе.
+Одинаковые запросы (scope, период, формат), пришедшие, пока задание ещё не
+готово, склеиваются: файл собирается один раз и уходит всем ожидающим — первому
+загрузкой, остальным по file_id. Ход задания виден в статус-сообщении, которое
+редактируется по мере работы. Счётчики очереди и длительностей — в stats().
+
+Если хендлер передал водяной знак данных (watermark), готовый файл кладётся в
+utils.artifact_cache; повторный запрос при том же знаке отправляется сразу из
+кеша по file_id, без очереди и пересборки.
+
+Каждое задание пишет файлы в свой каталог job.workdir (внутри EXPORT_TMP_DIR),
+который удаляется по завершении; остатки после аварийной остановки чистит start().
+Крупный файл перед отправкой сжимается в zip (utils.export_pack), а больше
+EXPORT_PART_BYTES — уходит нумерованными частями и сообщением-манифестом.
+"""
+from __future__ import annotations
+
+import asyncio
+import html
+import logging
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, FSInputFile, InputFile, Message
+
+from .utils.artifact_cache import artifact_cache, CachedArtifact
+from .utils.export_pack import pack_export, manifest_text, PackedPart
+from .utils.export_pool import export_pool
+from .config import (
+    EXPORT_JOBS_CONCURRENCY, EXPORT_JOBS_PER_USER, EXPORT_JOBS_MAX_QUEUED, EXPORT_PROGRESS_INTERVAL,
+    EXPORT_TMP_DIR, EXPORT_PART_BYTES, EXPORT_COMPRESS_MIN_BYTES,
+)
+
+logger = logging.getLogger(__name__)
+
+# (scope, days, fmt): scope — "all", "brig:<tg_id>", "agent:<agent_id>", "admin:<tg_id>" (дельта-выгрузки);
+# у дописывания в книгу fmt — "xlsx_merge:<file_unique_id>" присланного файла
+ExportKey = tuple[str, int | None, str]
+
+# уже сжатые форматы: в zip кладём, только если файл надо резать на части
+_PACKED_SUFFIXES = {".xlsx", ".zip", ".gz"}
+
+
+@dataclass
+class ExportResult:
+    """
+    Итог задания: файл (path или data) с подписью либо только текст (нет данных).
+    path должен лежать в job.workdir — каталог удаляется после отправки.
+    """
+    text: str
+    path: Path | None = None
+    data: bytes | None = None
+    filename: str | None = None
+    cacheable: bool = True  # False — запасной вариант (например, CSV вместо XLSX), в кеш не кладём
+    # после упаковки (_pack): части по порядку, если архив пришлось резать, и размеры до/после сжатия
+    parts: list[PackedPart] = field(default_factory=list)
+    manifest: str | None = None
+    raw_bytes: int | None = None
+    packed_bytes: int | None = None
+    # вызывается один раз, если файл дошёл хотя бы до одного получателя (например, сдвиг водяного знака)
+    on_sent: Callable[[], Awaitable[None]] | None = None
+
+    @property
+    def has_file(self) -> bool:
+        return self.path is not None or self.data is not None or bool(self.parts)
+
+
+@dataclass(eq=False)
+class _Waiter:
+    bot: Bot
+    user_id: int
+    chat_id: int
+    status_id: int | None = None  # message_id статус-сообщения
+
+
+@dataclass(eq=False)
+class ExportJob:
+    key: ExportKey
+    title: str
+    build: Callable[["ExportJob"], Awaitable[ExportResult]]
+    watermark: object = None
+    waiters: list[_Waiter] = field(default_factory=list)
+    queued_at: float = field(default_factory=time.perf_counter)
+    started_at: float | None = None
+    workdir: Path | None = None  # временный каталог задания (создаётся при старте)
+    _progress_at: float = 0.0
+    _progress_text: str = ""
+
+    async def progress(self, text: str, *, force: bool = False) -> None:
+        """Обновить статус у всех ожидающих (не чаще EXPORT_PROGRESS_INTERVAL, если не force)."""
+        now = time.perf_counter()
+        if text == self._progress_text or (not force and now - self._progress_at < EXPORT_PROGRESS_INTERVAL):
+            return
+        self._progress_at, self._progress_text = now, text
+        for w in list(self.waiters):
+            await _edit_status(w, f"⏳ {self.title}: {text}")
+
+
+def _upload(path: Path | None, filename: str, data: bytes | None) -> InputFile:
+    return FSInputFile(str(path), filename=filename) if path is not None else BufferedInputFile(data, filename=filename)
+
+
+async def _edit_status(w: _Waiter, text: str) -> None:
+    if w.status_id is None:
+        return
+    try:
+        await w.bot.edit_message_text(text, chat_id=w.chat_id, message_id=w.status_id)
+    except Exception:
+        # «message is not modified», удалённое сообщение и т.п. — статус не критичен
+        logger.debug("Export status edit failed", exc_info=True)
+
+
+class ExportJobs:
+    def __init__(
+        self,
+        *,
+        concurrency: int = EXPORT_JOBS_CONCURRENCY,
+        per_user: int = EXPORT_JOBS_PER_USER,
+        max_queued: int = EXPORT_JOBS_MAX_QUEUED,
+        part_bytes: int = EXPORT_PART_BYTES,
+        tmp_dir: str | Path = EXPORT_TMP_DIR,
+    ) -> None:
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.part_bytes = part_bytes
+        self.tmp_dir = Path(tmp_dir)
+        self._sem = asyncio.Semaphore(concurrency)
+        self._jobs: dict[ExportKey, ExportJob] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+        # счётчики для логов/диагностики
+        self.submitted = 0
+        self.cached = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.done = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+        self.split = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.upload_total = 0.0
+
+    # ---- постановка
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for j in self._jobs.values() if j.started_at is None)
+
+    @property
+    def running(self) -> int:
+        return sum(1 for j in self._jobs.values() if j.started_at is not None)
+
+    def _user_jobs(self, user_id: int) -> int:
+        return sum(1 for j in self._jobs.values() if any(w.user_id == user_id for w in j.waiters))
+
+    async def submit(
+        self,
+        m: Message,
+        key: ExportKey,
+        title: str,
+        build: Callable[[ExportJob], Awaitable[ExportResult]],
+        *,
+        watermark: object = None,
+    ) -> bool:
+        """
+        Поставить выгрузку в очередь от имени автора сообщения m.
+        watermark — отпечаток данных выгрузки; при совпадении с кешем файл уходит сразу.
+        False — отказ (лимит пользователя или переполненная очередь), причина уже отправлена.
+        """
+        waiter = _Waiter(bot=m.bot, user_id=m.from_user.id, chat_id=m.chat.id)
+        if watermark is not None:
+            entry = artifact_cache.get(key, watermark)
+            if entry is not None:
+                self.cached += 1
+                await self._send_cached(waiter, key, watermark, entry)
+                return True
+
+        job = self._jobs.get(key)
+        if job is not None:
+            if any(w.user_id == waiter.user_id for w in job.waiters):
+                await m.answer(f"⏳ {title}: уже собирается, пришлю, как будет готово.")
+                return True
+            if self._user_jobs(waiter.user_id) >= self.per_user:
+                self.rejected += 1
+                await m.answer("⏳ У вас уже собираются выгрузки. Дождитесь их и повторите.")
+                return False
+            # такая же выгрузка уже в работе — просто ждём её результат
+            self.coalesced += 1
+            waiter.status_id = (await m.answer(f"⏳ {title}: такая же выгрузка уже собирается, пришлю и вам.")).message_id
+            job.waiters.append(waiter)
+            return True
+
+        if self._user_jobs(waiter.user_id) >= self.per_user:
+            self.rejected += 1
+            await m.answer("⏳ У вас уже собираются выгрузки. Дождитесь их и повторите.")
+            return False
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            await m.answer("⏳ Сейчас собирается слишком много выгрузок. Попробуйте через пару минут.")
+            return False
+
+        self.submitted += 1
+        job = ExportJob(key=key, title=title, build=build, watermark=watermark, waiters=[waiter])
+        self._jobs[key] = job
+        ahead = self.queued - 1
+        status = await m.answer(f"⏳ {title}: в очереди" + (f", перед вами {ahead}." if ahead else ", начинаю…"))
+        waiter.status_id = status.message_id
+        task = asyncio.create_task(self._run(job), name=f"export-{key[0]}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    # ---- выполнение
+
+    async def _run(self, job: ExportJob) -> None:
+        try:
+            async with self._sem:
+                job.started_at = time.perf_counter()
+                wait = job.started_at - job.queued_at
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.tmp_dir.mkdir(parents=True, exist_ok=True)
+                job.workdir = Path(tempfile.mkdtemp(prefix=job.key[0].replace(":", "_") + "_", dir=self.tmp_dir))
+                await job.progress("собираю…", force=True)
+                try:
+                    result = await job.build(job)
+                    await self._pack(job, result)
+                finally:
+                    # новые запросы с тем же ключом — уже за свежими данными
+                    self._forget(job)
+                    run = time.perf_counter() - job.started_at
+                    self.run_total += run
+                    self.run_max = max(self.run_max, run)
+                if job.watermark is not None and result.has_file and result.cacheable and not result.parts:
+                    entry = artifact_cache.put(
+                        job.key, job.watermark, caption=result.text,
+                        filename=result.filename or result.path.name,
+                        src=result.path, data=result.data,
+                    )
+                    result.path, result.data = artifact_cache.path(entry), None
+                    result.filename = entry.filename
+                await self._deliver(job, result)
+            self.done += 1
+            logger.info("Export %s done: %d requester(s), wait %.1f s, run %.1f s",
+                        job.key, len(job.waiters), wait, run)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.exception("Export %s failed", job.key)
+            for w in job.waiters:
+                await _edit_status(w, f"⚠️ {job.title}: не удалось сформировать экспорт: {html.escape(str(e))}")
+        finally:
+            self._forget(job)
+            if job.workdir is not None:
+                shutil.rmtree(job.workdir, ignore_errors=True)
+
+    def _forget(self, job: ExportJob) -> None:
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+    async def _pack(self, job: ExportJob, result: ExportResult) -> None:
+        """Сжать крупный файл результата в zip; больше part_bytes — нарезать на части (в export_pool)."""
+        if result.path is None:
+            return
+        size = result.path.stat().st_size
+        if size <= self.part_bytes and (
+            size <= EXPORT_COMPRESS_MIN_BYTES or result.path.suffix.lower() in _PACKED_SUFFIXES
+        ):
+            return
+        await job.progress("сжимаю…", force=True)
+        parts, result.raw_bytes, result.packed_bytes = await export_pool.run(
+            pack_export, str(result.path), self.part_bytes,
+        )
+        if len(parts) == 1:
+            result.path = Path(parts[0].path)
+            result.filename = result.path.name
+        else:
+            self.split += 1
+            result.path, result.parts = None, parts
+            result.manifest = manifest_text(job.title, parts, result.raw_bytes)
+
+    async def _deliver(self, job: ExportJob, result: ExportResult) -> None:
+        if not result.has_file:
+            for w in job.waiters:
+                await _edit_status(w, result.text)
+            return
+        if result.parts:
+            files = [(Path(p.path), Path(p.path).name) for p in result.parts]
+        elif result.path is not None:
+            files = [(result.path, result.filename or result.path.name)]
+        else:
+            files = [(None, result.filename or "export")]
+        file_ids: list[str | None] = [None] * len(files)
+        any_delivered = False
+        t0 = time.perf_counter()
+        for w in job.waiters:
+            await _edit_status(w, f"📤 {job.title}: отправляю…")
+            delivered = True
+            for i, (path, filename) in enumerate(files):
+                caption = result.text
+                if len(files) > 1:
+                    caption = f"Часть {i + 1} из {len(files)}" + (f". {result.text}" if result.text else "")
+                try:
+                    if file_ids[i] is not None:
+                        try:
+                            sent = await w.bot.send_document(w.chat_id, file_ids[i], caption=caption or None)
+                        except TelegramBadRequest:
+                            # file_id с прошлой отправки не принят — этому получателю грузим файл заново
+                            logger.warning("Export %s file_id rejected for %s, uploading", job.key, w.chat_id,
+                                           exc_info=True)
+                            file_ids[i] = None
+                    if file_ids[i] is None:
+                        sent = await w.bot.send_document(
+                            w.chat_id, _upload(path, filename, result.data), caption=caption or None,
+                        )
+                except Exception:
+                    logger.exception("Export %s delivery to %s failed", job.key, w.chat_id)
+                    await _edit_status(w, f"⚠️ {job.title}: не удалось отправить файл.")
+                    delivered = False
+                    break
+                if file_ids[i] is None and sent.document is not None:
+                    file_ids[i] = sent.document.file_id
+                    if len(files) == 1 and job.watermark is not None and result.cacheable:
+                        artifact_cache.set_file_id(job.key, job.watermark, file_ids[i])
+            if not delivered:
+                continue
+            any_delivered = True
+            if result.manifest:
+                try:
+                    await w.bot.send_message(w.chat_id, result.manifest)
+                except Exception:
+                    logger.exception("Export %s manifest to %s failed", job.key, w.chat_id)
+            if w.status_id is not None:
+                try:
+                    await w.bot.delete_message(w.chat_id, w.status_id)
+                except Exception:
+                    logger.debug("Export status delete failed", exc_info=True)
+
+        if any_delivered and result.on_sent is not None:
+            try:
+                await result.on_sent()
+            except Exception:
+                logger.exception("Export %s on_sent hook failed", job.key)
+        upload = time.perf_counter() - t0
+        sent = result.packed_bytes or sum(p.stat().st_size for p, _ in files if p is not None) or len(result.data or b"")
+        raw = result.raw_bytes or sent
+        self.upload_total += upload
+        self.sent_bytes += sent
+        self.raw_bytes += raw
+        logger.info("Export %s sent: %d part(s), %d -> %d bytes (x%.1f), upload %.1f s",
+                    job.key, len(files), raw, sent, raw / sent if sent else 1.0, upload)
+
+    async def _send_cached(self, w: _Waiter, key: ExportKey, watermark: object, entry: CachedArtifact) -> None:
+        if entry.file_id is not None:
+            try:
+                await w.bot.send_document(w.chat_id, entry.file_id, caption=entry.caption or None)
+                return
+            except TelegramBadRequest:
+                # file_id больше не действует (сменился токен бота, файл удалён у Telegram)
+                logger.warning("Cached file_id for %s rejected, uploading from disk", key, exc_info=True)
+                artifact_cache.forget_file_id(key, watermark)
+        document = FSInputFile(str(artifact_cache.path(entry)), filename=entry.filename)
+        sent = await w.bot.send_document(w.chat_id, document, caption=entry.caption or None)
+        if sent.document is not None:
+            artifact_cache.set_file_id(key, watermark, sent.document.file_id)
+
+    # ---- жизненный цикл
+
+    def start(self) -> None:
+        """Убрать временные каталоги заданий, оставшиеся после аварийной остановки."""
+        if self.tmp_dir.exists():
+            for p in self.tmp_dir.iterdir():
+                if p.is_dir():
+                    shutil.rmtree(p, ignore_errors=True)
+                else:
+                    p.unlink(missing_ok=True)
+
+    async def stop(self, timeout: float = 15.0) -> None:
+        """Дождаться текущих заданий (не дольше timeout), остальные отменить."""
+        pending = list(self._tasks)
+        if pending:
+            _, not_done = await asyncio.wait(pending, timeout=timeout)
+            for t in not_done:
+                t.cancel()
+
+    def stats(self) -> dict:
+        done = self.done + self.failed
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "submitted": self.submitted,
+            "cached": self.cached,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "done": self.done,
+            "failed": self.failed,
+            "wait_avg_s": round(self.wait_total / done, 2) if done else 0.0,
+            "wait_max_s": round(self.wait_max, 2),
+            "run_avg_s": round(self.run_total / done, 2) if done else 0.0,
+            "run_max_s": round(self.run_max, 2),
+            "split": self.split,
+            "compression": round(self.raw_bytes / self.sent_bytes, 2) if self.sent_bytes else 1.0,
+            "upload_total_s": round(self.upload_total, 1),
+        }
+
+
+export_jobs = ExportJobs()
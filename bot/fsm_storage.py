@@ -0,0 +1,292 @@
+# bot/fsm_storage.py
+"""
+FSM-хранилище aiogram на отдельном SQLite-файле (FSM_DB_PATH): опрос, начатый агентом,
+переживает перезапуск бота (visit_id и накапливаемая карточка — в state.update_data).
+
+Чтения идут из словаря в памяти; в файл — только при первом обращении к ключу после старта.
+Записи внутри апдейта копятся в памяти, а FsmFlushMiddleware (bot/middlewares.py) после
+хендлера сбрасывает изменённые ключи одной транзакцией: set_state и несколько update_data
+одного шага — одна запись. Вне апдейта (фоновые задачи) запись уходит сразу.
+Данные сериализуются pickle; файл отдельный, чтобы не делить блокировку записи с data.db.
+
+Память ограничена: запись без обращений дольше FSM_CACHE_TTL уходит из словаря (остаётся
+в файле), при FSM_CACHE_MAXSIZE вытесняется самая давняя. Несброшенные записи не вытесняются.
+Брошенные опросы стирает из файла expire() — его зовёт уборщик (bot/sweeper.py) и дописывает
+в БД карточки из стёртых данных; не вышло — возвращает записи на место restore(). Ключи из
+saving_keys (карточку как раз пишет хендлер) expire() не стирает: одну карточку пишет кто-то один.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import pickle
+import time
+from contextvars import ContextVar
+from copy import copy
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Mapping
+
+import aiosqlite
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from .config import FSM_DB_PATH, FSM_CACHE_TTL, FSM_CACHE_MAXSIZE
+
+logger = logging.getLogger(__name__)
+
+# ключи, изменённые за текущий апдейт (выставляется FsmFlushMiddleware); None — вне апдейта
+pending_fsm_keys: ContextVar[set[str] | None] = ContextVar("pending_fsm_keys", default=None)
+
+# опросы, чью карточку сейчас пишет хендлер (или занимает под неё номер флаера, см. routers/flow.py):
+# повторный апдейт того же агента отступает, expire() ключ не стирает
+saving_keys: set[StorageKey] = set()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key        TEXT PRIMARY KEY,
+    state      TEXT,
+    data       BLOB,
+    updated_at REAL NOT NULL
+)
+"""
+_INDEX = "CREATE INDEX IF NOT EXISTS ix_fsm_updated ON fsm (updated_at)"
+
+
+@dataclass
+class ExpiredRecord:
+    key: str
+    state: str | None
+    data: dict[str, Any]
+    updated_at: float
+
+
+@dataclass
+class _Record:
+    state: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+    used_at: float = field(default_factory=time.monotonic)
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self, path: str = FSM_DB_PATH, *, ttl: float = FSM_CACHE_TTL, maxsize: int = FSM_CACHE_MAXSIZE,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._db: aiosqlite.Connection | None = None
+        self._open_lock = asyncio.Lock()
+        # порядок вставки = порядок последнего обращения (самая давняя запись — первая)
+        self._cache: dict[str, _Record] = {}
+        self._dirty: set[str] = set()
+        # ключи, чья запись не удалась: их дописывает следующий flush (любого ключа)
+        self._retry: set[str] = set()
+
+        self.hits = 0
+        self.loads = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.evicted = 0
+        self.expired = 0
+
+    # ---- файл
+
+    async def _conn(self) -> aiosqlite.Connection:
+        if self._db is None:
+            async with self._open_lock:
+                if self._db is None:
+                    db = await aiosqlite.connect(self.path)
+                    await db.execute("PRAGMA journal_mode=WAL")
+                    await db.execute("PRAGMA synchronous=NORMAL")
+                    await db.execute(_SCHEMA)
+                    await db.execute(_INDEX)
+                    await db.commit()
+                    self._db = db
+        return self._db
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+        return ":".join("" if p is None else str(p) for p in parts)
+
+    async def _record(self, key: StorageKey) -> tuple[str, _Record]:
+        k = self._key(key)
+        rec = self._cache.pop(k, None)
+        if rec is not None:
+            self.hits += 1
+            rec.used_at = time.monotonic()
+            self._cache[k] = rec
+            return k, rec
+        db = await self._conn()
+        async with db.execute("SELECT state, data FROM fsm WHERE key = ?", (k,)) as cur:
+            row = await cur.fetchone()
+        self.loads += 1
+        # пока ждали файл, запись могла появиться из другого апдейта — она свежее
+        rec = self._cache.get(k)
+        if rec is None:
+            rec = _Record(row[0], pickle.loads(row[1]) if row[1] else {}) if row else _Record()
+            if len(self._cache) >= self.maxsize:
+                self.trim()
+            self._cache[k] = rec
+        return k, rec
+
+    def trim(self) -> int:
+        """Убрать из памяти записи без обращений дольше ttl; если всё ещё полно — самые давние."""
+        deadline = time.monotonic() - self.ttl
+        drop = []
+        for k, rec in self._cache.items():
+            if rec.used_at >= deadline:
+                break
+            if k not in self._dirty:
+                drop.append(k)
+        excess = len(self._cache) - len(drop) - self.maxsize + 1
+        if excess > 0:
+            dropping = set(drop)
+            for k in self._cache:
+                if excess <= 0:
+                    break
+                if k not in dropping and k not in self._dirty:
+                    drop.append(k)
+                    excess -= 1
+        for k in drop:
+            del self._cache[k]
+        self.evicted += len(drop)
+        return len(drop)
+
+    async def expire(self, before: float) -> list[ExpiredRecord]:
+        """
+        Стереть из файла и памяти записи, не менявшиеся с before (time.time()): брошенные опросы.
+        Возвращает стёртое. Ключ, который как раз меняется (не сброшен), живой: его запишет flush,
+        в результат он не попадает. Ключ из saving_keys тоже: карточку пишет хендлер — уборщик
+        её не получит, а строку в файл вернёт следующий flush.
+        """
+        db = await self._conn()
+        async with db.execute(
+            "DELETE FROM fsm WHERE updated_at < ? RETURNING key, state, data, updated_at", (before,),
+        ) as cur:
+            rows = await cur.fetchall()
+        await db.commit()
+        # дальше без await: хендлер не займёт ключ между проверкой и снятием записи из памяти,
+        # а начатый после — найдёт опрос уже пустым
+        saving = {self._key(key) for key in saving_keys}
+        expired = []
+        for k, st, data, updated_at in rows:
+            if k in self._dirty:
+                continue
+            if k in saving:
+                self._cache.setdefault(k, _Record(st, pickle.loads(data) if data else {}))
+                self._dirty.add(k)
+                self._retry.add(k)
+                continue
+            self._cache.pop(k, None)
+            expired.append(ExpiredRecord(k, st, pickle.loads(data) if data else {}, updated_at))
+        self.expired += len(expired)
+        return expired
+
+    async def restore(self, records: list[ExpiredRecord]) -> None:
+        """Вернуть стёртые expire() записи (если ключ успел начаться заново — остаётся новая)."""
+        db = await self._conn()
+        await db.executemany(
+            "INSERT OR IGNORE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+            [(r.key, r.state, pickle.dumps(r.data, pickle.HIGHEST_PROTOCOL), r.updated_at) for r in records],
+        )
+        await db.commit()
+        self.expired -= len(records)
+
+    async def _changed(self, k: str) -> None:
+        self._dirty.add(k)
+        pending = pending_fsm_keys.get()
+        if pending is not None:
+            pending.add(k)
+        else:
+            await self.flush([k])
+
+    async def flush(self, keys: Iterable[str]) -> None:
+        """Записать текущие значения ключей одной транзакцией (пустые записи удаляются)."""
+        keys = list(self._retry.union(keys))
+        self._retry.clear()
+        upserts, deletes = [], []
+        now = time.time()
+        for k in keys:
+            rec = self._cache.get(k)
+            if rec is None:
+                continue
+            if rec.state is None and not rec.data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, rec.state, pickle.dumps(rec.data, pickle.HIGHEST_PROTOCOL), now))
+        # значения уже сняты: изменения во время записи снова пометят ключ
+        self._dirty.difference_update(keys)
+        if not upserts and not deletes:
+            return
+        try:
+            db = await self._conn()
+            if upserts:
+                await db.executemany(
+                    "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                    "updated_at = excluded.updated_at",
+                    upserts,
+                )
+            if deletes:
+                await db.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+            await db.commit()
+        except Exception:
+            # не записалось: ключи снова несброшенные (trim их не вытеснит) и уйдут со следующим flush
+            self._dirty.update(keys)
+            self._retry.update(keys)
+            if self._db is not None:
+                await self._db.rollback()
+            raise
+        self.flushes += 1
+        self.rows_written += len(upserts) + len(deletes)
+
+    # ---- BaseStorage
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, rec = await self._record(key)
+        rec.state = state.state if isinstance(state, State) else state
+        await self._changed(k)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._record(key))[1].state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        k, rec = await self._record(key)
+        rec.data = data.copy()
+        await self._changed(k)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._record(key))[1].data.copy()
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Any | None = None) -> Any | None:
+        return copy((await self._record(storage_key))[1].data.get(dict_key, default))
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> dict[str, Any]:
+        k, rec = await self._record(key)
+        rec.data.update(data)
+        await self._changed(k)
+        return rec.data.copy()
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+
+fsm_storage = SQLiteStorage()
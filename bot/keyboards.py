@@ -144,7 +144,11 @@ BTN_ADMIN_STATS_ALL = "📈 Сводка по всем"
 BTN_ADMIN_EXPORT_XLSX = "📤 Экспорт XLSX"
 BTN_ADMIN_EXPORT_CSV = "📩 Экспорт CSV"
 BTN_XLSX_ALL = "XLSX — всё"
+BTN_XLSX_PIVOTS = "XLSX — только сводные"
+BTN_XLSX_DELTA = "XLSX — новое с прошлой выгрузки"
+BTN_XLSX_MERGE = "XLSX — дописать в прошлую книгу"
 BTN_CSV_ALL = "CSV — всё"
+BTN_CSV_DELTA = "CSV — новое с прошлой выгрузки"
 
 # --- Доступы (бригадиры) ---
 BTN_ADMIN_ACCESS         = "🔑 Доступы (бригадиры)"
@@ -187,6 +191,9 @@ def kb_admin_export_xlsx() -> ReplyKeyboardMarkup:
         resize_keyboard=True,
         keyboard=[
             [KeyboardButton(text=BTN_XLSX_ALL)],
+            [KeyboardButton(text=BTN_XLSX_PIVOTS)],
+            [KeyboardButton(text=BTN_XLSX_DELTA)],
+            [KeyboardButton(text=BTN_XLSX_MERGE)],
             [KeyboardButton(text=BTN_BACK)],
         ],
     )
@@ -196,6 +203,7 @@ def kb_admin_export_csv() -> ReplyKeyboardMarkup:
         resize_keyboard=True,
         keyboard=[
             [KeyboardButton(text=BTN_CSV_ALL)],
+            [KeyboardButton(text=BTN_CSV_DELTA)],
             [KeyboardButton(text=BTN_BACK)],
         ],
     )
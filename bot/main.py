@@ -1,24 +1,36 @@
 import asyncio
+import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 from .config import settings
-from .db import init_db
+from .db import init_db, async_session
+from .repo import warm_flyer_bitmap
+from .outbox import outbox_worker
+from .sweeper import sweeper
+from .write_queue import write_queue
+from .utils.webhook import stimul_client
+from .utils.export_pool import export_pool
+from .exports import export_jobs
+from .utils.artifact_cache import artifact_cache
+from .utils.contact_mirror import contact_mirror
+from .access import access_cache
+from .fsm_storage import fsm_storage
+from .middlewares import DbSessionMiddleware, AccessMiddleware, FsmFlushMiddleware, db_stats
 from .routers.home import router as home_router
 from .routers.flow import router as flow_router
 from .routers.admin import router as admin_router
 from .routers.stats import router as stats_router
 from .routers.brigadier import router as brigadier_router  # ← добавлено
 
-async def main():
-    if not settings.BOT_TOKEN:
-        raise RuntimeError("Укажите BOT_TOKEN в config.py")
-
-    await init_db()
-
-    bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+def create_dispatcher() -> Dispatcher:
+    # FSM в SQLite-файле: опрос не теряется при перезапуске; запись — одна на апдейт
+    dp = Dispatcher(storage=fsm_storage)
+    dp.update.outer_middleware(FsmFlushMiddleware(fsm_storage))
+    # одна сессия БД на апдейт (data["session"] → аргумент session у хендлеров)
+    dp.update.outer_middleware(DbSessionMiddleware())
+    dp.update.outer_middleware(AccessMiddleware())
 
     # Порядок подключения: общие → роль-меню
     dp.include_router(home_router)
@@ -26,8 +38,48 @@ async def main():
     dp.include_router(stats_router)
     dp.include_router(admin_router)
     dp.include_router(brigadier_router)  # ← добавлено
+    return dp
+
+async def main():
+    if not settings.BOT_TOKEN:
+        raise RuntimeError("Укажите BOT_TOKEN в config.py")
+
+    await init_db()
+    async with async_session() as session:
+        await warm_flyer_bitmap(session)
+
+    bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = create_dispatcher()
 
-    await dp.start_polling(bot)
+    await write_queue.start()
+    await stimul_client.start()
+    await outbox_worker.start()
+    await sweeper.start()
+    export_pool.start()
+    export_jobs.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await outbox_worker.stop()
+        await sweeper.stop()
+        await export_jobs.stop()
+        # после остановки поллинга новых записей нет — дописываем принятые
+        await write_queue.stop()
+        await stimul_client.close()
+        await fsm_storage.close()
+        export_pool.close()
+        logging.getLogger(__name__).info("Stimul client stats: %s", stimul_client.stats())
+        logging.getLogger(__name__).info("Export jobs stats: %s", export_jobs.stats())
+        logging.getLogger(__name__).info("Export pool stats: %s", export_pool.stats())
+        logging.getLogger(__name__).info("Export cache stats: %s", artifact_cache.stats())
+        logging.getLogger(__name__).info("Contact mirror stats: %s", contact_mirror.stats())
+        logging.getLogger(__name__).info("DB per-update stats: %s", db_stats.snapshot())
+        logging.getLogger(__name__).info("FSM storage stats: %s", fsm_storage.stats())
+        logging.getLogger(__name__).info("Sweeper stats: %s", sweeper.stats())
+        logging.getLogger(__name__).info("Write queue stats: %s", write_queue.stats())
+        logging.getLogger(__name__).info(
+            "Access cache: hits=%d misses=%d", access_cache.hits, access_cache.misses,
+        )
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,152 @@
+# bot/middlewares.py
+from __future__ import annotations
+
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+
+from .db import async_session, session_has_writes, current_db_counters, DbCounters
+from .fsm_storage import SQLiteStorage, pending_fsm_keys
+from .access import AccessContext, access_cache
+from .repo import get_or_create_agent, get_access_flags
+
+logger = logging.getLogger(__name__)
+
+
+class DbStats:
+    """Накопительные счётчики по всем апдейтам: видно, сколько сессий/соединений/коммитов стоит апдейт."""
+
+    def __init__(self) -> None:
+        self.updates = 0
+        self.sessions = 0
+        self.connections = 0
+        self.commits = 0
+
+    def record(self, c: DbCounters) -> None:
+        self.updates += 1
+        self.sessions += c.sessions
+        self.connections += c.connections
+        self.commits += c.commits
+
+    def snapshot(self) -> dict:
+        n = self.updates or 1
+        return {
+            "updates": self.updates,
+            "sessions_per_update": round(self.sessions / n, 2),
+            "connections_per_update": round(self.connections / n, 2),
+            "commits_per_update": round(self.commits / n, 2),
+        }
+
+
+db_stats = DbStats()
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Одна AsyncSession на апдейт: кладётся в data["session"], хендлеры получают её аргументом.
+    Коммит ленивый — только если в сессии были изменения, которые хендлер сам не закоммитил.
+    При исключении изменения откатываются.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        counters = DbCounters()
+        token = current_db_counters.set(counters)
+        try:
+            async with async_session() as session:
+                data["session"] = session
+                result = await handler(event, data)
+                if session_has_writes(session):
+                    await session.commit()
+                return result
+        finally:
+            current_db_counters.reset(token)
+            db_stats.record(counters)
+            logger.debug(
+                "update: sessions=%d connections=%d commits=%d",
+                counters.sessions, counters.connections, counters.commits,
+            )
+
+
+class FsmFlushMiddleware(BaseMiddleware):
+    """
+    Сброс FSM на диск один раз за апдейт: все set_state/update_data хендлера копятся
+    в pending_fsm_keys и пишутся одной транзакцией после него (и при исключении тоже).
+    """
+
+    def __init__(self, storage: SQLiteStorage) -> None:
+        self.storage = storage
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        keys: set[str] = set()
+        token = pending_fsm_keys.set(keys)
+        try:
+            return await handler(event, data)
+        finally:
+            pending_fsm_keys.reset(token)
+            if keys:
+                try:
+                    await self.storage.flush(keys)
+                except Exception:
+                    logger.exception("FSM flush failed (%d keys)", len(keys))
+
+
+BLOCKED_TEXT = "⛔️ Доступ к опросам ограничен администратором/бригадиром."
+
+
+class AccessMiddleware(BaseMiddleware):
+    """
+    Флаги доступа пользователя один раз на апдейт: data["access"] (AccessContext).
+    Берётся из access_cache, при промахе — один запрос get_access_flags.
+    Заблокированные пользователи (кроме вошедших админов) дальше хендлеров не проходят.
+    Регистрируется после DbSessionMiddleware — нужна data["session"].
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        access = access_cache.get(user.id)
+        if access is None:
+            session = data["session"]
+            agent_id, is_admin, is_brig, is_blocked = await get_access_flags(session, user.id)
+            if agent_id is None:
+                agent = await get_or_create_agent(session, user.id, name=user.full_name, username=user.username)
+                agent_id = agent.id
+                # сразу: хендлер может ждать write_queue, а её писатель — блокировку записи,
+                # которую держала бы незакоммиченная вставка до конца апдейта
+                await session.commit()
+            access = AccessContext(
+                tg_user_id=user.id,
+                agent_id=agent_id,
+                is_admin=is_admin,
+                is_brig=is_brig,
+                is_blocked=is_blocked,
+            )
+            access_cache.put(access)
+        data["access"] = access
+
+        if access.is_blocked and not access.is_admin:
+            if isinstance(event, Update) and event.message is not None:
+                await event.message.answer(BLOCKED_TEXT)
+            elif isinstance(event, Update) and event.callback_query is not None:
+                await event.callback_query.answer(BLOCKED_TEXT, show_alert=True)
+            return None
+        return await handler(event, data)
@@ -0,0 +1,303 @@
+# bot/migrations.py
+"""
+Версионные миграции схемы SQLite. Выполняются один раз при старте (init_db).
+
+Применённые версии записываются в schema_version. На последующих запусках
+сверяется отпечаток (PRAGMA schema_version + состав таблиц/колонок моделей):
+если он совпал и все версии применены — старт обходится без DDL и PRAGMA table_info.
+
+Новая миграция — функция async (conn) -> None в конце MIGRATIONS со следующим номером.
+Миграции должны быть идемпотентны: на свежей базе таблицы уже созданы create_all.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .db import Base
+
+logger = logging.getLogger(__name__)
+
+
+async def _table_info(conn: AsyncConnection, table: str) -> list[dict]:
+    res = await conn.execute(text(f"PRAGMA table_info({table})"))
+    # rows: (cid, name, type, notnull, dflt_value, pk)
+    return [{"cid": r[0], "name": r[1], "type": r[2], "notnull": r[3], "dflt": r[4], "pk": r[5]} for r in res.all()]
+
+
+# ==========================
+# Миграции
+# ==========================
+
+async def _m001_agent_columns(conn: AsyncConnection) -> None:
+    """agent: колонки admin_logged_in и username в старых базах."""
+    cols = {c["name"] for c in await _table_info(conn, "agent")}
+    if "admin_logged_in" not in cols:
+        await conn.execute(text("ALTER TABLE agent ADD COLUMN admin_logged_in BOOLEAN DEFAULT 0"))
+    if "username" not in cols:
+        await conn.execute(text("ALTER TABLE agent ADD COLUMN username VARCHAR(255)"))
+
+
+async def _m002_brig_tables(conn: AsyncConnection) -> None:
+    """
+    Таблицы бригадиров:
+      - brigadiers(brig_tg_id PK)
+      - brig_sessions(brig_tg_id PK, logged_in INT)
+      - brig_members(brig_tg_id, member_tg_id, PK (brig_tg_id, member_tg_id))
+      - blocked_members(member_tg_id PK, blocked_by)
+    Старые варианты схемы пересоздаются с переносом данных.
+    """
+    # ---- brigadiers ----
+    info = await _table_info(conn, "brigadiers")
+    if not info:
+        await conn.execute(text("CREATE TABLE brigadiers (brig_tg_id BIGINT PRIMARY KEY)"))
+    else:
+        cols = [c["name"] for c in info]
+        if "brig_tg_id" not in cols or len(cols) != 1:
+            # переносим данные из любой подходящей колонки
+            candidate = next((n for n in ("brig_tg_id", "brig_id", "tg_id", "id") if n in cols), None)
+            await conn.execute(text("ALTER TABLE brigadiers RENAME TO brigadiers_old"))
+            await conn.execute(text("CREATE TABLE brigadiers (brig_tg_id BIGINT PRIMARY KEY)"))
+            if candidate:
+                await conn.execute(text(f"""
+                    INSERT OR IGNORE INTO brigadiers (brig_tg_id)
+                    SELECT {candidate} FROM brigadiers_old
+                    WHERE {candidate} IS NOT NULL
+                """))
+            await conn.execute(text("DROP TABLE brigadiers_old"))
+
+    # ---- brig_sessions ----
+    ddl = """
+        CREATE TABLE brig_sessions (
+            brig_tg_id BIGINT PRIMARY KEY,
+            logged_in INTEGER NOT NULL DEFAULT 0
+        )
+    """
+    info = await _table_info(conn, "brig_sessions")
+    if not info:
+        await conn.execute(text(ddl))
+    else:
+        cols = {c["name"] for c in info}
+        if not {"brig_tg_id", "logged_in"}.issubset(cols) or len(cols) != 2:
+            await conn.execute(text("ALTER TABLE brig_sessions RENAME TO brig_sessions_old"))
+            await conn.execute(text(ddl))
+            if {"brig_tg_id", "logged_in"}.issubset(cols):
+                await conn.execute(text("""
+                    INSERT OR IGNORE INTO brig_sessions (brig_tg_id, logged_in)
+                    SELECT brig_tg_id, logged_in FROM brig_sessions_old
+                """))
+            await conn.execute(text("DROP TABLE brig_sessions_old"))
+
+    # ---- brig_members ----
+    ddl = """
+        CREATE TABLE brig_members (
+            brig_tg_id   BIGINT NOT NULL,
+            member_tg_id BIGINT NOT NULL,
+            PRIMARY KEY (brig_tg_id, member_tg_id)
+        )
+    """
+    info = await _table_info(conn, "brig_members")
+    if not info:
+        await conn.execute(text(ddl))
+    else:
+        cols = {c["name"] for c in info}
+        if not {"brig_tg_id", "member_tg_id"}.issubset(cols) or len(cols) != 2:
+            await conn.execute(text("ALTER TABLE brig_members RENAME TO brig_members_old"))
+            await conn.execute(text(ddl))
+            if {"brig_tg_id", "member_tg_id"}.issubset(cols):
+                await conn.execute(text("""
+                    INSERT OR IGNORE INTO brig_members (brig_tg_id, member_tg_id)
+                    SELECT brig_tg_id, member_tg_id FROM brig_members_old
+                """))
+            await conn.execute(text("DROP TABLE brig_members_old"))
+
+    # ---- blocked_members ----
+    await conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS blocked_members (
+            member_tg_id BIGINT PRIMARY KEY,
+            blocked_by   BIGINT
+        )
+    """))
+
+
+async def _m003_flyer_claims(conn: AsyncConnection) -> None:
+    """
+    Уникальный индекс на contact.flyer_number и перенос занятых номеров в реестр flyer_claim.
+    Нечисловые значения пропускаются; «007» и «7» считаются одним номером — побеждает ранний контакт.
+    """
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_contact_flyer "
+        "ON contact(flyer_number) WHERE flyer_number IS NOT NULL"
+    ))
+    res = await conn.execute(text("SELECT 1 FROM flyer_claim LIMIT 1"))
+    if res.first() is not None:
+        return
+    await conn.execute(text("""
+        INSERT OR IGNORE INTO flyer_claim (number, contact_id, claimed_at)
+        SELECT CAST(TRIM(flyer_number) AS INTEGER), id, COALESCE(closed_at, created_at)
+        FROM contact
+        WHERE flyer_number IS NOT NULL
+          AND TRIM(flyer_number) <> ''
+          AND TRIM(flyer_number) NOT GLOB '*[^0-9]*'
+          AND LENGTH(TRIM(flyer_number)) <= 18
+        ORDER BY id
+    """))
+
+
+async def _m004_agent_day_stats(conn: AsyncConnection) -> None:
+    """Первичное заполнение суточного роллапа agent_day_stats по закрытым контактам."""
+    res = await conn.execute(text("SELECT 1 FROM agent_day_stats LIMIT 1"))
+    if res.first() is not None:
+        return
+    await conn.execute(text("""
+        INSERT INTO agent_day_stats
+            (agent_id, day, total, consent, refusal, no_one, hand, mailbox, none, home_yes)
+        SELECT agent_id, date(created_at), COUNT(*),
+               SUM(talk_status = 'CONSENT'), SUM(talk_status = 'REFUSAL'), SUM(talk_status = 'NO_ONE'),
+               SUM(flyer_method = 'HAND'), SUM(flyer_method = 'MAILBOX'), SUM(flyer_method = 'NONE'),
+               SUM(COALESCE(home_voting, 0) = 1)
+        FROM contact
+        WHERE closed_at IS NOT NULL AND agent_id IS NOT NULL
+        GROUP BY agent_id, date(created_at)
+    """))
+
+
+async def _m005_indexes(conn: AsyncConnection) -> None:
+    """Индексы под запросы repo.py (в моделях объявлены те же имена)."""
+    for ddl in (
+        "CREATE INDEX IF NOT EXISTS ix_contact_agent_created ON contact (agent_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_contact_created ON contact (created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_contact_open ON contact (created_at) WHERE closed_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_visit_agent_id ON visit (agent_id)",
+        "CREATE INDEX IF NOT EXISTS ix_agent_username_lower ON agent (lower(username))",
+        "CREATE INDEX IF NOT EXISTS ix_agent_day_stats_day ON agent_day_stats (day)",
+    ):
+        await conn.execute(text(ddl))
+
+
+async def _m006_contact_updated_at(conn: AsyncConnection) -> None:
+    """contact.updated_at для водяного знака кеша выгрузок; старым строкам — время закрытия/создания."""
+    cols = {c["name"] for c in await _table_info(conn, "contact")}
+    if "updated_at" not in cols:
+        await conn.execute(text("ALTER TABLE contact ADD COLUMN updated_at DATETIME"))
+    await conn.execute(text(
+        "UPDATE contact SET updated_at = COALESCE(closed_at, created_at) WHERE updated_at IS NULL"
+    ))
+
+
+async def _m007_contact_updated_index(conn: AsyncConnection) -> None:
+    """Индекс по contact.updated_at: зеркало выгрузок забирает изменённые карточки диапазоном."""
+    await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_contact_updated ON contact (updated_at)"))
+
+
+async def _m008_visit_open_index(conn: AsyncConnection) -> None:
+    """Частичный индекс незакрытых визитов: уборщик закрывает брошенные пачками."""
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_visit_open ON visit (started_at) WHERE closed_at IS NULL"
+    ))
+
+
+async def _m009_agent_day_cube(conn: AsyncConnection) -> None:
+    """
+    Первичное заполнение суточного куба agent_day_cube по закрытым контактам.
+    Коды — позиция в Enum + 1 (0 — NULL): RepeatTouch, TalkStatus, FlyerMethod из models.py.
+    """
+    res = await conn.execute(text("SELECT 1 FROM agent_day_cube LIMIT 1"))
+    if res.first() is not None:
+        return
+    await conn.execute(text("""
+        INSERT INTO agent_day_cube (agent_id, day, repeat, status, method, home, n)
+        SELECT COALESCE(agent_id, 0), date(created_at),
+               CASE repeat_touch WHEN 'PRIMARY' THEN 1 WHEN 'SECONDARY' THEN 2 ELSE 0 END,
+               CASE talk_status WHEN 'NO_ONE' THEN 1 WHEN 'REFUSAL' THEN 2 WHEN 'CONSENT' THEN 3 ELSE 0 END,
+               CASE flyer_method WHEN 'HAND' THEN 1 WHEN 'MAILBOX' THEN 2 WHEN 'NONE' THEN 3 ELSE 0 END,
+               COALESCE(home_voting, 0) = 1, COUNT(*)
+        FROM contact
+        WHERE closed_at IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5, 6
+    """))
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[AsyncConnection], Awaitable[None]]]] = [
+    (1, "agent columns", _m001_agent_columns),
+    (2, "brigadier tables", _m002_brig_tables),
+    (3, "flyer claims", _m003_flyer_claims),
+    (4, "agent_day_stats rollup", _m004_agent_day_stats),
+    (5, "query indexes", _m005_indexes),
+    (6, "contact.updated_at", _m006_contact_updated_at),
+    (7, "contact.updated_at index", _m007_contact_updated_index),
+    (8, "visit open index", _m008_visit_open_index),
+    (9, "agent_day_cube rollup", _m009_agent_day_cube),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# ==========================
+# Раннер
+# ==========================
+
+def _models_digest() -> str:
+    """Отпечаток моделей: меняется, если в коде добавили таблицу/колонку/индекс."""
+    parts = []
+    for t in sorted(Base.metadata.tables.values(), key=lambda t: t.name):
+        parts.append(t.name + ":" + ",".join(c.name for c in t.columns))
+        parts.extend(sorted(f"{t.name}#{ix.name}" for ix in t.indexes))
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+
+async def _fingerprint(conn: AsyncConnection) -> str:
+    res = await conn.execute(text("PRAGMA schema_version"))
+    return f"{res.scalar()}:{_models_digest()}"
+
+
+async def run_migrations(conn: AsyncConnection) -> list[int]:
+    """
+    Привести схему к LATEST_VERSION. Возвращает список применённых версий
+    (пустой — схема уже актуальна и отпечаток совпал).
+    """
+    # на актуальной базе — ни одного DDL, даже CREATE … IF NOT EXISTS
+    exists = (await conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    ))).first()
+    if exists is None:
+        await conn.execute(text("""
+            CREATE TABLE schema_version (
+                version     INTEGER PRIMARY KEY,
+                name        VARCHAR(100) NOT NULL,
+                applied_at  DATETIME NOT NULL,
+                fingerprint VARCHAR(64)
+            )
+        """))
+    row = (await conn.execute(text(
+        "SELECT version, fingerprint FROM schema_version ORDER BY version DESC LIMIT 1"
+    ))).first()
+    current = row[0] if row else 0
+    if current >= LATEST_VERSION and row[1] == await _fingerprint(conn):
+        return []
+
+    # новые таблицы/индексы моделей; существующие таблицы create_all не трогает
+    await conn.run_sync(Base.metadata.create_all)
+
+    applied = []
+    for version, name, fn in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("schema migration %d: %s", version, name)
+        await fn(conn)
+        await conn.execute(
+            text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+            {"v": version, "n": name, "t": datetime.utcnow()},
+        )
+        applied.append(version)
+
+    await conn.execute(
+        text("UPDATE schema_version SET fingerprint = :f WHERE version = :v"),
+        {"f": await _fingerprint(conn), "v": max(current, LATEST_VERSION)},
+    )
+    return applied
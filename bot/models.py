@@ -1,6 +1,6 @@
 from __future__ import annotations
-from datetime import datetime
-from sqlalchemy import String, Integer, ForeignKey, Boolean, DateTime, Enum as SAEnum
+from datetime import datetime, date
+from sqlalchemy import String, Integer, ForeignKey, Boolean, Date, DateTime, Index, Enum as SAEnum, func, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from .db import Base
 import enum
@@ -19,6 +19,11 @@ class FlyerMethod(str, enum.Enum):
     MAILBOX = "MAILBOX"
     NONE = "NONE"
 
+class OutboxStatus(str, enum.Enum):
+    PENDING = "PENDING"
+    SENT = "SENT"
+    DEAD = "DEAD"
+
 class Agent(Base):
     __tablename__ = "agent"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -32,10 +37,13 @@ class Agent(Base):
     visits: Mapped[list['Visit']] = relationship(back_populates="agent")
     contacts: Mapped[list['Contact']] = relationship(back_populates="agent")
 
+# поиск по @username без учёта регистра (repo.get_agent_by_username)
+Index("ix_agent_username_lower", func.lower(Agent.username))
+
 class Visit(Base):
     __tablename__ = "visit"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    agent_id: Mapped[int] = mapped_column(ForeignKey("agent.id", ondelete="CASCADE"))
+    agent_id: Mapped[int] = mapped_column(ForeignKey("agent.id", ondelete="CASCADE"), index=True)
     address: Mapped[str | None] = mapped_column(String(255), nullable=True)
     started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     closed_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
@@ -43,6 +51,9 @@ class Visit(Base):
     agent: Mapped['Agent'] = relationship(back_populates="visits")
     contacts: Mapped[list['Contact']] = relationship(back_populates="visit")
 
+    # незакрытые визиты — уборщик брошенных опросов (bot/sweeper.py)
+    __table_args__ = (Index("ix_visit_open", "started_at", sqlite_where=text("closed_at IS NULL")),)
+
 class Contact(Base):
     __tablename__ = "contact"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -65,6 +76,93 @@ class Contact(Base):
 
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     closed_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # любое изменение карточки (водяной знак кеша выгрузок)
+    updated_at: Mapped[datetime | None] = mapped_column(
+        DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow,
+    )
 
     visit: Mapped['Visit'] = relationship(back_populates="contacts")
     agent: Mapped['Agent'] = relationship(back_populates="contacts")
+
+    __table_args__ = (
+        # сводки/выгрузки агента за период
+        Index("ix_contact_agent_created", "agent_id", "created_at"),
+        # общие выгрузки и край периода в сводках
+        Index("ix_contact_created", "created_at"),
+        # незакрытые карточки (их ещё нет в agent_day_stats)
+        Index("ix_contact_open", "created_at", sqlite_where=text("closed_at IS NULL")),
+        # дозаливка изменённых карточек в колоночное зеркало (utils.contact_mirror)
+        Index("ix_contact_updated", "updated_at"),
+    )
+
+class FlyerClaim(Base):
+    """Реестр выданных номеров флаеров: один номер — одна строка (PK = номер)."""
+    __tablename__ = "flyer_claim"
+    number: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    contact_id: Mapped[int | None] = mapped_column(ForeignKey("contact.id", ondelete="SET NULL"), nullable=True)
+    claimed_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class AgentDayStats(Base):
+    """
+    Суточная сводка по агенту (день — по contact.created_at, UTC) только по закрытым карточкам.
+    Ведётся в repo.save_contact / repo.close_abandoned_contacts, пересборка — python -m bot.cli rollup-rebuild.
+    """
+    __tablename__ = "agent_day_stats"
+    agent_id: Mapped[int] = mapped_column(ForeignKey("agent.id", ondelete="CASCADE"), primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    consent: Mapped[int] = mapped_column(Integer, default=0)
+    refusal: Mapped[int] = mapped_column(Integer, default=0)
+    no_one: Mapped[int] = mapped_column(Integer, default=0)
+    hand: Mapped[int] = mapped_column(Integer, default=0)
+    mailbox: Mapped[int] = mapped_column(Integer, default=0)
+    none: Mapped[int] = mapped_column(Integer, default=0)
+    home_yes: Mapped[int] = mapped_column(Integer, default=0)
+
+    __table_args__ = (Index("ix_agent_day_stats_day", "day"),)
+
+class AgentDayCube(Base):
+    """
+    Те же закрытые карточки, что в agent_day_stats, с разбивкой по (повторность, статус, флаер, надомка):
+    сводные листы выгрузки (repo.contact_cube) без прохода по contact. Коды — позиция в Enum + 1
+    (0 — NULL), как в колоночном зеркале; agent_id 0 — карточка без агента.
+    Ведётся там же, где agent_day_stats, пересборка — python -m bot.cli rollup-rebuild.
+    """
+    __tablename__ = "agent_day_cube"
+    agent_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    repeat: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    status: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    method: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    home: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+
+    n: Mapped[int] = mapped_column(Integer, default=0)
+
+    __table_args__ = (Index("ix_agent_day_cube_day", "day"),)
+
+class ExportMark(Base):
+    """Водяной знак дельта-выгрузки администратора: карточки с id <= last_contact_id он уже получил."""
+    __tablename__ = "export_mark"
+    tg_user_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    last_contact_id: Mapped[int] = mapped_column(Integer, default=0)
+    exported_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class WebhookOutbox(Base):
+    """Очередь доставки вебхуков Stimul: пишется в одной транзакции с закрытием контакта."""
+    __tablename__ = "webhook_outbox"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    contact_id: Mapped[int | None] = mapped_column(ForeignKey("contact.id", ondelete="SET NULL"), nullable=True, index=True)
+    phone: Mapped[str] = mapped_column(String(32))
+    code: Mapped[str] = mapped_column(String(64))
+    voting_at_home: Mapped[bool] = mapped_column(Boolean, default=False)
+
+    status: Mapped[OutboxStatus] = mapped_column(SAEnum(OutboxStatus), default=OutboxStatus.PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_error: Mapped[str | None] = mapped_column(String(500), nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_webhook_outbox_due", "status", "next_attempt_at"),)
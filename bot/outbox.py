@@ -0,0 +1,142 @@
+# bot/outbox.py
+"""
+Фоновая доставка вебхуков Stimul из таблицы webhook_outbox.
+
+Хендлер пишет строку outbox в той же транзакции, что и закрытие контакта, и сразу
+отвечает агенту. Воркер выбирает «созревшие» PENDING-строки, шлёт их с ограниченной
+параллельностью, при неудаче (сеть, таймаут, 5xx, 429) перепланирует с экспоненциальной
+задержкой, а после OUTBOX_MAX_ATTEMPTS переводит в DEAD. Невалидные данные и постоянные 4xx
+(400/401/404/422…) повтор не исправит — такие строки уходят в DEAD сразу. Доставка — at-least-once:
+строки, не успевшие завершиться до остановки, уйдут после рестарта.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+
+from .config import (
+    OUTBOX_CONCURRENCY, OUTBOX_BATCH, OUTBOX_POLL_INTERVAL,
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX,
+)
+from .db import async_session
+from .repo import list_due_webhooks, mark_webhook_sent, mark_webhook_failed
+from .utils.webhook import build_lottery_payload, stimul_client
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Задержка перед попыткой №attempt+1: base * 2^(attempt-1), с джиттером 50–100%."""
+    raw = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** max(0, attempt - 1)))
+    return raw * random.uniform(0.5, 1.0)
+
+
+class OutboxWorker:
+    def __init__(
+        self,
+        *,
+        concurrency: int = OUTBOX_CONCURRENCY,
+        batch: int = OUTBOX_BATCH,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+    ) -> None:
+        self.concurrency = concurrency
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+
+        self._sem = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+        # счётчики для логов/диагностики
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+
+    # ---- жизненный цикл
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="outbox-worker")
+
+    async def stop(self, timeout: float = 15.0) -> None:
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        pending = list(self._inflight.values())
+        if pending:
+            # даём текущим запросам завершиться; остальное доставим после рестарта
+            _, not_done = await asyncio.wait(pending, timeout=timeout)
+            for t in not_done:
+                t.cancel()
+
+    def notify(self) -> None:
+        """Разбудить воркер: в очереди появилась новая строка."""
+        self._wake.set()
+
+    # ---- цикл
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                free = self.batch - len(self._inflight)
+                if free > 0:
+                    async with async_session() as session:
+                        rows = await list_due_webhooks(session, limit=free, exclude_ids=self._inflight.keys())
+                    for row in rows:
+                        self._inflight[row.id] = asyncio.create_task(self._deliver(row))
+            except Exception:
+                logger.exception("Outbox poll failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, row) -> None:
+        try:
+            async with self._sem:
+                payload, msg = build_lottery_payload(row.phone, row.code, row.voting_at_home)
+                ok = retry = False
+                if payload is not None:
+                    ok, msg, retry = await stimul_client.post(payload)
+
+            attempt = row.attempts + 1
+            async with async_session() as session:
+                if ok:
+                    await mark_webhook_sent(session, row.id)
+                    self.sent += 1
+                elif not retry or attempt >= self.max_attempts:
+                    await mark_webhook_failed(session, row.id, error=msg, retry_at=None)
+                    self.dead += 1
+                    logger.warning("Outbox #%s (contact %s) dead after %s attempts: %s",
+                                   row.id, row.contact_id, attempt, msg)
+                else:
+                    retry_at = datetime.utcnow() + timedelta(seconds=backoff_delay(attempt))
+                    await mark_webhook_failed(session, row.id, error=msg, retry_at=retry_at)
+                    self.failed += 1
+                    logger.info("Outbox #%s attempt %s failed, retry at %s: %s",
+                                row.id, attempt, retry_at.isoformat(timespec="seconds"), msg)
+                await session.commit()
+            # освободилось место — можно добрать следующую порцию
+            self._wake.set()
+        except Exception:
+            # строка осталась PENDING — подберём её на следующем плановом опросе
+            logger.exception("Outbox delivery #%s crashed", row.id)
+        finally:
+            self._inflight.pop(row.id, None)
+
+
+outbox_worker = OutboxWorker()
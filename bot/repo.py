@@ -1,16 +1,24 @@
 from __future__ import annotations
 
-from typing import Iterable, Optional, List, Dict
+from typing import AsyncIterator, Iterable, Optional, List, Dict, Sequence
 from hashlib import sha256
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, time
 import re
 from sqlalchemy import func
 
-from sqlalchemy import select, update, text
+from sqlalchemy import select, update, delete, insert, text, case, cast, Integer, LargeBinary, Row, event
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
 
-from .models import Agent, Visit, Contact, RepeatTouch, TalkStatus, FlyerMethod
+from .models import (
+    Agent, Visit, Contact, FlyerClaim, WebhookOutbox, AgentDayStats, AgentDayCube, ExportMark,
+    RepeatTouch, TalkStatus, FlyerMethod, OutboxStatus,
+)
+from .utils.flyers import flyer_bitmap, FLYER_MIN, FLYER_MAX
+from .access import invalidate_access
+from .config import EXPORT_CHUNK_SIZE
 
 # ==========================
 # Общие хелперы
@@ -48,13 +56,14 @@ async def get_or_create_agent(
 
     # create
     agent = Agent(tg_user_id=tg_user_id, name=name, username=username)
-    session.add(agent)
     try:
-        await session.flush()
+        # SAVEPOINT: при гонке откатывается только вставка, а не вся транзакция
+        # (в групповом коммите bot/write_queue.py в ней чужие записи)
+        async with session.begin_nested():
+            session.add(agent)
         return agent
     except IntegrityError:
         # гонка: кто-то создал параллельно
-        await session.rollback()
         res = await session.execute(select(Agent).where(Agent.tg_user_id == tg_user_id))
         agent = res.scalars().first()
         if agent:
@@ -113,321 +122,779 @@ async def create_contact(
     await session.flush()
     return c
 
-async def update_contact_fields(session: AsyncSession, contact_id: int, **fields) -> Contact | None:
-    await session.execute(update(Contact).where(Contact.id == contact_id).values(**fields))
-    res = await session.execute(select(Contact).where(Contact.id == contact_id))
-    return res.scalars().first()
+async def save_contact(
+    session: AsyncSession,
+    *,
+    visit_id: int,
+    agent_id: int,
+    full_name: str,
+    phone_e164: str,
+    created_at: datetime,
+    door_photo: bool = False,
+    repeat_touch: RepeatTouch | str | None = None,
+    talk_status: TalkStatus | str | None = None,
+    flyer_method: FlyerMethod | str | None = None,
+    flyer_number: int | None = None,
+    home_voting: bool | None = None,
+) -> int:
+    """
+    Записать заполненную карточку опроса сразу закрытой: INSERT … RETURNING id, привязка
+    заранее занятого номера флаера (claim_flyer_number с contact_id=None), agent_day_stats и agent_day_cube.
+    Коммит — вместе с остальной транзакцией вызывающего. Возвращает id карточки.
+    """
+    repeat_touch = RepeatTouch(repeat_touch) if repeat_touch else None
+    talk_status = TalkStatus(talk_status) if talk_status else None
+    flyer_method = FlyerMethod(flyer_method) if flyer_method else None
+    now = datetime.utcnow()
+    res = await session.execute(
+        insert(Contact)
+        .values(
+            visit_id=visit_id,
+            agent_id=agent_id,
+            full_name=full_name,
+            phone_e164=phone_e164,
+            phone_hash=phone_hash(phone_e164),
+            door_photo=door_photo,
+            repeat_touch=repeat_touch,
+            talk_status=talk_status,
+            flyer_method=flyer_method,
+            flyer_number=None if flyer_number is None else str(flyer_number),
+            home_voting=home_voting,
+            created_at=created_at,
+            closed_at=now,
+            updated_at=now,
+        )
+        .returning(Contact.id)
+    )
+    contact_id = res.scalar_one()
+    if flyer_number is not None:
+        await session.execute(
+            update(FlyerClaim)
+            .where(FlyerClaim.number == flyer_number, FlyerClaim.contact_id.is_(None))
+            .values(contact_id=contact_id)
+        )
+    await _rollup_add(session, agent_id, created_at, repeat_touch, talk_status, flyer_method, home_voting)
+    return contact_id
+
+# ---- брошенные опросы (bot/sweeper.py)
+
+async def close_abandoned_contacts(session: AsyncSession, *, before: datetime, limit: int) -> int:
+    """
+    Закрыть до limit карточек, открытых с created_at < before, одним UPDATE по ix_contact_open
+    и учесть их в agent_day_stats и agent_day_cube (по строке на агента, день и ячейку куба).
+    Возвращает число закрытых.
+    """
+    now = datetime.utcnow()
+    open_ids = (
+        select(Contact.id)
+        .where(Contact.closed_at.is_(None), Contact.created_at < before)
+        .order_by(Contact.created_at)
+        .limit(limit)
+    )
+    res = await session.execute(
+        update(Contact)
+        .where(Contact.id.in_(open_ids.scalar_subquery()))
+        .values(closed_at=now, updated_at=now)
+        .returning(Contact.agent_id, Contact.created_at, Contact.repeat_touch,
+                   Contact.talk_status, Contact.flyer_method, Contact.home_voting)
+        .execution_options(synchronize_session=False)
+    )
+    rows = res.all()
+    groups: dict[tuple[int, date], dict[str, int]] = {}
+    cells: dict[tuple, int] = {}
+    for r in rows:
+        cell = (r.agent_id, r.created_at.date(),
+                _cube_codes(r.repeat_touch, r.talk_status, r.flyer_method, r.home_voting))
+        cells[cell] = cells.get(cell, 0) + 1
+        if r.agent_id is None:
+            continue
+        acc = groups.setdefault((r.agent_id, r.created_at.date()), dict.fromkeys(_STAT_KEYS, 0))
+        for k, v in _card_counts(r.talk_status, r.flyer_method, r.home_voting).items():
+            acc[k] += v
+    if groups:
+        await _rollup_upsert(session, [
+            {"agent_id": agent_id, "day": day, **counts} for (agent_id, day), counts in groups.items()
+        ])
+    if cells:
+        await _cube_upsert(session, [_cube_row(*cell, n) for cell, n in cells.items()])
+    return len(rows)
+
+async def close_abandoned_visits(session: AsyncSession, *, before: datetime, limit: int) -> int:
+    """Закрыть до limit визитов, открытых с started_at < before, одним UPDATE по ix_visit_open."""
+    open_ids = (
+        select(Visit.id)
+        .where(Visit.closed_at.is_(None), Visit.started_at < before)
+        .order_by(Visit.started_at)
+        .limit(limit)
+    )
+    res = await session.execute(
+        update(Visit)
+        .where(Visit.id.in_(open_ids.scalar_subquery()))
+        .values(closed_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    return res.rowcount
 
-async def close_contact(session: AsyncSession, contact_id: int) -> None:
-    res = await session.execute(select(Contact).where(Contact.id == contact_id))
-    c = res.scalars().first()
-    if c and not c.closed_at:
-        c.closed_at = datetime.utcnow()
-        await session.flush()
+# ==========================
+# Outbox вебхуков Stimul
+# ==========================
+
+async def enqueue_lottery_webhook(
+    session: AsyncSession,
+    *,
+    contact_id: int | None,
+    phone: str,
+    code: str,
+    voting_at_home: bool,
+) -> WebhookOutbox:
+    """Поставить вебхук в очередь. Коммит — вместе с остальной транзакцией вызывающего."""
+    row = WebhookOutbox(
+        contact_id=contact_id,
+        phone=phone,
+        code=str(code).strip(),
+        voting_at_home=bool(voting_at_home),
+    )
+    session.add(row)
+    await session.flush()
+    return row
+
+async def list_due_webhooks(
+    session: AsyncSession, *, limit: int, exclude_ids: Iterable[int] = ()
+) -> list[WebhookOutbox]:
+    """PENDING-строки, у которых подошло время попытки (индекс ix_webhook_outbox_due)."""
+    q = (
+        select(WebhookOutbox)
+        .where(
+            WebhookOutbox.status == OutboxStatus.PENDING,
+            WebhookOutbox.next_attempt_at <= datetime.utcnow(),
+        )
+        .order_by(WebhookOutbox.next_attempt_at)
+        .limit(limit)
+    )
+    exclude = list(exclude_ids)
+    if exclude:
+        q = q.where(WebhookOutbox.id.not_in(exclude))
+    res = await session.execute(q)
+    return list(res.scalars().all())
+
+async def mark_webhook_sent(session: AsyncSession, outbox_id: int) -> None:
+    await session.execute(
+        update(WebhookOutbox)
+        .where(WebhookOutbox.id == outbox_id)
+        .values(
+            status=OutboxStatus.SENT,
+            attempts=WebhookOutbox.attempts + 1,
+            sent_at=datetime.utcnow(),
+            last_error=None,
+        )
+    )
+
+async def mark_webhook_failed(
+    session: AsyncSession, outbox_id: int, *, error: str, retry_at: datetime | None
+) -> None:
+    """Неудачная попытка: retry_at=None — в DEAD, иначе перепланировать."""
+    values = {
+        "attempts": WebhookOutbox.attempts + 1,
+        "last_error": (error or "")[:500],
+    }
+    if retry_at is None:
+        values["status"] = OutboxStatus.DEAD
+    else:
+        values["next_attempt_at"] = retry_at
+    await session.execute(
+        update(WebhookOutbox).where(WebhookOutbox.id == outbox_id).values(**values)
+    )
+
+async def get_webhook_status(session: AsyncSession, contact_id: int) -> WebhookOutbox | None:
+    """Последняя запись outbox по контакту (статус, попытки, последняя ошибка)."""
+    res = await session.execute(
+        select(WebhookOutbox)
+        .where(WebhookOutbox.contact_id == contact_id)
+        .order_by(WebhookOutbox.id.desc())
+        .limit(1)
+    )
+    return res.scalars().first()
 
 # ==========================
 # Выгрузки / выборки
 # ==========================
 
-async def list_contacts_for_period(session: AsyncSession, *, days: int | None):
+# колонки зеркала contact (utils.contact_mirror): порядок — как в _encode там же
+_MIRROR_COLUMNS = (
+    Contact.id, Contact.agent_id, Contact.repeat_touch, Contact.talk_status, Contact.flyer_method,
+    Contact.home_voting, Contact.created_at, Contact.full_name, Contact.phone_e164, Contact.flyer_number,
+    Contact.updated_at,
+)
+
+async def _stream_partitions(session: AsyncSession, q, chunk_size: int) -> AsyncIterator[Sequence[Row]]:
+    res = await session.stream(q.execution_options(yield_per=chunk_size))
+    try:
+        async for part in res.partitions():
+            yield part
+    finally:
+        await res.close()
+
+async def iter_contacts_after(
+    session: AsyncSession,
+    after_id: int,
+    *,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> AsyncIterator[Sequence[Row]]:
     """
-    Список (Contact, Agent) за период (days) или за весь период (None).
-    Сортировка — от новых к старым.
+    Карточки с id > after_id по возрастанию id, пачками по chunk_size (дозаливка зеркала).
+    Читает серверным курсором по PK, ORM-объекты не создаются.
     """
+    q = select(*_MIRROR_COLUMNS).where(Contact.id > after_id).order_by(Contact.id)
+    async for part in _stream_partitions(session, q, chunk_size):
+        yield part
+
+async def iter_contacts_updated(
+    session: AsyncSession,
+    *,
+    since: datetime,
+    max_id: int,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> AsyncIterator[Sequence[Row]]:
+    """Уже зеркалированные карточки (id <= max_id), изменённые не раньше since (индекс ix_contact_updated)."""
     q = (
-        select(Contact, Agent)
+        select(*_MIRROR_COLUMNS)
+        .where(Contact.updated_at >= since, Contact.id <= max_id)
+        .order_by(Contact.updated_at)
+    )
+    async for part in _stream_partitions(session, q, chunk_size):
+        yield part
+
+async def count_contacts(session: AsyncSession, *, max_id: int) -> int:
+    """Число карточек с id <= max_id (сверка зеркала: расхождение — значит, строки удаляли)."""
+    res = await session.execute(select(func.count(Contact.id)).where(Contact.id <= max_id))
+    return int(res.scalar() or 0)
+
+async def contacts_checksum(session: AsyncSession) -> dict[str, int]:
+    """
+    Контрольные суммы по колонкам contact в кодировке зеркала (utils.contact_mirror):
+    коды перечислений — позиция в Enum + 1 (0 — NULL), время — секунды UNIX, строки — длина в байтах UTF-8.
+    """
+    def _code(col, enum_cls):
+        return func.sum(_enum_code(col, enum_cls))
+
+    def _bytes(col):
+        return func.sum(func.coalesce(func.length(cast(col, LargeBinary)), 0))
+
+    q = select(
+        func.count(Contact.id).label("rows"),
+        func.sum(Contact.id).label("id"),
+        func.sum(func.coalesce(Contact.agent_id, 0)).label("agent"),
+        _code(Contact.repeat_touch, RepeatTouch).label("repeat"),
+        _code(Contact.talk_status, TalkStatus).label("status"),
+        _code(Contact.flyer_method, FlyerMethod).label("method"),
+        func.sum(case((Contact.home_voting.is_(True), 1), else_=0)).label("home"),
+        func.sum(cast(func.strftime("%s", Contact.created_at), Integer)).label("created"),
+        _bytes(Contact.full_name).label("full_name"),
+        _bytes(Contact.phone_e164).label("phone"),
+        _bytes(Contact.flyer_number).label("flyer"),
+    )
+    row = (await session.execute(q)).one()
+    return {k: int(v or 0) for k, v in row._mapping.items()}
+
+async def contact_cube(session: AsyncSession, *, days: int | None) -> list[tuple]:
+    """
+    Счётчики карточек за период по (агент, повторность, статус, флаер, надомка) без выборки строк:
+    целые дни — из agent_day_cube, из contact — только неполный первый день периода и ещё
+    не закрытые карточки (как в _period_counts). Формат — как у MirrorSnapshot.cube:
+    [(agent_id | None, RepeatTouch | None, TalkStatus | None, FlyerMethod | None, bool, n)].
+    """
+    cells = (AgentDayCube.repeat, AgentDayCube.status, AgentDayCube.method, AgentDayCube.home)
+    roll = (
+        select(Agent.id, *cells, func.sum(AgentDayCube.n))
+        .select_from(AgentDayCube)
+        .join(Agent, AgentDayCube.agent_id == Agent.id, isouter=True)
+        .group_by(Agent.id, *cells)
+    )
+    keys = (Agent.id, *_contact_cube_codes())
+    contacts = (
+        select(*keys, func.count())
+        .select_from(Contact)
         .join(Agent, Contact.agent_id == Agent.id, isouter=True)
+        .group_by(*keys)
     )
+    # незакрытых карточек в кубе ещё нет (частичный индекс ix_contact_open)
+    open_q = contacts.where(Contact.closed_at.is_(None))
+    queries = [roll, open_q]
+    if days is not None:
+        since = datetime.utcnow() - timedelta(days=days)
+        edge = datetime.combine(since.date() + timedelta(days=1), time.min)
+        queries = [
+            roll.where(AgentDayCube.day >= edge.date()),
+            open_q.where(Contact.created_at >= edge),
+            # неполный первый день — все карточки прямо из contact
+            contacts.where(Contact.created_at >= since, Contact.created_at < edge),
+        ]
+
+    out: dict[tuple, int] = {}
+    for q in queries:
+        for agent_id, *codes, n in (await session.execute(q)).all():
+            key = (agent_id, *codes)
+            out[key] = out.get(key, 0) + n
+    return [
+        (agent_id, _REPEATS[repeat], _STATUSES[status], _METHODS[method], bool(home), n)
+        for (agent_id, repeat, status, method, home), n in out.items() if n
+    ]
+
+async def agents_directory(session: AsyncSession) -> dict[int, tuple[int, str | None, str | None]]:
+    """Справочник агентов для выгрузок: id -> (tg_user_id, username, name)."""
+    res = await session.execute(select(Agent.id, Agent.tg_user_id, Agent.username, Agent.name))
+    return {r.id: (r.tg_user_id, r.username, r.name) for r in res}
+
+async def export_watermark(session: AsyncSession, *, days: int | None) -> tuple:
+    """
+    Водяной знак данных выгрузки за период: (число карточек, max id, max updated_at).
+    Меняется при добавлении, изменении, удалении карточки и при выходе строк из окна периода.
+    """
+    q = select(func.count(Contact.id), func.max(Contact.id), func.max(Contact.updated_at))
     if days is not None:
         since = datetime.utcnow() - timedelta(days=days)
         q = q.where(Contact.created_at >= since)
-    q = q.order_by(Contact.created_at.desc())
-    res = await session.execute(q)
-    return res.all()
+    count, max_id, max_updated = (await session.execute(q)).one()
+    return count, max_id, max_updated.isoformat() if max_updated else None
+
+async def get_export_mark(session: AsyncSession, tg_user_id: int) -> int:
+    """До какого contact.id администратор уже получил дельта-выгрузку (0 — ещё не выгружал)."""
+    res = await session.execute(select(ExportMark.last_contact_id).where(ExportMark.tg_user_id == tg_user_id))
+    return res.scalar() or 0
+
+async def set_export_mark(session: AsyncSession, tg_user_id: int, last_contact_id: int) -> None:
+    """Сдвинуть водяной знак дельта-выгрузки (только вперёд)."""
+    now = datetime.utcnow()
+    stmt = sqlite_insert(ExportMark).values(tg_user_id=tg_user_id, last_contact_id=last_contact_id, exported_at=now)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[ExportMark.tg_user_id],
+        set_={
+            "last_contact_id": func.max(ExportMark.last_contact_id, stmt.excluded.last_contact_id),
+            "exported_at": now,
+        },
+    ))
 
 # ==========================
 # Номера флаеров
 # ==========================
 
+async def warm_flyer_bitmap(session: AsyncSession) -> int:
+    """Заполнить битовую карту занятых номеров из flyer_claim. Вызывается при старте."""
+    flyer_bitmap.clear()
+    res = await session.execute(
+        select(FlyerClaim.number).where(FlyerClaim.number.between(FLYER_MIN, FLYER_MAX))
+    )
+    count = 0
+    for (n,) in res:
+        flyer_bitmap.add(int(n))
+        count += 1
+    flyer_bitmap.warmed = True
+    return count
+
 async def flyer_exists(session: AsyncSession, num: int | str) -> bool:
     """
     Проверка занятости номера флаера.
-    Сравнивает по числовому значению; мусорные/нечисловые значения в БД игнорируются.
+    Сначала битовая карта (без БД), затем точечный поиск по PK flyer_claim.
     """
     try:
         target = int(str(num).strip())
     except (TypeError, ValueError):
         return False
 
+    if target in flyer_bitmap:
+        return True
     res = await session.execute(
-        select(Contact.flyer_number).where(Contact.flyer_number.is_not(None))
+        select(FlyerClaim.number).where(FlyerClaim.number == target).limit(1)
     )
-    for (val,) in res:
-        s = str(val).strip()
-        if not s.isdigit():
-            continue
-        if int(s) == target:
-            return True
-    return False
+    if res.first() is None:
+        return False
+    flyer_bitmap.add(target)
+    return True
+
+async def claim_flyer_number(session: AsyncSession, num: int, contact_id: int | None) -> bool:
+    """
+    Атомарно занять номер флаера за контактом.
+    Одна вставка по PK: если номер уже занят — вернёт False и ничего не изменит.
+    При успехе проставляет contact.flyer_number в той же транзакции.
+    Бит в flyer_bitmap — при конфликте сразу (строка уже есть), при захвате — после коммита.
+    """
+    if num in flyer_bitmap:
+        return False
+    res = await session.execute(
+        sqlite_insert(FlyerClaim)
+        .values(number=num, contact_id=contact_id, claimed_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=[FlyerClaim.number])
+    )
+    if res.rowcount != 1:
+        flyer_bitmap.add(num)
+        return False
+    if contact_id is not None:
+        await session.execute(
+            update(Contact).where(Contact.id == contact_id).values(flyer_number=str(num))
+        )
+    # последним шагом: упавший выше захват бит не поставит
+    session.info.setdefault("flyers_claimed", []).append(num)
+    return True
+
+async def release_flyer_number(session: AsyncSession, num: int) -> bool:
+    """
+    Освободить номер, занятый под ещё не записанную карточку (contact_id IS NULL):
+    агент ввёл другой номер или карточку записать не удалось. Привязанный номер не трогает.
+    Бит снимается сразу: сброшенный бит ничего не гарантирует, откат оставит строку — решит вставка.
+    """
+    res = await session.execute(
+        delete(FlyerClaim).where(FlyerClaim.number == num, FlyerClaim.contact_id.is_(None))
+    )
+    if res.rowcount != 1:
+        return False
+    claimed = session.info.get("flyers_claimed")
+    if claimed and num in claimed:
+        claimed.remove(num)
+    flyer_bitmap.discard(num)
+    return True
+
+@event.listens_for(Session, "after_commit")
+def _flyers_after_commit(session):
+    for num in session.info.pop("flyers_claimed", ()):
+        flyer_bitmap.add(num)
+
+@event.listens_for(Session, "after_rollback")
+def _flyers_after_rollback(session):
+    session.info.pop("flyers_claimed", None)
 
 async def get_next_flyer_number(session: AsyncSession) -> int:
     """
-    «Следующий» номер (максимум+1), игнорируя нечисловые/вне диапазона значения.
+    «Следующий» номер (максимум+1), игнорируя значения вне диапазона.
     """
     res = await session.execute(
-        select(Contact.flyer_number).where(Contact.flyer_number.is_not(None))
+        select(func.max(FlyerClaim.number)).where(FlyerClaim.number.between(1, 30_000_000))
     )
-    max_num = 0
-    for (val,) in res:
-        s = str(val).strip() if val is not None else ""
-        if not s.isdigit():
-            continue
-        n = int(s)
-        if 1 <= n <= 30_000_000 and n > max_num:
-            max_num = n
+    max_num = res.scalar() or 0
     return max_num + 1 if max_num > 0 else 1
 
 # ==========================
 # Статистика
 # ==========================
 
-async def agent_stats_last24h(session: AsyncSession, agent_id: int) -> dict:
-    """Личная статистика агента за 24 часа."""
-    since = datetime.utcnow() - timedelta(hours=24)
-    q = select(Contact).where(Contact.agent_id == agent_id, Contact.created_at >= since)
-    res = await session.execute(q)
-    rows = res.scalars().all()
+# ключи счётчиков в сводках; порядок совпадает с _stat_columns()
+_STAT_KEYS = ("total", "consent", "refusal", "no_one", "hand", "mailbox", "none", "home_yes")
+
+def _stat_columns():
+    """Условные SUM(CASE …) по контактам — одна строка счётчиков на группу."""
+    def _count_if(cond):
+        return func.coalesce(func.sum(case((cond, 1), else_=0)), 0)
+    return (
+        func.count(Contact.id),
+        _count_if(Contact.talk_status == TalkStatus.CONSENT),
+        _count_if(Contact.talk_status == TalkStatus.REFUSAL),
+        _count_if(Contact.talk_status == TalkStatus.NO_ONE),
+        _count_if(Contact.flyer_method == FlyerMethod.HAND),
+        _count_if(Contact.flyer_method == FlyerMethod.MAILBOX),
+        _count_if(Contact.flyer_method == FlyerMethod.NONE),
+        _count_if(Contact.home_voting.is_(True)),
+    )
 
-    total = len(rows)
-    status = {"CONSENT": 0, "REFUSAL": 0, "NO_ONE": 0}
-    flyer = {"HAND": 0, "MAILBOX": 0, "NONE": 0}
-    home_yes = 0
+# ---- суточный роллап agent_day_stats
+# Закрытые карточки учитываются в строке (agent_id, день created_at). Сводки берут целые дни
+# из роллапа, а из contact читают только неполный первый день периода и ещё не закрытые карточки.
 
-    for c in rows:
-        if c.talk_status:
-            status[c.talk_status.value] = status.get(c.talk_status.value, 0) + 1
-        if c.flyer_method:
-            flyer[c.flyer_method.value] = flyer.get(c.flyer_method.value, 0) + 1
-        if c.home_voting:
-            home_yes += 1
+async def _rollup_add(
+    session: AsyncSession,
+    agent_id: int | None,
+    created_at: datetime,
+    repeat_touch: RepeatTouch | None,
+    talk_status: TalkStatus | None,
+    flyer_method: FlyerMethod | None,
+    home_voting: bool | None,
+) -> None:
+    """Прибавить одну закрытую карточку к agent_day_stats и agent_day_cube."""
+    codes = _cube_codes(repeat_touch, talk_status, flyer_method, home_voting)
+    await _cube_upsert(session, [_cube_row(agent_id, created_at.date(), codes, 1)])
+    if agent_id is None:
+        return
+    await _rollup_upsert(session, [{
+        "agent_id": agent_id, "day": created_at.date(),
+        **_card_counts(talk_status, flyer_method, home_voting),
+    }])
+
+def _card_counts(
+    talk_status: TalkStatus | None, flyer_method: FlyerMethod | None, home_voting: bool | None,
+) -> dict[str, int]:
+    return {
+        "total": 1,
+        "consent": int(talk_status == TalkStatus.CONSENT),
+        "refusal": int(talk_status == TalkStatus.REFUSAL),
+        "no_one": int(talk_status == TalkStatus.NO_ONE),
+        "hand": int(flyer_method == FlyerMethod.HAND),
+        "mailbox": int(flyer_method == FlyerMethod.MAILBOX),
+        "none": int(flyer_method == FlyerMethod.NONE),
+        "home_yes": int(bool(home_voting)),
+    }
 
-    return {"total": total, "status": status, "flyer": flyer, "home_yes": home_yes}
+def _rollup_upsert_stmt():
+    stmt = sqlite_insert(AgentDayStats)
+    return stmt.on_conflict_do_update(
+        index_elements=[AgentDayStats.agent_id, AgentDayStats.day],
+        set_={k: getattr(AgentDayStats, k) + stmt.excluded[k] for k in _STAT_KEYS},
+    )
+
+# собирается один раз: построение ON CONFLICT … SET на каждую карточку стоит ~1 мс
+_ROLLUP_UPSERT = _rollup_upsert_stmt()
+
+async def _rollup_upsert(session: AsyncSession, rows: list[dict]) -> None:
+    """Прибавить счётчики к строкам agent_day_stats: rows — [{agent_id, day, total, …}], один executemany."""
+    await session.execute(_ROLLUP_UPSERT, rows)
 
-async def agents_stats_for_period(session: AsyncSession, days: int | None):
+async def _period_counts(
+    session: AsyncSession, since: datetime | None, *, agent_ids: Iterable[int] | None = None
+) -> dict[int, list[int]]:
     """
-    Сводка по всем агентам за период (или за всё время).
+    Счётчики (в порядке _STAT_KEYS) по агентам с момента since; None — за всё время.
+    agent_ids ограничивает выборку в SQL (None — все агенты).
+    """
+    roll = (
+        select(AgentDayStats.agent_id, *(func.sum(getattr(AgentDayStats, k)) for k in _STAT_KEYS))
+        .group_by(AgentDayStats.agent_id)
+    )
+    # незакрытых карточек в роллапе ещё нет (частичный индекс ix_contact_open)
+    open_q = (
+        select(Contact.agent_id, *_stat_columns())
+        .where(Contact.closed_at.is_(None))
+        .group_by(Contact.agent_id)
+    )
+    edge_q = None
+    if since is not None:
+        edge = datetime.combine(since.date() + timedelta(days=1), time.min)
+        roll = roll.where(AgentDayStats.day >= edge.date())
+        open_q = open_q.where(Contact.created_at >= edge)
+        # неполный первый день — все карточки прямо из contact
+        edge_q = (
+            select(Contact.agent_id, *_stat_columns())
+            .where(Contact.created_at >= since, Contact.created_at < edge)
+            .group_by(Contact.agent_id)
+        )
+    queries = [roll, open_q] + ([edge_q] if edge_q is not None else [])
+    if agent_ids is not None:
+        ids = list(agent_ids)
+        queries = [roll.where(AgentDayStats.agent_id.in_(ids))] + [
+            q.where(Contact.agent_id.in_(ids)) for q in queries[1:]
+        ]
+
+    out: dict[int, list[int]] = {}
+    for q in queries:
+        for aid, *counts in (await session.execute(q)).all():
+            acc = out.setdefault(aid, [0] * len(_STAT_KEYS))
+            for i, v in enumerate(counts):
+                acc[i] += v
+    return out
+
+def _rollup_source():
+    """agent_day_stats, посчитанный заново по закрытым контактам."""
+    day = func.date(Contact.created_at)
+    return (
+        select(Contact.agent_id, day, *_stat_columns())
+        .where(Contact.closed_at.is_not(None), Contact.agent_id.is_not(None))
+        .group_by(Contact.agent_id, day)
+    )
+
+async def rebuild_agent_day_stats(session: AsyncSession) -> int:
+    """Пересобрать agent_day_stats с нуля. Возвращает число строк."""
+    await session.execute(delete(AgentDayStats))
+    res = await session.execute(
+        insert(AgentDayStats).from_select(["agent_id", "day", *_STAT_KEYS], _rollup_source())
+    )
+    return res.rowcount
+
+async def check_agent_day_stats(session: AsyncSession) -> list[dict]:
+    """Сверка agent_day_stats с contact. Возвращает расхождения (пустой список — всё сходится)."""
+    zero = [0] * len(_STAT_KEYS)
+    expected = {
+        (aid, str(day)): list(counts)
+        for aid, day, *counts in (await session.execute(_rollup_source())).all()
+    }
+    res = await session.execute(select(AgentDayStats))
+    actual = {
+        (r.agent_id, r.day.isoformat()): [getattr(r, k) for k in _STAT_KEYS]
+        for r in res.scalars().all()
+    }
+    diffs = []
+    for key in sorted(expected.keys() | actual.keys()):
+        e, a = expected.get(key, zero), actual.get(key, zero)
+        if e != a:
+            diffs.append({
+                "agent_id": key[0],
+                "day": key[1],
+                "expected": dict(zip(_STAT_KEYS, e)),
+                "actual": dict(zip(_STAT_KEYS, a)),
+            })
+    return diffs
+
+# ---- суточный куб agent_day_cube
+# Те же закрытые карточки, что в agent_day_stats, по ячейкам (повторность, статус, флаер, надомка):
+# сводные листы выгрузки (contact_cube) берут целые дни отсюда. Коды — позиция в Enum + 1,
+# 0 — NULL (кодировка колоночного зеркала utils.contact_mirror); agent_id 0 — карточка без агента.
+
+_CUBE_KEYS = ("repeat", "status", "method", "home")
+_REPEATS: list[RepeatTouch | None] = [None, *RepeatTouch]
+_STATUSES: list[TalkStatus | None] = [None, *TalkStatus]
+_METHODS: list[FlyerMethod | None] = [None, *FlyerMethod]
+
+def _enum_code(col, enum_cls):
+    """Код перечисления в SQL: позиция в Enum + 1, NULL — 0."""
+    return case(*[(col == e, i) for i, e in enumerate(enum_cls, 1)], else_=0)
+
+def _contact_cube_codes():
+    """Ячейка куба по колонкам contact (в порядке _CUBE_KEYS)."""
+    return (
+        _enum_code(Contact.repeat_touch, RepeatTouch),
+        _enum_code(Contact.talk_status, TalkStatus),
+        _enum_code(Contact.flyer_method, FlyerMethod),
+        case((Contact.home_voting.is_(True), 1), else_=0),
+    )
+
+def _cube_codes(
+    repeat_touch: RepeatTouch | None,
+    talk_status: TalkStatus | None,
+    flyer_method: FlyerMethod | None,
+    home_voting: bool | None,
+) -> tuple[int, int, int, int]:
+    return (
+        _REPEATS.index(repeat_touch) if repeat_touch else 0,
+        _STATUSES.index(talk_status) if talk_status else 0,
+        _METHODS.index(flyer_method) if flyer_method else 0,
+        int(bool(home_voting)),
+    )
+
+def _cube_row(agent_id: int | None, day: date, codes: tuple[int, ...], n: int) -> dict:
+    return {"agent_id": agent_id or 0, "day": day, **dict(zip(_CUBE_KEYS, codes)), "n": n}
+
+def _cube_upsert_stmt():
+    stmt = sqlite_insert(AgentDayCube)
+    return stmt.on_conflict_do_update(
+        index_elements=[AgentDayCube.agent_id, AgentDayCube.day, *(getattr(AgentDayCube, k) for k in _CUBE_KEYS)],
+        set_={"n": AgentDayCube.n + stmt.excluded.n},
+    )
+
+_CUBE_UPSERT = _cube_upsert_stmt()
+
+async def _cube_upsert(session: AsyncSession, rows: list[dict]) -> None:
+    """Прибавить счётчики к ячейкам agent_day_cube: rows — [{agent_id, day, repeat, …, n}], один executemany."""
+    await session.execute(_CUBE_UPSERT, rows)
+
+def _cube_source():
+    """agent_day_cube, посчитанный заново по закрытым контактам."""
+    keys = (func.coalesce(Contact.agent_id, 0), func.date(Contact.created_at), *_contact_cube_codes())
+    return select(*keys, func.count()).where(Contact.closed_at.is_not(None)).group_by(*keys)
+
+def _cube_label(codes: Sequence[int]) -> str:
+    repeat, status, method, home = codes
+    names = (_REPEATS[repeat], _STATUSES[status], _METHODS[method])
+    return "/".join(e.value if e else "-" for e in names) + ("/home" if home else "")
+
+async def rebuild_agent_day_cube(session: AsyncSession) -> int:
+    """Пересобрать agent_day_cube с нуля. Возвращает число строк."""
+    await session.execute(delete(AgentDayCube))
+    res = await session.execute(
+        insert(AgentDayCube).from_select(["agent_id", "day", *_CUBE_KEYS, "n"], _cube_source())
+    )
+    return res.rowcount
+
+async def check_agent_day_cube(session: AsyncSession) -> list[dict]:
+    """
+    Сверка agent_day_cube с contact — в формате check_agent_day_stats, счётчики дня агента
+    по ячейкам куба ("PRIMARY/CONSENT/HAND/home": n). Пустой список — всё сходится.
+    """
+    expected: dict[tuple, dict[str, int]] = {}
+    for aid, day, *codes, n in (await session.execute(_cube_source())).all():
+        expected.setdefault((aid, str(day)), {})[_cube_label(codes)] = n
+    actual: dict[tuple, dict[str, int]] = {}
+    for r in (await session.execute(select(AgentDayCube))).scalars().all():
+        if r.n:
+            actual.setdefault((r.agent_id, r.day.isoformat()), {})[
+                _cube_label([getattr(r, k) for k in _CUBE_KEYS])
+            ] = r.n
+    return [
+        {"agent_id": key[0], "day": key[1], "expected": expected.get(key, {}), "actual": actual.get(key, {})}
+        for key in sorted(expected.keys() | actual.keys())
+        if expected.get(key, {}) != actual.get(key, {})
+    ]
+
+async def agent_stats_last24h(session: AsyncSession, agent_id: int) -> dict:
+    """Личная статистика агента за 24 часа."""
+    since = datetime.utcnow() - timedelta(hours=24)
+    counts = (await _period_counts(session, since, agent_ids=[agent_id])).get(agent_id, [0] * len(_STAT_KEYS))
+    total, consent, refusal, no_one, hand, mailbox, none, home_yes = counts
+    return {
+        "total": total,
+        "status": {"CONSENT": consent, "REFUSAL": refusal, "NO_ONE": no_one},
+        "flyer": {"HAND": hand, "MAILBOX": mailbox, "NONE": none},
+        "home_yes": home_yes,
+    }
+
+async def agents_stats_for_period(
+    session: AsyncSession, days: int | None, *, agent_ids: Iterable[int] | None = None
+):
+    """
+    Сводка по агентам за период (или за всё время).
+    agent_ids — только эти агенты (фильтр уходит в SQL), None — все.
     Возвращает список словарей, отсортированный по убыванию total.
+    Счётчики — из agent_day_stats и краевого GROUP BY по contact (_period_counts),
+    в Python — только склейка с агентами.
     """
+    if agent_ids is not None:
+        agent_ids = list(agent_ids)
+        if not agent_ids:
+            return []
+
     # карта агентов
-    res = await session.execute(select(Agent))
-    agents = res.scalars().all()
+    q = select(Agent.id, Agent.tg_user_id, Agent.username, Agent.name).order_by(Agent.id)
+    if agent_ids is not None:
+        q = q.where(Agent.id.in_(agent_ids))
+    res = await session.execute(q)
     stats = {
-        a.id: {
-            "agent_id": a.id,
-            "agent_tg": a.tg_user_id,
-            "agent_username": (f"@{a.username}" if getattr(a, "username", None) else ""),
-            "agent_name": a.name or "",
-            "total": 0,
-            "consent": 0,
-            "refusal": 0,
-            "no_one": 0,
-            "hand": 0,
-            "mailbox": 0,
-            "none": 0,
-            "home_yes": 0,
+        aid: {
+            "agent_id": aid,
+            "agent_tg": tg,
+            "agent_username": (f"@{username}" if username else ""),
+            "agent_name": name or "",
+            **dict.fromkeys(_STAT_KEYS, 0),
         }
-        for a in agents
+        for aid, tg, username, name in res.all()
     }
 
     # контакты
-    q = select(Contact)
-    if days is not None:
-        since = datetime.utcnow() - timedelta(days=days)
-        q = q.where(Contact.created_at >= since)
-    res = await session.execute(q)
-    rows = res.scalars().all()
-
-    for c in rows:
-        aid = c.agent_id
-        if aid not in stats:
-            stats[aid] = {
+    since = datetime.utcnow() - timedelta(days=days) if days is not None else None
+    for aid, counts in (await _period_counts(session, since, agent_ids=agent_ids)).items():
+        s = stats.get(aid)
+        if s is None:
+            # контакты агента, которого уже нет в таблице agent
+            s = stats[aid] = {
                 "agent_id": aid,
                 "agent_tg": None,
                 "agent_username": "",
                 "agent_name": "",
-                "total": 0,
-                "consent": 0,
-                "refusal": 0,
-                "no_one": 0,
-                "hand": 0,
-                "mailbox": 0,
-                "none": 0,
-                "home_yes": 0,
             }
-        s = stats[aid]
-        s["total"] += 1
-
-        if c.talk_status:
-            v = c.talk_status.value
-            if v == "CONSENT":
-                s["consent"] += 1
-            elif v == "REFUSAL":
-                s["refusal"] += 1
-            elif v == "NO_ONE":
-                s["no_one"] += 1
-
-        if c.flyer_method:
-            v = c.flyer_method.value
-            if v == "HAND":
-                s["hand"] += 1
-            elif v == "MAILBOX":
-                s["mailbox"] += 1
-            elif v == "NONE":
-                s["none"] += 1
-
-        if c.home_voting:
-            s["home_yes"] += 1
+        s.update(zip(_STAT_KEYS, counts))
 
     return sorted(stats.values(), key=lambda x: x["total"], reverse=True)
 
 # ==========================
 # БРИГАДИРЫ (доступы/привязки)
-# Таблицы (SQLite/Postgres совместимо):
+# Таблицы (создаются миграцией, bot/migrations.py):
 #  - brigadiers(brig_tg_id PK)
 #  - brig_sessions(brig_tg_id PK, logged_in INT)
 #  - brig_members(brig_tg_id, member_tg_id, PK (brig_tg_id, member_tg_id))
 # ==========================
 
-async def _table_info(session: AsyncSession, table: str) -> list[dict]:
-    res = await session.execute(text(f"PRAGMA table_info({table})"))
-    rows = res.all()
-    # rows: (cid, name, type, notnull, dflt_value, pk)
-    return [{"cid": r[0], "name": r[1], "type": r[2], "notnull": r[3], "dflt": r[4], "pk": r[5]} for r in rows]
-
-async def ensure_brig_tables(session: AsyncSession) -> None:
-    # ---- brigadiers: ensure schema ----
-    info = await _table_info(session, "brigadiers")
-    need_migrate = False
-    if not info:
-        # table doesn't exist — create
-        await session.execute(text("""
-            CREATE TABLE brigadiers (
-                brig_tg_id BIGINT PRIMARY KEY
-            )
-        """))
-    else:
-        cols = {c["name"] for c in info}
-        if "brig_tg_id" not in cols or len(cols) != 1:
-            need_migrate = True
-
-    if need_migrate:
-        # Try to migrate data from any plausible column (brig_tg_id/brig_id/tg_id/id)
-        src_cols = [c["name"] for c in info]
-        candidate = None
-        for name in ("brig_tg_id", "brig_id", "tg_id", "id"):
-            if name in src_cols:
-                candidate = name
-                break
-
-        await session.execute(text("ALTER TABLE brigadiers RENAME TO brigadiers_old"))
-        await session.execute(text("CREATE TABLE brigadiers (brig_tg_id BIGINT PRIMARY KEY)"))
-        if candidate:
-            await session.execute(text(f"""
-                INSERT OR IGNORE INTO brigadiers (brig_tg_id)
-                SELECT {candidate} FROM brigadiers_old
-                WHERE {candidate} IS NOT NULL
-            """))
-        await session.execute(text("DROP TABLE brigadiers_old"))
-
-    # ---- brig_sessions ----
-    info = await _table_info(session, "brig_sessions")
-    migrate = False
-    if not info:
-        await session.execute(text("""
-            CREATE TABLE brig_sessions (
-                brig_tg_id BIGINT PRIMARY KEY,
-                logged_in INTEGER NOT NULL DEFAULT 0
-            )
-        """))
-    else:
-        cols = {c["name"] for c in info}
-        if not {"brig_tg_id", "logged_in"}.issubset(cols) or len(cols) != 2:
-            migrate = True
-    if migrate:
-        await session.execute(text("ALTER TABLE brig_sessions RENAME TO brig_sessions_old"))
-        await session.execute(text("""
-            CREATE TABLE brig_sessions (
-                brig_tg_id BIGINT PRIMARY KEY,
-                logged_in INTEGER NOT NULL DEFAULT 0
-            )
-        """))
-        # попытка миграции
-        old_cols = {c["name"] for c in info}
-        if "brig_tg_id" in old_cols and "logged_in" in old_cols:
-            await session.execute(text("""
-                INSERT OR IGNORE INTO brig_sessions (brig_tg_id, logged_in)
-                SELECT brig_tg_id, logged_in FROM brig_sessions_old
-            """))
-        await session.execute(text("DROP TABLE brig_sessions_old"))
-
-    # ---- brig_members ----
-    info = await _table_info(session, "brig_members")
-    migrate = False
-    if not info:
-        await session.execute(text("""
-            CREATE TABLE brig_members (
-                brig_tg_id   BIGINT NOT NULL,
-                member_tg_id BIGINT NOT NULL,
-                PRIMARY KEY (brig_tg_id, member_tg_id)
-            )
-        """))
-    else:
-        cols = {c["name"] for c in info}
-        if not {"brig_tg_id", "member_tg_id"}.issubset(cols) or len(cols) != 2:
-            migrate = True
-    if migrate:
-        await session.execute(text("ALTER TABLE brig_members RENAME TO brig_members_old"))
-        await session.execute(text("""
-            CREATE TABLE brig_members (
-                brig_tg_id   BIGINT NOT NULL,
-                member_tg_id BIGINT NOT NULL,
-                PRIMARY KEY (brig_tg_id, member_tg_id)
-            )
-        """))
-        old_cols = {c["name"] for c in info}
-        if {"brig_tg_id", "member_tg_id"}.issubset(old_cols):
-            await session.execute(text("""
-                INSERT OR IGNORE INTO brig_members (brig_tg_id, member_tg_id)
-                SELECT brig_tg_id, member_tg_id FROM brig_members_old
-            """))
-        await session.execute(text("DROP TABLE brig_members_old"))
-
-    # ---- blocked members ----
-    try:
-        info = await _table_info(session, "blocked_members")
-    except Exception:
-        info = []
-    if not info:
-        await session.execute(text(
-            """
-            CREATE TABLE blocked_members (
-                member_tg_id BIGINT PRIMARY KEY,
-                blocked_by   BIGINT
-            )
-            """
-        ))
-
 # ---- назначение/проверка бригадиров
 
 async def add_brigadier(session: AsyncSession, brig_tg_id: int) -> None:
-    await ensure_brig_tables(session)
     await session.execute(
         text("INSERT OR IGNORE INTO brigadiers (brig_tg_id) VALUES (:b)"),
         {"b": brig_tg_id},
     )
 
 async def is_brigadier_allowed(session: AsyncSession, tg_user_id: int) -> bool:
-    await ensure_brig_tables(session)
     res = await session.execute(
         text("SELECT 1 FROM brigadiers WHERE brig_tg_id=:b LIMIT 1"),
         {"b": tg_user_id},
@@ -437,7 +904,6 @@ async def is_brigadier_allowed(session: AsyncSession, tg_user_id: int) -> bool:
 # ---- вход/выход бригадира
 
 async def set_brig_login(session: AsyncSession, brig_tg_id: int, logged: bool) -> None:
-    await ensure_brig_tables(session)
     await session.execute(
         text("""
             INSERT INTO brig_sessions (brig_tg_id, logged_in)
@@ -446,9 +912,9 @@ async def set_brig_login(session: AsyncSession, brig_tg_id: int, logged: bool) -
         """),
         {"b": brig_tg_id, "f": 1 if logged else 0},
     )
+    invalidate_access(session, brig_tg_id)
 
 async def is_brig_logged_in(session: AsyncSession, brig_tg_id: int) -> bool:
-    await ensure_brig_tables(session)
     res = await session.execute(
         text("SELECT logged_in FROM brig_sessions WHERE brig_tg_id=:b"),
         {"b": brig_tg_id},
@@ -460,7 +926,6 @@ async def is_brig_logged_in(session: AsyncSession, brig_tg_id: int) -> bool:
 
 async def set_brig_member(session: AsyncSession, brig_tg_id: int, member_tg_id: int) -> None:
     """Привязать участника (по его Telegram ID) к бригадиру (по его Telegram ID)."""
-    await ensure_brig_tables(session)
     # убедимся, что бригадир существует
     await add_brigadier(session, brig_tg_id)
     # idempotent insert
@@ -473,7 +938,6 @@ async def set_brig_member(session: AsyncSession, brig_tg_id: int, member_tg_id:
     )
 
 async def remove_brig_member(session: AsyncSession, brig_tg_id: int, member_tg_id: int) -> None:
-    await ensure_brig_tables(session)
     await session.execute(
         text("DELETE FROM brig_members WHERE brig_tg_id=:b AND member_tg_id=:m"),
         {"b": brig_tg_id, "m": member_tg_id},
@@ -481,7 +945,6 @@ async def remove_brig_member(session: AsyncSession, brig_tg_id: int, member_tg_i
 
 async def list_brigadiers(session: AsyncSession) -> List[Dict]:
     """[{brig_tg_id: int, username: str|None, name: str|None, members: [tg_id, ...]}, ...]"""
-    await ensure_brig_tables(session)
 
     rows_b = (await session.execute(
         text("SELECT brig_tg_id FROM brigadiers ORDER BY brig_tg_id")
@@ -515,7 +978,6 @@ async def list_brigadier_member_agent_ids(session: AsyncSession, brig_tg_id: int
     Для бригадира (tg id) вернуть список внутренних Agent.id
     по привязанным member_tg_id (если такие агенты существуют).
     """
-    await ensure_brig_tables(session)
     rows = (await session.execute(
         text("SELECT member_tg_id FROM brig_members WHERE brig_tg_id=:b"),
         {"b": brig_tg_id},
@@ -528,6 +990,11 @@ async def list_brigadier_member_agent_ids(session: AsyncSession, brig_tg_id: int
     res = await session.execute(select(Agent.id).where(Agent.tg_user_id.in_(member_tg_ids)))
     return [int(x[0]) for x in res.all()]
 
+async def brigade_stats_for_period(session: AsyncSession, brig_tg_id: int, days: int | None):
+    """Сводка agents_stats_for_period только по участникам бригады (стоимость — по размеру бригады)."""
+    agent_ids = await list_brigadier_member_agent_ids(session, brig_tg_id)
+    return await agents_stats_for_period(session, days, agent_ids=agent_ids)
+
 # --- Алиасы для совместимости со старыми импортами ---
 
 async def link_agent_to_brigadier(session: AsyncSession, brig_tg_id: int, member_agent_id: int) -> None:
@@ -611,21 +1078,38 @@ async def resolve_username_to_tg(session: AsyncSession, username: str) -> int |
 # ==========================
 
 async def block_member(session: AsyncSession, *, member_tg_id: int, blocked_by: int) -> None:
-    await ensure_brig_tables(session)
     await session.execute(
         text("INSERT OR REPLACE INTO blocked_members (member_tg_id, blocked_by) VALUES (:m, :b)"),
         {"m": member_tg_id, "b": blocked_by},
     )
+    invalidate_access(session, member_tg_id)
 
 async def unblock_member(session: AsyncSession, *, member_tg_id: int) -> None:
-    await ensure_brig_tables(session)
     await session.execute(text("DELETE FROM blocked_members WHERE member_tg_id=:m"), {"m": member_tg_id})
+    invalidate_access(session, member_tg_id)
 
 async def is_member_blocked(session: AsyncSession, tg_user_id: int) -> bool:
-    await ensure_brig_tables(session)
     res = await session.execute(text("SELECT 1 FROM blocked_members WHERE member_tg_id=:m LIMIT 1"), {"m": tg_user_id})
     return res.first() is not None
 
+async def get_access_flags(session: AsyncSession, tg_user_id: int) -> tuple[int | None, bool, bool, bool]:
+    """
+    Все флаги доступа одним запросом: (agent_id, is_admin, is_brig_logged, is_blocked).
+    Используется AccessMiddleware при промахе кеша.
+    """
+    res = await session.execute(
+        text("""
+            SELECT
+                (SELECT id FROM agent WHERE tg_user_id = :tg),
+                (SELECT admin_logged_in FROM agent WHERE tg_user_id = :tg),
+                EXISTS(SELECT 1 FROM brig_sessions WHERE brig_tg_id = :tg AND logged_in = 1),
+                EXISTS(SELECT 1 FROM blocked_members WHERE member_tg_id = :tg)
+        """),
+        {"tg": tg_user_id},
+    )
+    agent_id, is_admin, is_brig, is_blocked = res.one()
+    return agent_id, bool(is_admin), bool(is_brig), bool(is_blocked)
+
 async def block_member_by_username(session: AsyncSession, member_username: str, *, blocked_by: int) -> int:
     agent = await get_agent_by_username(session, member_username)
     if not agent:
@@ -659,3 +1143,4 @@ async def demote_brigadier(session, tg_user_id: int) -> None:
     except Exception:
         # если таблицы нет — тихо игнорируем
         pass
+    invalidate_access(session, tg_user_id)
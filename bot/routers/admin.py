@@ -2,24 +2,29 @@ from __future__ import annotations
 
 import logging
 import html
-from datetime import datetime
-from pathlib import Path
-import tempfile
+from datetime import datetime, timedelta
+from functools import partial
 
 from aiogram import Router, F
-from aiogram.types import Message, FSInputFile, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..config import settings
 from ..db import async_session
+from ..exports import export_jobs, ExportJob, ExportResult
+from ..access import AccessContext, invalidate_access
 from ..repo import (
     # базовое
-    list_contacts_for_period,
+    export_watermark,
+    get_export_mark,
+    set_export_mark,
+    contact_cube,
+    agents_directory,
     get_or_create_agent,
     agents_stats_for_period,
     # бригадиры
-    ensure_brig_tables,
     add_brigadier,
     set_brig_member,
     get_agent_by_username,   # ← добавили
@@ -27,7 +32,9 @@ from ..repo import (
     list_brigadiers,
     resolve_username_to_tg,
 )
-from ..utils.excel import rows_to_dataframe, write_excel_with_pivot, write_admin_summary
+from ..utils.excel import render_export, render_delta_export, write_admin_summary, write_pivot_sheets
+from ..utils.export_pool import export_pool
+from ..utils.contact_mirror import contact_mirror
 from ..keyboards import (
     # меню/доступ
     BTN_ADMIN, BTN_ADMIN_LOGIN, BTN_ADMIN_LOGOUT, BTN_ADMIN_HELP, 
@@ -36,7 +43,7 @@ from ..keyboards import (
 
     # экспорт
     BTN_ADMIN_EXPORT_XLSX, BTN_ADMIN_EXPORT_CSV,
-    BTN_XLSX_ALL, BTN_CSV_ALL,
+    BTN_XLSX_ALL, BTN_XLSX_PIVOTS, BTN_CSV_ALL, BTN_XLSX_DELTA, BTN_XLSX_MERGE, BTN_CSV_DELTA,
     kb_admin_export_xlsx, kb_admin_export_csv,
 
     # периоды
@@ -54,6 +61,9 @@ from ..models import Agent              # ← чтобы select(Agent) рабо
 logger = logging.getLogger(__name__)
 router = Router(name="admin")
 
+# Bot API отдаёт боту на скачивание файлы не больше 20 МБ
+_BOOK_MAX_BYTES = 20 * 1024 * 1024
+
 
 # ----- STATES -----
 class AdminStats(StatesGroup):
@@ -62,13 +72,6 @@ class AdminStats(StatesGroup):
 class AdminDemoteBrig(StatesGroup):
     waiting_username_or_id = State()
 
-# ----- HELPERS -----
-async def _is_admin_logged(user_id: int) -> bool:
-    async with async_session() as session:
-        agent = await get_or_create_agent(session, user_id)
-        await session.commit()
-        return bool(getattr(agent, "admin_logged_in", False))
-
 @router.message(F.text == BTN_ACCESS_DEMOTE)
 async def admin_access_demote_brig_start(m: Message, state: FSMContext):
     await state.set_state(AdminDemoteBrig.waiting_username_or_id)
@@ -79,8 +82,8 @@ async def admin_access_demote_brig_start(m: Message, state: FSMContext):
 
 # ===== AUTH / MENU =====
 @router.message(F.text == BTN_ADMIN_LOGIN)
-async def admin_login_start(m: Message, state: FSMContext):
-    if await _is_admin_logged(m.from_user.id):
+async def admin_login_start(m: Message, state: FSMContext, access: AccessContext):
+    if access.is_admin:
         await m.answer("Вы уже вошли как админ.", reply_markup=kb_admin_menu())
         return
     await m.answer("🔐 Введите логин администратора:", reply_markup=kb_main(is_admin=False))
@@ -95,16 +98,16 @@ async def admin_login_get_login(m: Message, state: FSMContext):
 
 
 @router.message(AdminAuth.waiting_password)
-async def admin_login_get_pass(m: Message, state: FSMContext):
+async def admin_login_get_pass(m: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     login = data.get("admin_login", "")
     password = (m.text or "").strip()
 
     if login == settings.ADMIN_LOGIN and password == settings.ADMIN_PASSWORD:
-        async with async_session() as session:
-            agent = await get_or_create_agent(session, m.from_user.id)
-            agent.admin_logged_in = True
-            await session.commit()
+        agent = await get_or_create_agent(session, m.from_user.id)
+        agent.admin_logged_in = True
+        invalidate_access(session, m.from_user.id)
+        await session.commit()
         await state.clear()
         await m.answer("✅ Админ-вход выполнен.", reply_markup=kb_admin_menu())
     else:
@@ -113,47 +116,49 @@ async def admin_login_get_pass(m: Message, state: FSMContext):
 
 
 @router.message(F.text == BTN_ADMIN_LOGOUT)
-async def admin_logout(m: Message, state: FSMContext):
-    async with async_session() as session:
-        agent = await get_or_create_agent(session, m.from_user.id)
-        agent.admin_logged_in = False
-        await session.commit()
+async def admin_logout(m: Message, state: FSMContext, session: AsyncSession):
+    agent = await get_or_create_agent(session, m.from_user.id)
+    agent.admin_logged_in = False
+    invalidate_access(session, m.from_user.id)
+    await session.commit()
     await state.clear()
     await m.answer("Вы вышли из админ-режима.", reply_markup=kb_main(is_admin=False))
 
 
 @router.message(F.text == BTN_ADMIN)
-async def admin_menu_cmd(m: Message):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_menu_cmd(m: Message, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await m.answer("🛠 Админ-меню", reply_markup=kb_admin_menu())
 
 
 @router.message(F.text == BTN_ADMIN_HELP)
-async def admin_help(m: Message):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_help(m: Message, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await m.answer(
         "Экспорт: XLSX и CSV (с выбором периода). "
-        "В XLSX: листы data, summary, pivot_multi, pivot_flat. "
+        "В XLSX: листы data, summary, pivot_multi, pivot_flat; «только сводные» — без листа data, быстро на любом объёме. "
+        "«Новое с прошлой выгрузки» — только карточки, появившиеся после вашей прошлой такой выгрузки; "
+        "«дописать в прошлую книгу» — пришлите её XLSX, новые строки добавятся в неё. "
         "Также доступна текстовая и XLSX-сводка по всем агентам."
     )
 
 
 # ===== EXPORT XLSX / CSV =====
 @router.message(F.text == BTN_ADMIN_EXPORT_XLSX)
-async def admin_export_xlsx_menu(m: Message):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_export_xlsx_menu(m: Message, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await m.answer("📦 Экспорт XLSX — выберите:", reply_markup=kb_admin_export_xlsx())
 
 
 @router.message(F.text == BTN_XLSX_ALL)
-async def admin_export_xlsx_choose_range(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_export_xlsx_choose_range(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await state.update_data(fmt="xlsx")
@@ -161,17 +166,27 @@ async def admin_export_xlsx_choose_range(m: Message, state: FSMContext):
     await m.answer("Выберите период:", reply_markup=kb_export_ranges())
 
 
+@router.message(F.text == BTN_XLSX_PIVOTS)
+async def admin_export_pivots_choose_range(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
+        await m.answer("Доступ запрещён.")
+        return
+    await state.update_data(fmt="pivots")
+    await state.set_state(AdminExport.waiting_range)
+    await m.answer("Выберите период:", reply_markup=kb_export_ranges())
+
+
 @router.message(F.text == BTN_ADMIN_EXPORT_CSV)
-async def admin_export_csv_menu(m: Message):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_export_csv_menu(m: Message, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await m.answer("📦 Экспорт CSV — выберите:", reply_markup=kb_admin_export_csv())
 
 
 @router.message(F.text == BTN_CSV_ALL)
-async def admin_export_csv_choose_range(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_export_csv_choose_range(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await state.update_data(fmt="csv")
@@ -180,8 +195,8 @@ async def admin_export_csv_choose_range(m: Message, state: FSMContext):
 
 
 @router.message(AdminExport.waiting_range, F.text.in_([BTN_EXP_TODAY, BTN_EXP_7, BTN_EXP_30, BTN_EXP_ALL, BTN_BACK]))
-async def admin_export_do(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_export_do(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
 
@@ -201,55 +216,172 @@ async def admin_export_do(m: Message, state: FSMContext):
         days, label = 30, "за 30 дней"
 
     fmt = (await state.get_data()).get("fmt", "xlsx")
+    if fmt == "pivots":
+        title = f"Сводные XLSX {label}"
+        build = partial(_build_pivots_export, days=days, label=label)
+    else:
+        title = f"{fmt.upper()} {label}"
+        build = partial(_build_contacts_export, days=days, fmt=fmt, label=label)
+
+    await export_jobs.submit(
+        m, ("all", days, fmt), title, build,
+        watermark=await export_watermark(session, days=days),
+    )
+    await state.clear()
+    await m.answer("🛠 Админ-меню", reply_markup=kb_admin_menu())
+
+
+async def _build_contacts_export(job: ExportJob, *, days: int | None, fmt: str, label: str) -> ExportResult:
+    """Задание очереди выгрузок: все карточки за период -> CSV/XLSX (рендер в export_pool по зеркалу contact)."""
+    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    base = job.workdir / f"export_{days or 'all'}_{fmt}_{ts}"
+    csv_path = base.with_suffix(".csv")
+    xlsx_path = base.with_suffix(".xlsx")
+    # здесь только дозаливка зеркала (новые/изменённые карточки); файлы собирает процесс export_pool
+    await job.progress("обновляю данные…", force=True)
+    async with async_session() as session:
+        meta = await contact_mirror.sync(session)
+    since = datetime.utcnow() - timedelta(days=days) if days is not None else None
+
+    await job.progress(f"собираю {fmt.upper()}…", force=True)
+    total, xlsx_error, xlsx_tb = await export_pool.run(
+        render_export, str(contact_mirror.root), meta, since,
+        str(csv_path), str(xlsx_path) if fmt == "xlsx" else None,
+    )
+    if total == 0:
+        return ExportResult("Записей за выбранный период нет.")
+    if fmt == "csv":
+        return ExportResult(f"CSV ({label}) — UTF-8 BOM. Строк: {total}.", path=csv_path)
+    if xlsx_error is None:
+        return ExportResult(f"XLSX ({label}). Строк: {total}.", path=xlsx_path)
+    logger.error("XLSX export failed:\n%s", xlsx_tb)
+    return ExportResult(
+        "XLSX не собрался. Отправляю CSV. Ошибка: " + html.escape(xlsx_error),
+        path=csv_path, cacheable=False,
+    )
+
+
+async def _build_pivots_export(job: ExportJob, *, days: int | None, label: str) -> ExportResult:
+    """Задание очереди выгрузок: только summary/pivot-листы по GROUP BY (строки contact не читаются)."""
+    async with async_session() as session:
+        cube = await contact_cube(session, days=days)
+        agents = await agents_directory(session)
+    if not cube:
+        return ExportResult("Записей за выбранный период нет.")
+    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    xlsx_path = job.workdir / f"export_{days or 'all'}_pivots_{ts}.xlsx"
+    await export_pool.run(write_pivot_sheets, cube, agents, str(xlsx_path))
+    total = sum(row[-1] for row in cube)
+    return ExportResult(f"Сводные XLSX ({label}). Карточек: {total}.", path=xlsx_path)
+
+
+# ===== EXPORT: NEW SINCE LAST EXPORT =====
+@router.message(F.text.in_([BTN_XLSX_DELTA, BTN_CSV_DELTA]))
+async def admin_export_delta(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
+        await m.answer("Доступ запрещён.")
+        return
+    fmt = "xlsx" if m.text == BTN_XLSX_DELTA else "csv"
+    await export_jobs.submit(
+        m, (f"admin:{m.from_user.id}", None, f"{fmt}_delta"), f"{fmt.upper()} — новое с прошлой выгрузки",
+        partial(_build_delta_export, tg_user_id=m.from_user.id, fmt=fmt),
+    )
+    await state.clear()
+    await m.answer("🛠 Админ-меню", reply_markup=kb_admin_menu())
+
+
+@router.message(F.text == BTN_XLSX_MERGE)
+async def admin_export_merge_start(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
+        await m.answer("Доступ запрещён.")
+        return
+    await state.set_state(AdminExport.waiting_base_book)
+    await m.answer(
+        "Пришлите XLSX прошлой выгрузки «новое с прошлой выгрузки» (до 20 МБ) — допишу в неё новые карточки.",
+        reply_markup=kb_cancel(),
+    )
+
+
+@router.message(AdminExport.waiting_base_book, F.document)
+async def admin_export_merge_do(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
+        await m.answer("Доступ запрещён.")
+        return
+    doc = m.document
+    if not (doc.file_name or "").lower().endswith(".xlsx"):
+        await m.answer("Нужен файл .xlsx из выгрузки «новое с прошлой выгрузки».")
+        return
+    await state.clear()
+    if doc.file_size and doc.file_size > _BOOK_MAX_BYTES:
+        await m.answer("Файл больше 20 МБ — бот не может его скачать. Выгрузите данные заново целиком.",
+                       reply_markup=kb_admin_menu())
+        return
+    # в ключе — присланный файл: другая книга того же админа не сольётся с уже идущим дописыванием
+    await export_jobs.submit(
+        m, (f"admin:{m.from_user.id}", None, f"xlsx_merge:{doc.file_unique_id}"), "XLSX — дописать в прошлую книгу",
+        partial(_build_delta_export, tg_user_id=m.from_user.id, fmt="xlsx", base_file_id=doc.file_id),
+    )
+    await m.answer("🛠 Админ-меню", reply_markup=kb_admin_menu())
 
-    try:
+
+@router.message(AdminExport.waiting_base_book)
+async def admin_export_merge_wrong(m: Message):
+    await m.answer("Пришлите файл XLSX или нажмите «Отмена».")
+
+
+async def _build_delta_export(
+    job: ExportJob, *, tg_user_id: int, fmt: str, base_file_id: str | None = None,
+) -> ExportResult:
+    """
+    Задание очереди выгрузок: карточки после водяного знака администратора -> CSV/XLSX
+    (с base_file_id — дописать их в присланную книгу). Знак сдвигается, когда файл отправлен.
+    """
+    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    base = job.workdir / f"export_new_{fmt}_{ts}"
+    csv_path = base.with_suffix(".csv")
+    xlsx_path = base.with_suffix(".xlsx")
+    book_path = None
+    if base_file_id is not None:
+        await job.progress("скачиваю книгу…", force=True)
+        book_path = job.workdir / "base.xlsx"
+        await job.waiters[0].bot.download(base_file_id, destination=book_path)
+
+    await job.progress("обновляю данные…", force=True)
+    async with async_session() as session:
+        meta = await contact_mirror.sync(session)
+        after_id = await get_export_mark(session, tg_user_id)
+
+    await job.progress(f"собираю {fmt.upper()}…", force=True)
+    new, total, upto, xlsx_error, xlsx_tb = await export_pool.run(
+        render_delta_export, str(contact_mirror.root), meta, after_id,
+        str(csv_path), str(xlsx_path) if fmt == "xlsx" else None,
+        str(book_path) if book_path is not None else None,
+    )
+    if new == 0:
+        return ExportResult("Новых карточек с прошлой выгрузки нет.")
+
+    async def advance_mark() -> None:
         async with async_session() as session:
-            rows = await list_contacts_for_period(session, days=days)
-        df = rows_to_dataframe(rows)
-        total = len(df.index)
-        if total == 0:
-            await state.clear()
-            await m.answer("Записей за выбранный период нет.", reply_markup=kb_admin_menu())
-            return
+            await set_export_mark(session, tg_user_id, upto)
+            await session.commit()
 
-        ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        base = Path(tempfile.gettempdir()) / f"export_{ts}"
-
-        if fmt == "xlsx":
-            xlsx_path = base.with_suffix(".xlsx")
-            try:
-                write_excel_with_pivot(df, str(xlsx_path))
-                await m.answer_document(
-                    FSInputFile(str(xlsx_path)),
-                    caption=f"XLSX ({label}). Строк: {total}."
-                )
-            except Exception as e:
-                logger.exception("XLSX export failed")
-                csv_path = base.with_suffix(".csv")
-                df.to_csv(str(csv_path), index=False, encoding="utf-8-sig")
-                await m.answer_document(
-                    FSInputFile(str(csv_path)),
-                    caption="XLSX не собрался. Отправляю CSV. Ошибка: " + html.escape(str(e))
-                )
-        else:
-            csv_path = base.with_suffix(".csv")
-            df.to_csv(str(csv_path), index=False, encoding="utf-8-sig")
-            await m.answer_document(
-                FSInputFile(str(csv_path)),
-                caption=f"CSV ({label}) — UTF-8 BOM. Строк: {total}."
-            )
-    except Exception as e:
-        logger.exception("Export handler failed")
-        await m.answer("Не удалось сформировать экспорт: " + html.escape(str(e)))
-    finally:
-        await state.clear()
-        await m.answer("🛠 Админ-меню", reply_markup=kb_admin_menu())
+    if book_path is not None:
+        text = f"XLSX — дописано новых строк: {new}, всего в книге: {total}."
+    else:
+        text = f"{fmt.upper()} — новое с прошлой выгрузки. Строк: {new}."
+    if fmt == "csv" or xlsx_error is None:
+        return ExportResult(text, path=csv_path if fmt == "csv" else xlsx_path, on_sent=advance_mark)
+    logger.error("XLSX export failed:\n%s", xlsx_tb)
+    return ExportResult(
+        "XLSX не собрался. Отправляю CSV. Ошибка: " + html.escape(xlsx_error),
+        path=csv_path, on_sent=advance_mark,
+    )
 
 
 # ===== STATS: ALL AGENTS =====
 @router.message(F.text == BTN_ADMIN_STATS_ALL)
-async def admin_stats_all_start(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_stats_all_start(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await m.answer("За какой период показать сводку по всем агентам?", reply_markup=kb_export_ranges())
@@ -257,8 +389,8 @@ async def admin_stats_all_start(m: Message, state: FSMContext):
 
 
 @router.message(AdminStats.waiting_range, F.text.in_([BTN_EXP_TODAY, BTN_EXP_7, BTN_EXP_30, BTN_EXP_ALL, BTN_BACK]))
-async def admin_stats_all_run(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_stats_all_run(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
 
@@ -275,9 +407,7 @@ async def admin_stats_all_run(m: Message, state: FSMContext):
     elif m.text == BTN_EXP_30:
         days = 30
 
-    async with async_session() as local_session:
-        stats = await agents_stats_for_period(local_session, days)
-        await local_session.commit()
+    stats = await agents_stats_for_period(session, days)
 
     if not stats or all(s.get("total", 0) == 0 for s in stats):
         await state.clear()
@@ -296,24 +426,30 @@ async def admin_stats_all_run(m: Message, state: FSMContext):
         )
     await m.answer("\n\n".join(lines))
 
-    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    xlsx_path = Path(tempfile.gettempdir()) / f"admin_stats_{ts}.xlsx"
-    try:
-        write_admin_summary(stats, str(xlsx_path))
-        await m.answer_document(FSInputFile(str(xlsx_path)), caption="Полная сводка по всем агентам (XLSX).")
-    except Exception as e:
-        logger.exception("Admin stats XLSX failed")
-        await m.answer("Не удалось сформировать XLSX: " + html.escape(str(e)))
+    # XLSX — через очередь выгрузок; сами цифры служат водяным знаком кеша
+    await export_jobs.submit(
+        m, ("stats_all", days, "xlsx"), "Сводка по всем агентам (XLSX)",
+        partial(_build_admin_summary, stats=stats, days=days),
+        watermark=tuple(tuple(s.values()) for s in stats),
+    )
 
     await state.clear()
     await m.answer("🛠 Админ-меню", reply_markup=kb_admin_menu())
 
 
+async def _build_admin_summary(job: ExportJob, *, stats: list[dict], days: int | None) -> ExportResult:
+    """Задание очереди выгрузок: сводка по всем агентам -> XLSX (рендер в export_pool)."""
+    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    xlsx_path = job.workdir / f"admin_stats_{days or 'all'}_{ts}.xlsx"
+    await export_pool.run(write_admin_summary, stats, str(xlsx_path))
+    return ExportResult("Полная сводка по всем агентам (XLSX).", path=xlsx_path)
+
+
 # ====== Доступы (бригадиры) по @username ======
 
 @router.message(F.text == BTN_ADMIN_ACCESS)
-async def admin_access_menu(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_access_menu(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await state.clear()
@@ -322,16 +458,16 @@ async def admin_access_menu(m: Message, state: FSMContext):
 
 # — назначить бригадира —
 @router.message(F.text == BTN_ACCESS_ADD_BRIG)
-async def admin_access_add_brigadier_start(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_access_add_brigadier_start(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await state.set_state(AdminAccess.waiting_brig_username)
     await m.answer("Введите @username пользователя, которого назначаем бригадиром (например: @username).")
 
 @router.message(AdminAccess.waiting_brig_username)
-async def admin_access_add_brigadier_save(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_access_add_brigadier_save(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
+    if not access.is_admin:
         await state.clear()
         await m.answer("Доступ запрещён.")
         return
@@ -343,14 +479,12 @@ async def admin_access_add_brigadier_save(m: Message, state: FSMContext):
         await m.answer("Укажите корректный username (например, @username).")
         return
 
-    async with async_session() as session:
-        await ensure_brig_tables(session)
-        tg_id = await resolve_username_to_tg(session, raw)
-        if not tg_id:
-            await m.answer("Пользователь не найден в базе. Он должен хотя бы раз написать боту.")
-            return
-        await add_brigadier(session, tg_id)
-        await session.commit()
+    tg_id = await resolve_username_to_tg(session, raw)
+    if not tg_id:
+        await m.answer("Пользователь не найден в базе. Он должен хотя бы раз написать боту.")
+        return
+    await add_brigadier(session, tg_id)
+    await session.commit()
 
     await state.clear()
     await m.answer(f"✅ @{raw} назначен бригадиром.", reply_markup=kb_admin_access_menu())
@@ -358,8 +492,8 @@ async def admin_access_add_brigadier_save(m: Message, state: FSMContext):
 
 # — привязать участника к бригадиру —
 @router.message(F.text == BTN_ACCESS_ATTACH_MEMBER)
-async def admin_access_attach_start(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_access_attach_start(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
     await state.set_state(AdminAccess.waiting_attach_brig_username)
@@ -378,8 +512,8 @@ async def admin_access_attach_get_member(m: Message, state: FSMContext):
     await m.answer("Теперь введите @username участника, которого нужно привязать.")
 
 @router.message(AdminAccess.waiting_attach_member_username)
-async def admin_access_attach_save(m: Message, state: FSMContext):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_access_attach_save(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
+    if not access.is_admin:
         await state.clear()
         await m.answer("Доступ запрещён.")
         return
@@ -394,19 +528,17 @@ async def admin_access_attach_save(m: Message, state: FSMContext):
     data = await state.get_data()
     brig_username = data.get("brig_username")
 
-    async with async_session() as session:
-        await ensure_brig_tables(session)
-        brig_tg = await resolve_username_to_tg(session, brig_username or "")
-        member_tg = await resolve_username_to_tg(session, raw)
-        if not brig_tg:
-            await m.answer(f"Бригадир @{brig_username} не найден в базе.")
-            return
-        if not member_tg:
-            await m.answer(f"Участник @{raw} не найден в базе.")
-            return
+    brig_tg = await resolve_username_to_tg(session, brig_username or "")
+    member_tg = await resolve_username_to_tg(session, raw)
+    if not brig_tg:
+        await m.answer(f"Бригадир @{brig_username} не найден в базе.")
+        return
+    if not member_tg:
+        await m.answer(f"Участник @{raw} не найден в базе.")
+        return
 
-        await set_brig_member(session, brig_tg, member_tg)
-        await session.commit()
+    await set_brig_member(session, brig_tg, member_tg)
+    await session.commit()
 
     await state.clear()
     await m.answer(f"✅ Участник @{raw} привязан к бригадиру @{brig_username}.", reply_markup=kb_admin_access_menu())
@@ -414,20 +546,18 @@ async def admin_access_attach_save(m: Message, state: FSMContext):
 
 # — список бригадиров —
 @router.message(F.text == BTN_ACCESS_LIST)
-async def admin_access_list_brigadiers(m: Message):
-    if not await _is_admin_logged(m.from_user.id):
+async def admin_access_list_brigadiers(m: Message, session: AsyncSession, access: AccessContext):
+    if not access.is_admin:
         await m.answer("Доступ запрещён.")
         return
 
-    async with async_session() as session:
-        await ensure_brig_tables(session)
-        items = await list_brigadiers(session)
+    items = await list_brigadiers(session)
 
-        # Подтянем известные username/имена из таблицы Agent
-        # создадим карты tg_id -> (@username, name)
-        res = await session.execute(select(Agent))
-        agents = res.scalars().all()
-        uname_by_tg = {a.tg_user_id: (f"@{a.username}" if a.username else "", a.name or "") for a in agents}
+    # Подтянем известные username/имена из таблицы Agent
+    # создадим карты tg_id -> (@username, name)
+    res = await session.execute(select(Agent))
+    agents = res.scalars().all()
+    uname_by_tg = {a.tg_user_id: (f"@{a.username}" if a.username else "", a.name or "") for a in agents}
 
     if not items:
         await m.answer("Бригадиров ещё нет.", reply_markup=kb_admin_access_menu())
@@ -446,7 +576,7 @@ async def admin_access_list_brigadiers(m: Message):
     await m.answer("\n".join(lines), reply_markup=kb_admin_access_menu())
 
 @router.message(AdminDemoteBrig.waiting_username_or_id)
-async def admin_access_demote_brig_finish(m: Message, state: FSMContext):
+async def admin_access_demote_brig_finish(m: Message, state: FSMContext, session: AsyncSession):
     raw = (m.text or "").strip()
 
     if raw == BTN_BACK or raw.lower() in ("отмена", "cancel"):
@@ -458,21 +588,19 @@ async def admin_access_demote_brig_finish(m: Message, state: FSMContext):
 
     if raw.startswith("@"):
         uname = raw.lstrip("@")
-        async with async_session() as session:
-            agent = await get_agent_by_username(session, uname)
-            if not agent:
-                await m.answer("Не нашёл такого @username. Убедитесь, что человек писал боту.")
-                return
-            tg_id = int(agent.tg_user_id)
+        agent = await get_agent_by_username(session, uname)
+        if not agent:
+            await m.answer("Не нашёл такого @username. Убедитесь, что человек писал боту.")
+            return
+        tg_id = int(agent.tg_user_id)
     else:
         if not raw.isdigit():
             await m.answer("Нужен @username или числовой Telegram ID.")
             return
         tg_id = int(raw)
 
-    async with async_session() as session:
-        await demote_brigadier(session, tg_id)
-        await session.commit()
+    await demote_brigadier(session, tg_id)
+    await session.commit()
 
     await state.clear()
     await m.answer(f"✅ Пользователь {'@'+uname if raw.startswith('@') else tg_id} разжалован из бригадиров.",
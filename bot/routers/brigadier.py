@@ -2,12 +2,14 @@ from __future__ import annotations
 
 import io
 from datetime import datetime
+from functools import partial
 
 from aiogram import Router, F
-from aiogram.types import Message, BufferedInputFile
+from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # pandas опционально: если нет — используем openpyxl
 try:
@@ -15,23 +17,23 @@ try:
 except Exception:
     pd = None
 
-from ..db import async_session
 from ..models import Agent
+from ..access import AccessContext
+from ..exports import export_jobs, ExportJob, ExportResult
 from ..repo import (
     get_or_create_agent,
-    ensure_brig_tables,
     is_brigadier_allowed,
     set_brig_login,
-    is_brig_logged_in,
     get_agent_by_username,
     set_brig_member,
     remove_brig_member,
     list_brigadier_member_agent_ids,
-    agents_stats_for_period,
+    brigade_stats_for_period,
     block_member_by_username,
+    unblock_member_by_username,
 )
 from ..keyboards import (
-    kb_brig_menu, kb_brig_blacklist, kb_export_ranges,
+    kb_brig_menu, kb_brig_blacklist, kb_export_ranges, kb_main, kb_access_menu,
     BTN_BRIG_MENU, BTN_BRIG_MEMBERS, BTN_BRIG_ATTACH, BTN_BRIG_DETACH,
     BTN_BRIG_BLACKLIST, BTN_BRIG_BLOCK, BTN_BRIG_UNBLOCK,
     BTN_BRIG_STATS, BTN_BRIG_EXPORT_XLSX, BTN_BRIG_LOGOUT, BTN_BRIG_HELP,
@@ -62,22 +64,10 @@ class BrigBlockUser(StatesGroup):
 class BrigStats(StatesGroup):
     waiting_range = State()
 
-async def _main_kb_for(user_id: int):
-    async with async_session() as session:
-        agent = await get_or_create_agent(session, user_id)
-        await ensure_brig_tables(session)
-        await session.commit()
-        admin = bool(getattr(agent, "admin_logged_in", False))
-        brig_logged = await is_brig_logged_in(session, user_id)
-    return kb_main(is_admin=admin, is_brig=brig_logged)
-
 # -------- Access --------
 @router.message(F.text == BTN_ACCESS)
-async def access_menu(m: Message):
-    async with async_session() as session:
-        await ensure_brig_tables(session)
-        brig_logged = await is_brig_logged_in(session, m.from_user.id)
-    await m.answer("🔑 Доступ:", reply_markup=kb_access_menu(brig_logged=brig_logged, admin_logged=False))
+async def access_menu(m: Message, access: AccessContext):
+    await m.answer("🔑 Доступ:", reply_markup=kb_access_menu(brig_logged=access.is_brig, admin_logged=False))
 
 # -------- Login/logout --------
 @router.message(F.text == BTN_BRIG_LOGIN)
@@ -86,76 +76,68 @@ async def brig_login_start(m: Message, state: FSMContext):
     await m.answer("🧑‍✈️ Вход бригадира.\nВведите <b>ваш ID</b> (число).")
 
 @router.message(BrigAuth.waiting_id)
-async def brig_login_finish(m: Message, state: FSMContext):
+async def brig_login_finish(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
     raw = (m.text or "").strip()
     if not raw.isdigit():
         await m.answer("Нужны только цифры. Введите ваш ID.")
         return
     entered_id = int(raw)
 
-    async with async_session() as session:
-        await ensure_brig_tables(session)
-        allowed = await is_brigadier_allowed(session, m.from_user.id)
-        if not allowed:
-            await state.clear()
-            await m.answer("⛔️ Вам не назначена роль бригадира.")
-            return
-
-        agent = await get_or_create_agent(session, m.from_user.id)
-        if agent.id != entered_id:
-            await state.clear()
-            await m.answer("❌ ID не совпадает. Проверьте у администратора.")
-            return
-
-        await set_brig_login(session, m.from_user.id, True)
-        await session.commit()
+    allowed = await is_brigadier_allowed(session, m.from_user.id)
+    if not allowed:
+        await state.clear()
+        await m.answer("⛔️ Вам не назначена роль бригадира.")
+        return
+
+    agent = await get_or_create_agent(session, m.from_user.id)
+    if agent.id != entered_id:
+        await state.clear()
+        await m.answer("❌ ID не совпадает. Проверьте у администратора.")
+        return
+
+    await set_brig_login(session, m.from_user.id, True)
+    await session.commit()
 
     await state.clear()
     await m.answer("✅ Вход выполнен.", reply_markup=kb_brig_menu())
-    await m.answer("Главное меню:", reply_markup=await _main_kb_for(m.from_user.id))
+    await m.answer("Главное меню:", reply_markup=kb_main(is_admin=access.is_admin, is_brig=True))
 
 @router.message(F.text == BTN_BRIG_LOGOUT)
-async def brig_logout(m: Message, state: FSMContext):
-    async with async_session() as session:
-        await ensure_brig_tables(session)
-        await set_brig_login(session, m.from_user.id, False)
-        await session.commit()
+async def brig_logout(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
+    await set_brig_login(session, m.from_user.id, False)
+    await session.commit()
     await state.clear()
-    await m.answer("🚪 Режим бригадира выключен.", reply_markup=await _main_kb_for(m.from_user.id))
+    await m.answer("🚪 Режим бригадира выключен.", reply_markup=kb_main(is_admin=access.is_admin, is_brig=False))
 
 @router.message(F.text == BTN_BRIG_BLACKLIST)
-async def brig_blacklist_menu(m: Message):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
-            return
+async def brig_blacklist_menu(m: Message, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
+        return
     await m.answer("🧱 Чёрный список — выберите действие:", reply_markup=kb_brig_blacklist())
 
 @router.message(F.text == BTN_BRIG_MENU)
-async def brig_menu(m: Message):
-    async with async_session() as session:
-        await ensure_brig_tables(session)
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
-            return
+async def brig_menu(m: Message, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
+        return
     await m.answer("🧑‍✈️ Меню бригадира", reply_markup=kb_brig_menu())
 
 # -------- Members: combined list --------
 @router.message(F.text == BTN_BRIG_MEMBERS)
-async def brig_list_members(m: Message):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
-            return
-        agent_ids = await list_brigadier_member_agent_ids(session, m.from_user.id)
-        if not agent_ids:
-            await m.answer("Пока нет прикреплённых участников.", reply_markup=kb_brig_menu())
-            return
-        rows = await session.execute(
-            # Получим username/имя для списка
-            __import__('sqlalchemy').select(Agent).where(Agent.id.in_(agent_ids))
-        )
-        agents = rows.scalars().all()
+async def brig_list_members(m: Message, session: AsyncSession, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
+        return
+    agent_ids = await list_brigadier_member_agent_ids(session, m.from_user.id)
+    if not agent_ids:
+        await m.answer("Пока нет прикреплённых участников.", reply_markup=kb_brig_menu())
+        return
+    rows = await session.execute(
+        # Получим username/имя для списка
+        __import__('sqlalchemy').select(Agent).where(Agent.id.in_(agent_ids))
+    )
+    agents = rows.scalars().all()
     lines = ["<b>👥 Ваши участники</b>"]
     for a in agents:
         uname = f"@{a.username}" if a.username else "(без @)"
@@ -166,97 +148,89 @@ async def brig_list_members(m: Message):
 
 # -------- Attach by @username --------
 @router.message(F.text == BTN_BRIG_ATTACH)
-async def brig_attach_by_username_ask(m: Message, state: FSMContext):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир.")
-            return
+async def brig_attach_by_username_ask(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир.")
+        return
     await state.set_state(BrigAttachUser.waiting_username)
     await m.answer("Введите @username участника, которого хотите <b>привязать</b> к себе.")
 
 @router.message(BrigAttachUser.waiting_username)
-async def brig_attach_by_username_save(m: Message, state: FSMContext):
+async def brig_attach_by_username_save(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
     uname = (m.text or "").strip().lstrip("@")
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await state.clear()
-            await m.answer("⛔️ Сначала войдите как бригадир.")
-            return
-        agent = await get_agent_by_username(session, uname)
-        if not agent:
-            await m.answer("Не нашёл такого @username. Человек должен написать боту хотя бы раз.")
-            return
-        await set_brig_member(session, brig_tg_id=m.from_user.id, member_tg_id=int(agent.tg_user_id))
-        await session.commit()
+    if not access.is_brig:
+        await state.clear()
+        await m.answer("⛔️ Сначала войдите как бригадир.")
+        return
+    agent = await get_agent_by_username(session, uname)
+    if not agent:
+        await m.answer("Не нашёл такого @username. Человек должен написать боту хотя бы раз.")
+        return
+    await set_brig_member(session, brig_tg_id=m.from_user.id, member_tg_id=int(agent.tg_user_id))
+    await session.commit()
     await state.clear()
     await m.answer(f"✅ Участник @{uname} привязан к вам.", reply_markup=kb_brig_menu())
 
 # -------- Detach by @username --------
 @router.message(F.text == BTN_BRIG_DETACH)
-async def brig_detach_by_username_ask(m: Message, state: FSMContext):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир.")
-            return
+async def brig_detach_by_username_ask(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир.")
+        return
     await state.set_state(BrigDetachUser.waiting_username)
     await m.answer("Введите @username участника, которого хотите <b>отвязать</b> от себя.")
 
 @router.message(BrigDetachUser.waiting_username)
-async def brig_detach_by_username_save(m: Message, state: FSMContext):
+async def brig_detach_by_username_save(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
     uname = (m.text or "").strip().lstrip("@")
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await state.clear()
-            await m.answer("⛔️ Сначала войдите как бригадир.")
-            return
-        agent = await get_agent_by_username(session, uname)
-        if not agent:
-            await m.answer("Не нашёл такого @username.")
-            return
-        await remove_brig_member(session, brig_tg_id=m.from_user.id, member_tg_id=int(agent.tg_user_id))
-        await session.commit()
+    if not access.is_brig:
+        await state.clear()
+        await m.answer("⛔️ Сначала войдите как бригадир.")
+        return
+    agent = await get_agent_by_username(session, uname)
+    if not agent:
+        await m.answer("Не нашёл такого @username.")
+        return
+    await remove_brig_member(session, brig_tg_id=m.from_user.id, member_tg_id=int(agent.tg_user_id))
+    await session.commit()
     await state.clear()
     await m.answer(f"🧹 Участник @{uname} отвязан.", reply_markup=kb_brig_menu())
 
 # -------- Block by @username --------
 @router.message(F.text == BTN_BRIG_BLOCK)
-async def brig_block_ask(m: Message, state: FSMContext):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир.")
-            return
+async def brig_block_ask(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир.")
+        return
     await state.set_state(BrigBlockUser.waiting_username)
     await m.answer("Введите @username участника, которого хотите <b>заблокировать</b> в чате/боте.")
 
 @router.message(BrigBlockUser.waiting_username)
-async def brig_block_save(m: Message, state: FSMContext):
+async def brig_block_save(m: Message, state: FSMContext, session: AsyncSession):
     uname = (m.text or "").strip().lstrip("@")
-    async with async_session() as session:
-        try:
-            tg_id = await block_member_by_username(session, uname, blocked_by=m.from_user.id)
-            await session.commit()
-        except ValueError:
-            await m.answer("Не нашёл такого @username. Человек должен написать боту хотя бы раз.")
-            return
+    try:
+        tg_id = await block_member_by_username(session, uname, blocked_by=m.from_user.id)
+        await session.commit()
+    except ValueError:
+        await m.answer("Не нашёл такого @username. Человек должен написать боту хотя бы раз.")
+        return
     await state.clear()
     await m.answer(f"🚫 @{uname} заблокирован. Доступ к опросам закрыт.", reply_markup=kb_brig_menu())
 
 # -------- Stats for members + CSV export --------
 @router.message(F.text == BTN_BRIG_STATS)
-async def brig_stats_start(m: Message, state: FSMContext):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир.")
-            return
+async def brig_stats_start(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир.")
+        return
     await state.set_state(BrigStats.waiting_range)
     await m.answer("За какой период показать сводку по вашим участникам?", reply_markup=kb_export_ranges())
 
 @router.message(F.text == BTN_BRIG_EXPORT_XLSX)
-async def brig_export_start(m: Message, state: FSMContext):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
-            return
+async def brig_export_start(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир через «🔑 Доступ».")
+        return
     await state.set_state(BrigStats.waiting_range)
     await state.update_data(export_only=True)   # только файл, без текстовой простыни
     await m.answer("За какой период выгрузить XLSX по вашим участникам?", reply_markup=kb_export_ranges())
@@ -265,24 +239,22 @@ class BrigUnblockUser(StatesGroup):
     waiting_username = State()
 
 @router.message(F.text == BTN_BRIG_UNBLOCK)
-async def brig_unblock_ask(m: Message, state: FSMContext):
-    async with async_session() as session:
-        if not await is_brig_logged_in(session, m.from_user.id):
-            await m.answer("⛔️ Сначала войдите как бригадир.")
-            return
+async def brig_unblock_ask(m: Message, state: FSMContext, access: AccessContext):
+    if not access.is_brig:
+        await m.answer("⛔️ Сначала войдите как бригадир.")
+        return
     await state.set_state(BrigUnblockUser.waiting_username)
     await m.answer("Введите @username участника, которого нужно ♻️ <b>разблокировать</b>.")
 
 @router.message(BrigUnblockUser.waiting_username)
-async def brig_unblock_save(m: Message, state: FSMContext):
+async def brig_unblock_save(m: Message, state: FSMContext, session: AsyncSession):
     uname = (m.text or "").strip().lstrip("@")
-    async with async_session() as session:
-        try:
-            await unblock_member_by_username(session, uname)
-            await session.commit()
-        except ValueError:
-            await m.answer("Не нашёл такого @username. Человек должен один раз написать боту.")
-            return
+    try:
+        await unblock_member_by_username(session, uname)
+        await session.commit()
+    except ValueError:
+        await m.answer("Не нашёл такого @username. Человек должен один раз написать боту.")
+        return
     await state.clear()
     await m.answer(f"♻️ @{uname} разблокирован. Доступ к опросам восстановлен.", reply_markup=kb_brig_menu())
 
@@ -302,7 +274,7 @@ async def brig_help(m: Message):
     BrigStats.waiting_range,
     F.text.in_([BTN_EXP_TODAY, BTN_EXP_7, BTN_EXP_30, BTN_EXP_ALL, BTN_BACK]),
 )
-async def brig_stats_run(m: Message, state: FSMContext):
+async def brig_stats_run(m: Message, state: FSMContext, session: AsyncSession):
     if m.text == BTN_BACK:
         await state.clear()
         await m.answer("🧑‍✈️ Меню бригадира", reply_markup=kb_brig_menu())
@@ -322,12 +294,7 @@ async def brig_stats_run(m: Message, state: FSMContext):
         days, title = 30, "за 30 дней"
 
     # статистика ТОЛЬКО по подопечным этого бригадира
-    async with async_session() as session:
-        agent_ids = await list_brigadier_member_agent_ids(session, m.from_user.id)
-        all_stats = await agents_stats_for_period(session, days)
-        await session.commit()
-
-    stats = [s for s in all_stats if s.get("agent_id") in set(agent_ids)]
+    stats = await brigade_stats_for_period(session, m.from_user.id, days)
     if not stats:
         await state.clear()
         await m.answer("Пока нет данных по вашим участникам за выбранный период.", reply_markup=kb_brig_menu())
@@ -347,7 +314,19 @@ async def brig_stats_run(m: Message, state: FSMContext):
             )
         await m.answer("\n\n".join(lines))
 
-    # ===== XLSX в памяти с русскими заголовками =====
+    # XLSX собирает очередь выгрузок; сводка уже снята — передаём строки (они же водяной знак кеша)
+    await export_jobs.submit(
+        m, (f"brig:{m.from_user.id}", days, "xlsx"), f"XLSX по участникам ({title})",
+        partial(_build_brig_stats_xlsx, stats=stats, days=days),
+        watermark=tuple(tuple(s.values()) for s in stats),
+    )
+
+    await state.clear()
+    await m.answer("🧑‍✈️ Меню бригадира", reply_markup=kb_brig_menu())
+
+
+async def _build_brig_stats_xlsx(job: ExportJob, *, stats: list[dict], days: int | None) -> ExportResult:
+    """Задание очереди выгрузок: сводка бригады -> XLSX в памяти с русскими заголовками."""
     headers_ru = [
         "Логин (@)", "Имя",
         "Всего", "Согласие", "Отказ", "Никого нет",
@@ -430,9 +409,5 @@ async def brig_stats_run(m: Message, state: FSMContext):
             ws.column_dimensions[get_column_letter(i)].width = w
         wb.save(bio)
 
-    data = bio.getvalue()
     filename = f"brig_stats_{(days or 0)}d_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-    await m.answer_document(BufferedInputFile(data, filename=filename))
-
-    await state.clear()
-    await m.answer("🧑‍✈️ Меню бригадира", reply_markup=kb_brig_menu())
+    return ExportResult("", data=bio.getvalue(), filename=filename)
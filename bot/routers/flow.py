@@ -1,22 +1,28 @@
 # bot/routers/flow.py
 from __future__ import annotations
 
+import logging
 import re
+from datetime import datetime
+
 from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import StateFilter
 from aiogram.types import Message
-from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from ..access import AccessContext
 from ..states import Survey  # убедись, что в states есть перечисленные ниже состояния
-from ..db import async_session
 from ..repo import (
-    get_or_create_agent, create_visit, close_visit, create_contact,
-    update_contact_fields, close_contact, flyer_exists,
+    get_or_create_agent, create_visit, close_visit, save_contact,
+    claim_flyer_number, release_flyer_number, enqueue_lottery_webhook,
 )
-from ..models import RepeatTouch, TalkStatus, FlyerMethod, Contact
+from ..models import RepeatTouch, TalkStatus, FlyerMethod
 from ..utils.phone import normalize_phone
-from ..utils.webhook import send_lottery_code
+from ..outbox import outbox_worker
+from ..fsm_storage import saving_keys
+from ..write_queue import write_queue
+from ..utils.flyers import FLYER_MIN, FLYER_MAX
 
 from ..keyboards import (
     remove, kb_main, kb_cancel, kb_finish_or_add,
@@ -29,15 +35,107 @@ from ..keyboards import (
 )
 
 router = Router(name="flow")
-
-
-# ===== вспомогательная клавиатура главного меню для пользователя
-async def _main_kb_for(user_id: int):
-    async with async_session() as session:
-        agent = await get_or_create_agent(session, user_id)
-        await session.commit()
-        is_admin = bool(getattr(agent, "admin_logged_in", False))
-    return kb_main(is_admin=is_admin)
+logger = logging.getLogger(__name__)
+
+# Карточка избирателя копится в FSM-данных (ключ "card") и пишется в БД одной транзакцией,
+# когда опрос по ней закончен (_save_card). Сразу в БД идёт только захват номера флаера:
+# уникальность проверяется на шаге ввода номера. Все записи идут через write_queue
+# (групповой коммит): функции ниже — намерения, которые писатель выполняет в своей сессии.
+# Недозаполненная карточка не теряется: при отмене/выходе в меню её пишет save_pending_card,
+# у брошенного опроса — уборщик (bot/sweeper.py) при стирании FSM. Номер флаера, занятый
+# под карточку, освобождается, если агент ввёл другой или карточку записать не удалось.
+
+# карточки, которые сейчас пишутся (или под которые занимается номер флаера) — saving_keys:
+# апдейты обрабатываются параллельно, и повторное нажатие не должно записать карточку (и вебхук)
+# второй раз, а повторный ввод — занять второй номер; уборщик такие опросы не стирает
+_BUSY = object()
+
+
+async def _open_visit(
+    session: AsyncSession, tg_user_id: int, name: str | None, username: str | None,
+) -> tuple[int, int]:
+    """Агент (создаётся при первом входе) и новый визит. Возвращает (agent_id, visit_id)."""
+    agent = await get_or_create_agent(session, tg_user_id, name=name, username=username)
+    visit = await create_visit(session, agent_id=agent.id)
+    return agent.id, visit.id
+
+
+async def _card_update(state: FSMContext, **fields) -> dict:
+    """Дописать поля в накапливаемую карточку. Возвращает данные FSM после обновления."""
+    card = {**(await state.get_value("card") or {}), **fields}
+    return await state.update_data(card=card)
+
+
+async def _submit_card(state: FSMContext, fn, *args, **fields):
+    """
+    Отдать карточку (с дописанными fields) в write_queue: await fn(session, data, *args).
+    Из FSM карточка уходит только после записи. _BUSY — карточка уже пишется или уже записана
+    (двойное нажатие): вызывающему отвечать не нужно, это делает первый апдейт.
+    """
+    if state.key in saving_keys:
+        return _BUSY
+    saving_keys.add(state.key)
+    try:
+        data = await state.get_data()
+        if not data.get("card"):
+            return _BUSY
+        data["card"] = {**data["card"], **fields}
+        result = await write_queue.submit(fn, data, *args)
+        await state.update_data(card=None)
+        return result
+    finally:
+        saving_keys.discard(state.key)
+
+
+async def save_pending_card(state: FSMContext) -> None:
+    """Записать недозаполненную карточку как есть (закрытой) — перед отменой или сбросом опроса."""
+    card = await state.get_value("card")
+    if card and card.get("phone_e164"):
+        try:
+            await _submit_card(state, _save_card)
+        except Exception:
+            # карточка, которую БД не принимает, не должна запирать агента в опросе
+            logger.exception("Pending card not saved, dropped: %r", card)
+            if card.get("flyer_number") is not None:
+                await write_queue.submit(release_flyer_number, card["flyer_number"])
+
+
+async def _claim_flyer(session: AsyncSession, num: int, previous: int | None) -> bool:
+    """
+    Занять номер под карточку вместо previous (занятого ею раньше): повторный ввод номера
+    не должен навсегда сжечь первый. Свой же номер ещё раз — не конфликт.
+    """
+    if num == previous:
+        return True
+    if not await claim_flyer_number(session, num, None):
+        return False
+    if previous is not None:
+        await release_flyer_number(session, previous)
+    return True
+
+
+async def _save_card(session: AsyncSession, data: dict) -> int | None:
+    """Записать накопленную карточку (закрытой). None — карточки в состоянии нет (уже записана)."""
+    card = data.get("card")
+    if not card or not card.get("phone_e164"):
+        return None
+    return await save_contact(session, visit_id=data["visit_id"], agent_id=data["agent_id"], **card)
+
+
+async def _finish_card(session: AsyncSession, data: dict, voting_at_home: bool) -> tuple[int | None, bool]:
+    """Карточка целиком + вебхук в outbox — одной транзакцией. Возвращает (id карточки, вебхук поставлен)."""
+    cid = await _save_card(session, data)
+    if not cid:
+        return None, False
+    phone_raw = data.get("phone")
+    code = data.get("lottery_code")
+    # защита от двойного клика
+    if not (phone_raw and code) or data.get("wh_sent"):
+        return cid, False
+    await enqueue_lottery_webhook(
+        session, contact_id=cid, phone=phone_raw, code=code, voting_at_home=voting_at_home,
+    )
+    return cid, True
 
 
 # ===== отмена запрещена на критичных шагах
@@ -53,9 +151,10 @@ async def deny_cancel_on_strict_steps(m: Message, state: FSMContext):
 
 
 @router.message(F.text == BTN_CANCEL)
-async def on_cancel(m: Message, state: FSMContext):
+async def on_cancel(m: Message, state: FSMContext, access: AccessContext):
+    await save_pending_card(state)
     await state.clear()
-    await m.answer("Окей, прервал. Что дальше?", reply_markup=await _main_kb_for(m.from_user.id))
+    await m.answer("Окей, прервал. Что дальше?", reply_markup=kb_main(is_admin=access.is_admin))
 
 
 # ===== старт опроса
@@ -63,11 +162,9 @@ async def on_cancel(m: Message, state: FSMContext):
 async def start_visit(m: Message, state: FSMContext):
     display_name = " ".join(filter(None, [m.from_user.first_name, m.from_user.last_name])).strip() or None
     username = m.from_user.username or None
-    async with async_session() as session:
-        agent = await get_or_create_agent(session, m.from_user.id, name=display_name, username=username)
-        visit = await create_visit(session, agent_id=agent.id)
-        await session.commit()
-    await state.update_data(visit_id=visit.id, agent_id=agent.id, additional=False)
+    await save_pending_card(state)
+    agent_id, visit_id = await write_queue.submit(_open_visit, m.from_user.id, display_name, username)
+    await state.update_data(visit_id=visit_id, agent_id=agent_id, additional=False)
 
     await m.answer("📷 Пришлите фото у двери квартиры (обязательно).", reply_markup=remove())
     await state.set_state(Survey.waiting_photo_door)
@@ -76,7 +173,7 @@ async def start_visit(m: Message, state: FSMContext):
 # ===== фото у двери
 @router.message(Survey.waiting_photo_door, F.photo)
 async def door_photo(m: Message, state: FSMContext):
-    # если хотите хранить сам факт фото — можно проставить флаг у визита/контакта
+    # факт фото у двери попадает в карточку (door_photo) при её записи
     await m.answer("✍️ Введите ФИО избирателя полностью (пример: Иванов Иван Иванович).", reply_markup=kb_cancel())
     await state.set_state(Survey.waiting_full_name)
 
@@ -137,23 +234,16 @@ async def get_phone(m: Message, state: FSMContext):
 
 async def _commit_phone_and_open_next_steps(m: Message, state: FSMContext, phone: str):
     data = await state.get_data()
-    visit_id = data["visit_id"]
-    agent_id = data["agent_id"]
-    full_name = data["full_name"]
-
-    async with async_session() as session:
-        contact = await create_contact(
-            session,
-            visit_id=visit_id,
-            agent_id=agent_id,
-            full_name=full_name,
-            phone_e164=phone,
-        )
-        # фиксируем, что фото у двери было
-        await update_contact_fields(session, contact.id, door_photo=True)
-        await session.commit()
-
-    await state.update_data(contact_id=contact.id, phone=phone)
+    # новая карточка: время — как раньше, по вводу телефона; фото у двери обязательно на входе в визит
+    await state.update_data(
+        phone=phone,
+        card={
+            "full_name": data["full_name"],
+            "phone_e164": phone,
+            "created_at": datetime.utcnow(),
+            "door_photo": True,
+        },
+    )
 
     if data.get("additional"):
         await m.answer("🎟 Выдача флаера: как передали?", reply_markup=kb_flyer_method())
@@ -167,11 +257,7 @@ async def _commit_phone_and_open_next_steps(m: Message, state: FSMContext, phone
 @router.message(Survey.waiting_repeat_touch, F.text.in_([BTN_PRIMARY, BTN_SECONDARY]))
 async def choose_repeat(m: Message, state: FSMContext):
     val = RepeatTouch.PRIMARY if m.text == BTN_PRIMARY else RepeatTouch.SECONDARY
-    data = await state.get_data()
-    contact_id = data["contact_id"]
-    async with async_session() as session:
-        await update_contact_fields(session, contact_id, repeat_touch=val)
-        await session.commit()
+    await _card_update(state, repeat_touch=val.value)
     await m.answer("🗣 Статус общения: как прошло?", reply_markup=kb_status())
     await state.set_state(Survey.waiting_talk_status)
 
@@ -185,31 +271,29 @@ async def choose_talk_status(m: Message, state: FSMContext):
         BTN_CONSENT: TalkStatus.CONSENT,
     }
     status = mapping[m.text]
-    data = await state.get_data()
-    contact_id = data["contact_id"]
-
-    async with async_session() as session:
-        await update_contact_fields(session, contact_id, talk_status=status)
-        await session.commit()
+    card = await state.get_value("card")
+    if not card:
+        # повторное нажатие: карточку уже закрыл первый апдейт
+        return
 
     if status == TalkStatus.NO_ONE:
         # первичка + никого нет → закрываем карточку
-        async with async_session() as session:
-            res = await session.execute(select(Contact).where(Contact.id == contact_id))
-            c = res.scalars().first()
-            if c and c.repeat_touch == RepeatTouch.PRIMARY:
-                await close_contact(session, contact_id)
-                await session.commit()
-                await state.update_data(last_closed_contact_id=contact_id)
-                await m.answer("Никого нет (первичный обход). Карточка закрыта. Что дальше?", reply_markup=kb_finish_or_add())
-                await state.set_state(Survey.waiting_finish_choice)
+        if card.get("repeat_touch") == RepeatTouch.PRIMARY:
+            contact_id = await _submit_card(state, _save_card, talk_status=status.value)
+            if contact_id is _BUSY:
                 return
+            await state.update_data(last_closed_contact_id=contact_id)
+            await m.answer("Никого нет (первичный обход). Карточка закрыта. Что дальше?", reply_markup=kb_finish_or_add())
+            await state.set_state(Survey.waiting_finish_choice)
+            return
 
         # иначе продолжаем
+        await _card_update(state, talk_status=status.value)
         await m.answer("Никого нет (вторичный обход). 🎟 Выдача флаера: как передали?", reply_markup=kb_flyer_method())
         await state.set_state(Survey.waiting_flyer_method)
         return
 
+    await _card_update(state, talk_status=status.value)
     await m.answer("🎟 Выдача флаера: как передали?", reply_markup=kb_flyer_method())
     await state.set_state(Survey.waiting_flyer_method)
 
@@ -223,13 +307,8 @@ async def choose_flyer(m: Message, state: FSMContext):
     }
     method = mapping[m.text]
 
-    data = await state.get_data()
-    contact_id = data["contact_id"]
-
     # Сохраняем метод выдачи
-    async with async_session() as session:
-        await update_contact_fields(session, contact_id, flyer_method=method)
-        await session.commit()
+    await _card_update(state, flyer_method=method.value)
 
     # ❗ И "На руки", и "В ящик" → просим номер флаера (обязательно)
     if method in (FlyerMethod.HAND, FlyerMethod.MAILBOX):
@@ -255,25 +334,28 @@ async def flyer_number_input(m: Message, state: FSMContext):
         return
 
     num = int(text)
-    if not (1 <= num <= 60_000):
+    if not (FLYER_MIN <= num <= FLYER_MAX):
         await m.answer("⚠️ Номер вне диапазона. Допустимо от 1 до 60 000.")
         return
 
-    # уникальность
-    async with async_session() as session:
-        if await flyer_exists(session, num):
+    # уникальность: проверка и захват номера — одна атомарная вставка; карточки в БД ещё нет,
+    # номер привязывается к ней в save_contact
+    if state.key in saving_keys:
+        # предыдущий ввод ещё занимает номер — ответит он
+        return
+    saving_keys.add(state.key)
+    try:
+        card = await state.get_value("card")
+        if not card:
+            return
+        if not await write_queue.submit(_claim_flyer, num, card.get("flyer_number")):
             await m.answer("⚠️ Такой номер флаера уже использовался. Укажите другой.")
             return
-
-    data = await state.get_data()
-    contact_id = data["contact_id"]
-
-    async with async_session() as session:
-        await update_contact_fields(session, contact_id, flyer_number=str(num))
-        await session.commit()
-
-    # сохраним код в FSM, чтобы вебхук гарантированно его получил
-    await state.update_data(lottery_code=str(num))
+        # сохраним код в FSM, чтобы вебхук гарантированно его получил
+        await _card_update(state, flyer_number=num)
+        await state.update_data(lottery_code=str(num))
+    finally:
+        saving_keys.discard(state.key)
 
     await m.answer("🏠 Голосование на дому: требуется ли урна?", reply_markup=kb_yes_no())
     await state.set_state(Survey.waiting_home_voting)
@@ -284,41 +366,23 @@ async def flyer_number_required(m: Message, state: FSMContext):
     await m.answer("#️⃣ Номер флаера обязателен. Введите, пожалуйста.")
 
 
-# --- Голосование на дому + вызов вебхука ---
+# --- Голосование на дому + постановка вебхука в очередь ---
 @router.message(Survey.waiting_home_voting, F.text.in_([BTN_YES, BTN_NOT]))
 async def home_voting(m: Message, state: FSMContext):
     voting_at_home = (m.text == BTN_YES)
-    await state.update_data(voting_at_home=voting_at_home)
 
-    data = await state.get_data()
-    phone_raw = data.get("phone")
-    code = data.get("lottery_code")
-    cid = data.get("contact_id")
-
-    # если чего-то нет в состоянии — добираем из БД
-    if (not phone_raw or not code) and cid:
-        async with async_session() as session:
-            c = await session.get(Contact, cid)
-            if c:
-                phone_raw = phone_raw or c.phone_e164
-                code = code or (c.flyer_number or "")
-
-    # отправляем вебхук (защита от двойного клика)
-    if phone_raw and code and not data.get("wh_sent"):
-        await state.update_data(wh_sent=True)
-        ok, msg = await send_lottery_code(phone_raw, code, voting_at_home)
-        if ok:
-            await m.answer("✅ Спасибо! Данные сохранены.")
-        else:
-            await m.answer(f"⚠️ Не удалось сохранить данные, попробуйте позже. {msg}")
-
-    # записываем home_voting и закрываем контакт
+    # записываем карточку целиком и кладём вебхук в outbox — одной транзакцией
+    res = await _submit_card(state, _finish_card, voting_at_home, home_voting=voting_at_home)
+    if res is _BUSY:
+        return
+    cid, queued = res
+    await state.update_data(voting_at_home=voting_at_home)
     if cid:
-        async with async_session() as session:
-            await update_contact_fields(session, cid, home_voting=voting_at_home)
-            await close_contact(session, cid)
-            await session.commit()
-        await state.update_data(last_closed_contact_id=cid)
+        await state.update_data(last_closed_contact_id=cid, wh_sent=await state.get_value("wh_sent") or queued)
+        if queued:
+            # доставка идёт в фоне (bot/outbox.py), агент не ждёт внешний сервис
+            outbox_worker.notify()
+            await m.answer("✅ Спасибо! Данные сохранены.")
 
     await m.answer("✅ Карточка готова. Завершить обход или добавить ещё избирателя?",
                    reply_markup=kb_finish_or_add())
@@ -326,25 +390,23 @@ async def home_voting(m: Message, state: FSMContext):
 
 # ===== завершение квартиры / добавить ещё
 @router.message(Survey.waiting_finish_choice, F.text.in_([BTN_FINISH, BTN_ADD_MORE, BTN_MAIN_MENU]))
-async def finish_choice(m: Message, state: FSMContext):
+async def finish_choice(m: Message, state: FSMContext, access: AccessContext):
     data = await state.get_data()
     visit_id = data.get("visit_id")
 
     if m.text == BTN_FINISH:
-        async with async_session() as session:
-            await close_visit(session, visit_id)
-            await session.commit()
+        await write_queue.submit(close_visit, visit_id)
         await state.clear()
-        await m.answer("Опрос завершён. Что дальше?", reply_markup=await _main_kb_for(m.from_user.id))
+        await m.answer("Опрос завершён. Что дальше?", reply_markup=kb_main(is_admin=access.is_admin))
         return
 
     if m.text == BTN_ADD_MORE:
         await state.update_data(additional=True,  # пометим, что следующий — «дополнительный»
-                               phone=None, lottery_code=None, wh_sent=False)
+                               phone=None, lottery_code=None, wh_sent=False, card=None)
         await m.answer("✍️ Введите ФИО избирателя полностью (пример: Иванов Иван Иванович).", reply_markup=kb_cancel())
         await state.set_state(Survey.waiting_full_name)
         return
 
     # BTN_MAIN_MENU
     await state.clear()
-    await m.answer("Главное меню:", reply_markup=await _main_kb_for(m.from_user.id))
+    await m.answer("Главное меню:", reply_markup=kb_main(is_admin=access.is_admin))
@@ -1,14 +1,17 @@
 from __future__ import annotations
 import io
 from datetime import datetime
+from functools import partial
 
 import pandas as pd
 from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, BufferedInputFile
+from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..db import async_session
+from ..access import AccessContext
+from ..exports import export_jobs, ExportJob, ExportResult
 from ..repo import get_or_create_agent, agent_stats_last24h, agents_stats_for_period
 from ..keyboards import (
     BTN_MY_STATS,
@@ -22,13 +25,11 @@ router = Router(name="stats")
 
 # ===== Твоя «Сводка за смену» как была =====
 @router.message(F.text == BTN_MY_STATS)
-async def my_stats(m: Message):
-    async with async_session() as session:
-        display_name = " ".join(filter(None, [m.from_user.first_name, m.from_user.last_name])).strip() or None
-        username = m.from_user.username or None
-        agent = await get_or_create_agent(session, m.from_user.id, name=display_name, username=username)
-        stats = await agent_stats_last24h(session, agent.id)
-        await session.commit()
+async def my_stats(m: Message, session: AsyncSession):
+    display_name = " ".join(filter(None, [m.from_user.first_name, m.from_user.last_name])).strip() or None
+    username = m.from_user.username or None
+    agent = await get_or_create_agent(session, m.from_user.id, name=display_name, username=username)
+    stats = await agent_stats_last24h(session, agent.id)
 
     uname = f"@{agent.username}" if agent.username else "(без @)"
     who = agent.name or uname
@@ -63,19 +64,13 @@ async def agent_export_start(m: Message, state: FSMContext):
     AgentExport.waiting_range,
     F.text.in_([BTN_EXP_TODAY, BTN_EXP_7, BTN_EXP_30, BTN_EXP_ALL, BTN_BACK]),
 )
-async def agent_export_run(m: Message, state: FSMContext):
+async def agent_export_run(m: Message, state: FSMContext, session: AsyncSession, access: AccessContext):
     # Назад — в главное меню
     if m.text == BTN_BACK:
         await state.clear()
-        async with async_session() as session:
-            agent = await get_or_create_agent(session, m.from_user.id)
-            await session.commit()
         await m.answer(
             "Главное меню.",
-            reply_markup=kb_main(
-                is_admin=bool(getattr(agent, "admin_logged_in", False)),
-                is_brig=bool(getattr(agent, "brig_logged_in", False)),
-            ),
+            reply_markup=kb_main(is_admin=access.is_admin, is_brig=access.is_brig),
         )
         return
 
@@ -89,22 +84,17 @@ async def agent_export_run(m: Message, state: FSMContext):
         days, title = 30, "за 30 дней"
 
     # Агент + агрегированная статистика за период
-    async with async_session() as session:
-        display_name = " ".join(filter(None, [m.from_user.first_name, m.from_user.last_name])) or None
-        username = m.from_user.username or None
-        agent = await get_or_create_agent(session, m.from_user.id, name=display_name, username=username)
-        all_stats = await agents_stats_for_period(session, days)
-        await session.commit()
-
-    my = next((s for s in all_stats if s.get("agent_id") == agent.id), None)
+    display_name = " ".join(filter(None, [m.from_user.first_name, m.from_user.last_name])) or None
+    username = m.from_user.username or None
+    agent = await get_or_create_agent(session, m.from_user.id, name=display_name, username=username)
+    found = await agents_stats_for_period(session, days, agent_ids=[agent.id])
+
+    my = found[0] if found else None
     if not my:
         await state.clear()
         await m.answer(
             "За выбранный период по вам нет данных.",
-            reply_markup=kb_main(
-                is_admin=bool(getattr(agent, "admin_logged_in", False)),
-                is_brig=bool(getattr(agent, "brig_logged_in", False)),
-            ),
+            reply_markup=kb_main(is_admin=access.is_admin, is_brig=access.is_brig),
         )
         return
 
@@ -126,10 +116,22 @@ async def agent_export_run(m: Message, state: FSMContext):
     )
     await m.answer(text)
 
-    # ===== XLSX в памяти (1 строка-агрегат) с русской шапкой =====
+    # XLSX собирает очередь выгрузок
+    await export_jobs.submit(
+        m, (f"agent:{agent.id}", days, "xlsx"), f"XLSX ({title})",
+        partial(_build_agent_xlsx, my=my, username=agent.username, name=agent.name, title=title, days=days),
+        watermark=(agent.username, agent.name, *my.values()),
+    )
+    await state.clear()
+
+
+async def _build_agent_xlsx(
+    job: ExportJob, *, my: dict, username: str | None, name: str | None, title: str, days: int | None,
+) -> ExportResult:
+    """Задание очереди выгрузок: личная сводка агента -> XLSX в памяти (1 строка-агрегат) с русской шапкой."""
     rows = [{
-        "username": agent.username or "",
-        "name":     agent.name or "",
+        "username": username or "",
+        "name":     name or "",
         "period":   title,
         "total":    my.get("total", 0),
         "consent":  my.get("consent", 0),
@@ -178,7 +180,5 @@ async def agent_export_run(m: Message, state: FSMContext):
         with pd.ExcelWriter(bio, engine="openpyxl") as w:
             df.to_excel(w, index=False, sheet_name="Моя сводка")
 
-    data = bio.getvalue()
     filename = f"my_stats_{(days or 0)}d_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-    await m.answer_document(BufferedInputFile(data, filename=filename))
-    await state.clear()
+    return ExportResult("", data=bio.getvalue(), filename=filename)
@@ -16,6 +16,7 @@ class Survey(StatesGroup):
 # -------- админ --------
 class AdminExport(StatesGroup):
     waiting_range = State()
+    waiting_base_book = State()  # дельта «дописать в прошлую книгу»: ждём файл XLSX
 
 class AdminAuth(StatesGroup):
     waiting_login = State()
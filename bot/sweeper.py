@@ -0,0 +1,152 @@
+# bot/sweeper.py
+"""
+Фоновая уборка брошенных опросов.
+
+Агент может бросить опрос на середине: состояние FSM, открытый визит и карточка
+(closed_at IS NULL) остаются навсегда. Раз в SWEEP_INTERVAL уборщик:
+- вытесняет из памяти FSM-записи без обращений дольше FSM_CACHE_TTL (fsm_storage.trim);
+- стирает из fsm.db опросы без движения дольше SURVEY_ABANDON_AFTER (fsm_storage.expire;
+  опрос, чью карточку как раз пишет хендлер, не трогает — см. saving_keys) и записывает
+  в БД закрытыми их недозаполненные карточки (копились в FSM, см. routers/flow.py) — одной
+  транзакцией; номер флаера привязывается к карточке (карточку, которую БД не приняла,
+  уборщик пропускает и освобождает её номер). Не записалось — FSM возвращается
+  на место (fsm_storage.restore), попытка повторится в следующий проход;
+- закрывает визиты и карточки старше того же срока пачками по SWEEP_BATCH —
+  один UPDATE по частичному индексу на пачку, карточки попадают в agent_day_stats и agent_day_cube.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from .config import SURVEY_ABANDON_AFTER, SWEEP_INTERVAL, SWEEP_BATCH
+from .db import async_session
+from .fsm_storage import ExpiredRecord, fsm_storage
+from .repo import close_abandoned_contacts, close_abandoned_visits, release_flyer_number, save_contact
+
+logger = logging.getLogger(__name__)
+
+
+class Sweeper:
+    def __init__(
+        self,
+        *,
+        interval: float = SWEEP_INTERVAL,
+        batch: int = SWEEP_BATCH,
+        abandon_after: float = SURVEY_ABANDON_AFTER,
+    ) -> None:
+        self.interval = interval
+        self.batch = batch
+        self.abandon_after = abandon_after
+        self._task: asyncio.Task | None = None
+
+        # счётчики для логов/диагностики
+        self.runs = 0
+        self.fsm_evicted = 0
+        self.fsm_expired = 0
+        self.cards_saved = 0
+        self.visits_closed = 0
+        self.contacts_closed = 0
+
+    # ---- жизненный цикл
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="sweeper")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ---- цикл
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Sweep failed")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> dict:
+        """Один проход. Возвращает, сколько чего убрано."""
+        evicted = fsm_storage.trim()
+        expired = await fsm_storage.expire(time.time() - self.abandon_after)
+        cards = await self._save_cards(expired)
+        before = datetime.utcnow() - timedelta(seconds=self.abandon_after)
+        visits = await self._drain(close_abandoned_visits, before)
+        contacts = await self._drain(close_abandoned_contacts, before)
+
+        self.runs += 1
+        self.fsm_evicted += evicted
+        self.fsm_expired += len(expired)
+        self.cards_saved += cards
+        self.visits_closed += visits
+        self.contacts_closed += contacts
+        done = {
+            "fsm_evicted": evicted, "fsm_expired": len(expired), "cards": cards,
+            "visits": visits, "contacts": contacts,
+        }
+        if any(done.values()):
+            logger.info("Sweep: %s", done)
+        return done
+
+    async def _save_cards(self, expired: list[ExpiredRecord]) -> int:
+        """
+        Записать карточки из стёртых FSM-записей. Карточка, которую БД не принимает, пропускается
+        (в лог), её номер флаера освобождается; не удалась вся транзакция — записи возвращаются в fsm.db.
+        """
+        pending = [r.data for r in expired if (r.data.get("card") or {}).get("phone_e164")]
+        if not pending:
+            return 0
+        saved = 0
+        try:
+            async with async_session() as session:
+                for data in pending:
+                    try:
+                        async with session.begin_nested():
+                            await save_contact(
+                                session, visit_id=data["visit_id"], agent_id=data["agent_id"], **data["card"],
+                            )
+                    except Exception:
+                        logger.exception("Abandoned card not saved, dropped: %r", data["card"])
+                        if data["card"].get("flyer_number") is not None:
+                            await release_flyer_number(session, data["card"]["flyer_number"])
+                        continue
+                    saved += 1
+                await session.commit()
+        except Exception:
+            await fsm_storage.restore(expired)
+            raise
+        return saved
+
+    async def _drain(self, close, before: datetime) -> int:
+        """Закрывать пачками (транзакция на пачку), пока не кончатся."""
+        total = 0
+        while True:
+            async with async_session() as session:
+                n = await close(session, before=before, limit=self.batch)
+                await session.commit()
+            total += n
+            if n < self.batch:
+                return total
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "fsm_evicted": self.fsm_evicted,
+            "fsm_expired": self.fsm_expired,
+            "cards_saved": self.cards_saved,
+            "visits_closed": self.visits_closed,
+            "contacts_closed": self.contacts_closed,
+        }
+
+
+sweeper = Sweeper()
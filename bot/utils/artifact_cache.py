@@ -0,0 +1,169 @@
+# bot/utils/artifact_cache.py
+"""
+Дисковый кеш готовых выгрузок (XLSX/CSV).
+
+Ключ — (scope, период, формат) задания и водяной знак данных: пока данные не
+изменились, повторный запрос не пересобирает файл, а отправляет сохранённый
+Telegram file_id (или загружает файл с диска, если file_id ещё нет).
+Для одного (scope, период, формат) хранится только последняя версия; общий объём
+ограничен EXPORT_CACHE_MAX_BYTES, лишнее вытесняется по давности использования (LRU).
+Индекс — JSON рядом с файлами, переживает перезапуск бота.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+from ..config import EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+_INDEX = "index.json"
+
+
+@dataclass
+class CachedArtifact:
+    scope: str        # repr ключа задания (без водяного знака)
+    file: str         # имя файла в каталоге кеша
+    filename: str     # имя для пользователя
+    caption: str
+    size: int
+    used_at: float
+    file_id: str | None = None
+
+
+class ArtifactCache:
+    def __init__(self, root: str | Path = EXPORT_CACHE_DIR, max_bytes: int = EXPORT_CACHE_MAX_BYTES) -> None:
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._index: dict[str, CachedArtifact] | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---- индекс
+
+    def _entries(self) -> dict[str, CachedArtifact]:
+        if self._index is None:
+            self._index = {}
+            try:
+                raw = json.loads((self.root / _INDEX).read_text(encoding="utf-8"))
+                self._index = {k: CachedArtifact(**v) for k, v in raw.items()}
+            except FileNotFoundError:
+                pass
+            except Exception:
+                logger.warning("Export cache index is broken, starting empty", exc_info=True)
+        return self._index
+
+    def _save(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / (_INDEX + ".tmp")
+        tmp.write_text(json.dumps({k: asdict(v) for k, v in self._entries().items()}), encoding="utf-8")
+        os.replace(tmp, self.root / _INDEX)
+
+    @staticmethod
+    def _digest(key: tuple, watermark: object) -> str:
+        return hashlib.sha1(repr((key, watermark)).encode()).hexdigest()
+
+    def path(self, entry: CachedArtifact) -> Path:
+        return self.root / entry.file
+
+    # ---- API
+
+    def get(self, key: tuple, watermark: object) -> CachedArtifact | None:
+        entries = self._entries()
+        digest = self._digest(key, watermark)
+        entry = entries.get(digest)
+        if entry is not None and not self.path(entry).exists():
+            del entries[digest]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry.used_at = time.time()
+        self._save()
+        return entry
+
+    def put(
+        self,
+        key: tuple,
+        watermark: object,
+        *,
+        caption: str,
+        filename: str,
+        src: Path | None = None,
+        data: bytes | None = None,
+    ) -> CachedArtifact:
+        """Положить файл в кеш (src переносится, data записывается). Старые версии того же ключа удаляются."""
+        entries = self._entries()
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest = self._digest(key, watermark)
+        file = digest + Path(filename).suffix
+        if src is not None:
+            shutil.move(str(src), str(self.root / file))
+        else:
+            (self.root / file).write_bytes(data or b"")
+        scope = repr(key)
+        for d in [d for d, e in entries.items() if e.scope == scope and d != digest]:
+            self._drop(d)
+        entry = CachedArtifact(
+            scope=scope, file=file, filename=filename, caption=caption,
+            size=(self.root / file).stat().st_size, used_at=time.time(),
+        )
+        entries[digest] = entry
+        self._evict(keep=digest)
+        self._save()
+        return entry
+
+    def set_file_id(self, key: tuple, watermark: object, file_id: str) -> None:
+        entry = self._entries().get(self._digest(key, watermark))
+        if entry is not None and entry.file_id != file_id:
+            entry.file_id = file_id
+            self._save()
+
+    def forget_file_id(self, key: tuple, watermark: object) -> None:
+        """file_id не принят Telegram (например, сменился токен) — дальше грузим файл."""
+        entry = self._entries().get(self._digest(key, watermark))
+        if entry is not None and entry.file_id is not None:
+            entry.file_id = None
+            self._save()
+
+    # ---- вытеснение
+
+    def _drop(self, digest: str) -> None:
+        entry = self._entries().pop(digest, None)
+        if entry is not None:
+            self.path(entry).unlink(missing_ok=True)
+
+    def _evict(self, *, keep: str) -> None:
+        entries = self._entries()
+        total = sum(e.size for e in entries.values())
+        for d in sorted(entries, key=lambda d: entries[d].used_at):
+            if total <= self.max_bytes:
+                break
+            if d == keep:
+                continue
+            total -= entries[d].size
+            self._drop(d)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(e.size for e in entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+artifact_cache = ArtifactCache()
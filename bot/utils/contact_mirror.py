@@ -0,0 +1,398 @@
+# bot/utils/contact_mirror.py
+"""
+Колоночное зеркало таблицы contact для выгрузок и сводных листов.
+
+Каждая колонка — отдельный файл на диске (MIRROR_DIR), строки идут по возрастанию id:
+числа и коды — плоские массивы numpy (.bin), строки — смещения/длины (.off/.len)
+и общий буфер байтов UTF-8 (.blob). Перечисления хранятся кодами int8
+(позиция в Enum + 1, 0 — NULL), агенты — справочником agents.json.
+
+Зеркало не пересобирается на каждую выгрузку: sync() дописывает карточки с id больше
+последнего зеркалированного и переписывает на месте изменённые (по contact.updated_at,
+индекс ix_contact_updated). Если строк в БД стало меньше (удаление) или файлы
+испорчены — полная пересборка. Готовность данных фиксирует meta.json: файлы длиннее,
+чем записано в нём, обрезаются при следующей синхронизации.
+
+Читатель (MirrorSnapshot) работает в процессе utils.export_pool через memmap:
+отбор периода, сортировка и счётчики сводных листов — векторно.
+
+Пересборка и сверка с SQL: python -m bot.cli mirror-rebuild / mirror-check.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+
+from ..config import MIRROR_DIR
+from ..models import RepeatTouch, TalkStatus, FlyerMethod
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = 1
+_META = "meta.json"
+_AGENTS = "agents.json"
+
+# числовые колонки: имя -> dtype
+_FIXED = {
+    "id": np.dtype("<i8"),
+    "agent": np.dtype("<i4"),     # 0 — без агента
+    "repeat": np.dtype("i1"),
+    "status": np.dtype("i1"),
+    "method": np.dtype("i1"),
+    "home": np.dtype("i1"),       # 1 — голосование на дому
+    "created": np.dtype("<i8"),   # микросекунды UNIX (UTC)
+}
+# строковые колонки
+_TEXT = ("full_name", "phone", "flyer")
+_OFF = np.dtype("<i8")
+_LEN = np.dtype("<i4")
+
+# код = позиция + 1, 0 — NULL
+REPEATS: list[RepeatTouch | None] = [None, *RepeatTouch]
+STATUSES: list[TalkStatus | None] = [None, *TalkStatus]
+METHODS: list[FlyerMethod | None] = [None, *FlyerMethod]
+_REPEAT_CODE = {e: i for i, e in enumerate(REPEATS) if e is not None}
+_STATUS_CODE = {e: i for i, e in enumerate(STATUSES) if e is not None}
+_METHOD_CODE = {e: i for i, e in enumerate(METHODS) if e is not None}
+
+_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+# изменения, закоммиченные чуть позже более свежих, не должны потеряться
+_UPDATED_SLACK = timedelta(minutes=1)
+
+
+def to_us(dt: datetime) -> int:
+    return (dt - _EPOCH) // _US
+
+
+def from_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=int(us))
+
+
+def _latest(current: datetime | None, rows: Sequence) -> datetime | None:
+    for r in rows:
+        if r.updated_at is not None and (current is None or r.updated_at > current):
+            current = r.updated_at
+    return current
+
+
+# ---------- запись ----------
+
+def _encode(rows: Sequence) -> tuple[dict[str, np.ndarray], dict[str, list[bytes]]]:
+    """Пачка строк repo.iter_contacts_after/updated -> массивы числовых колонок и байты строковых."""
+    n = len(rows)
+    fixed = {k: np.zeros(n, dtype=dt) for k, dt in _FIXED.items()}
+    text: dict[str, list[bytes]] = {k: [] for k in _TEXT}
+    ids, agent, repeat, status, method, home, created = (fixed[k] for k in _FIXED)
+    for i, (cid, agent_id, rt, ts, fm, hv, cr, full_name, phone, flyer, _) in enumerate(rows):
+        ids[i] = cid
+        agent[i] = agent_id or 0
+        repeat[i] = _REPEAT_CODE.get(rt, 0)
+        status[i] = _STATUS_CODE.get(ts, 0)
+        method[i] = _METHOD_CODE.get(fm, 0)
+        home[i] = 1 if hv else 0
+        created[i] = to_us(cr) if cr is not None else 0
+        text["full_name"].append((full_name or "").encode())
+        text["phone"].append((phone or "").encode())
+        text["flyer"].append((flyer or "").encode())
+    return fixed, text
+
+
+class ContactMirror:
+    def __init__(self, root: str | Path = MIRROR_DIR) -> None:
+        self.root = Path(root)
+        self._lock = asyncio.Lock()
+
+        self.syncs = 0
+        self.rebuilds = 0
+        self.appended = 0
+        self.rewritten = 0
+        self.sync_seconds_max = 0.0
+
+    # ---- файлы
+
+    def _file(self, name: str) -> Path:
+        return self.root / name
+
+    def _empty_meta(self) -> dict:
+        return {"schema": _SCHEMA, "rows": 0, "last_id": 0, "last_updated": None,
+                "blob": {k: 0 for k in _TEXT}}
+
+    def meta(self) -> dict:
+        """Текущее состояние зеркала (то, что видно читателям)."""
+        try:
+            meta = json.loads(self._file(_META).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return self._empty_meta()
+        if meta.get("schema") != _SCHEMA:
+            return self._empty_meta()
+        return meta
+
+    def _save_meta(self, meta: dict) -> None:
+        tmp = self._file(_META + ".tmp")
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, self._file(_META))
+
+    def _truncate(self, meta: dict) -> None:
+        """Обрезать файлы до длины из meta (хвост недописанной синхронизации)."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        rows = meta["rows"]
+        sizes = {f"{k}.bin": rows * dt.itemsize for k, dt in _FIXED.items()}
+        for k in _TEXT:
+            sizes[f"{k}.off"] = rows * _OFF.itemsize
+            sizes[f"{k}.len"] = rows * _LEN.itemsize
+            sizes[f"{k}.blob"] = meta["blob"][k]
+        for name, size in sizes.items():
+            path = self._file(name)
+            with open(path, "ab") as fh:
+                if fh.tell() != size:
+                    if fh.tell() < size:
+                        raise ValueError(f"mirror file {name} is shorter than meta says")
+                    fh.truncate(size)
+
+    def _append(self, meta: dict, fixed: dict[str, np.ndarray], text: dict[str, list[bytes]]) -> None:
+        for k, arr in fixed.items():
+            with open(self._file(f"{k}.bin"), "ab") as fh:
+                fh.write(arr.tobytes())
+        for k, values in text.items():
+            self._append_text(meta, k, values, positions=None)
+        meta["rows"] += len(fixed["id"])
+        meta["last_id"] = int(fixed["id"][-1])
+
+    def _append_text(self, meta: dict, col: str, values: list[bytes], positions: np.ndarray | None) -> None:
+        """Дописать строки в .blob; смещения/длины — в конец (positions=None) или на место."""
+        lens = np.fromiter((len(v) for v in values), dtype=_LEN, count=len(values))
+        offs = np.empty(len(values), dtype=_OFF)
+        offs[:1] = meta["blob"][col]
+        np.cumsum(lens[:-1], out=offs[1:])
+        offs[1:] += meta["blob"][col]
+        with open(self._file(f"{col}.blob"), "ab") as fh:
+            fh.write(b"".join(values))
+        meta["blob"][col] += int(lens.sum())
+        if positions is None:
+            with open(self._file(f"{col}.off"), "ab") as fh:
+                fh.write(offs.tobytes())
+            with open(self._file(f"{col}.len"), "ab") as fh:
+                fh.write(lens.tobytes())
+        else:
+            # размер .blob фиксируем до правки смещений: обрезка при сбое не оставит их «в пустоте»
+            self._save_meta(meta)
+            self._patch(f"{col}.off", _OFF, meta["rows"], positions, offs)
+            self._patch(f"{col}.len", _LEN, meta["rows"], positions, lens)
+
+    def _patch(self, name: str, dtype: np.dtype, rows: int, positions: np.ndarray, values: np.ndarray) -> None:
+        mm = np.memmap(self._file(name), dtype=dtype, mode="r+", shape=(rows,))
+        mm[positions] = values
+        mm.flush()
+        del mm
+
+    def _rewrite(self, meta: dict, ids: np.ndarray, fixed: dict[str, np.ndarray], text: dict[str, list[bytes]]) -> bool:
+        """Переписать изменённые строки на месте. False — какой-то id в зеркале не найден."""
+        positions = np.searchsorted(ids, fixed["id"])
+        if (positions >= len(ids)).any() or (ids[np.minimum(positions, len(ids) - 1)] != fixed["id"]).any():
+            return False
+        for k, arr in fixed.items():
+            if k != "id":
+                self._patch(f"{k}.bin", _FIXED[k], meta["rows"], positions, arr)
+        for k, values in text.items():
+            # старые байты остаются мусором в .blob до пересборки
+            self._append_text(meta, k, values, positions=positions)
+        return True
+
+    # ---- синхронизация
+
+    async def sync(self, session) -> dict:
+        """Догнать БД: новые карточки дописать, изменённые переписать. Возвращает meta для MirrorSnapshot."""
+        async with self._lock:
+            t0 = time.perf_counter()
+            try:
+                meta = await self._sync(session)
+            except (OSError, ValueError):
+                # испорченные/чужие файлы зеркала
+                logger.exception("Contact mirror sync failed, rebuilding")
+                meta = await self._rebuild(session)
+            dt = time.perf_counter() - t0
+            self.syncs += 1
+            self.sync_seconds_max = max(self.sync_seconds_max, dt)
+            return meta
+
+    async def rebuild(self, session) -> dict:
+        """Полная пересборка зеркала с нуля."""
+        async with self._lock:
+            return await self._rebuild(session)
+
+    async def _rebuild(self, session) -> dict:
+        self.rebuilds += 1
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+        return await self._sync(session, meta=self._empty_meta())
+
+    async def _sync(self, session, meta: dict | None = None) -> dict:
+        from ..repo import iter_contacts_after, iter_contacts_updated, count_contacts, agents_directory
+
+        meta = meta if meta is not None else self.meta()
+        self._truncate(meta)
+        last_updated = datetime.fromisoformat(meta["last_updated"]) if meta["last_updated"] else None
+
+        if meta["rows"]:
+            if await count_contacts(session, max_id=meta["last_id"]) != meta["rows"]:
+                logger.info("Contacts were deleted since last mirror sync, rebuilding")
+                return await self._rebuild(session)
+            if last_updated is not None:
+                ids = np.fromfile(self._file("id.bin"), dtype=_FIXED["id"], count=meta["rows"])
+                async for part in iter_contacts_updated(
+                    session, since=last_updated - _UPDATED_SLACK, max_id=meta["last_id"],
+                ):
+                    fixed, text = _encode(part)
+                    if not self._rewrite(meta, ids, fixed, text):
+                        logger.info("Updated contact missing from mirror, rebuilding")
+                        return await self._rebuild(session)
+                    self._save_meta(meta)
+                    self.rewritten += len(part)
+                    last_updated = _latest(last_updated, part)
+
+        async for part in iter_contacts_after(session, meta["last_id"]):
+            fixed, text = _encode(part)
+            self._append(meta, fixed, text)
+            # meta после каждой пачки: оборванная синхронизация оставляет целое (короче) зеркало
+            self._save_meta(meta)
+            self.appended += len(part)
+            last_updated = _latest(last_updated, part)
+
+        agents = await agents_directory(session)
+        tmp = self._file(_AGENTS + ".tmp")
+        tmp.write_text(json.dumps({str(k): v for k, v in agents.items()}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self._file(_AGENTS))
+
+        meta["last_updated"] = last_updated.isoformat() if last_updated else None
+        self._save_meta(meta)
+        return meta
+
+    # ---- сверка
+
+    async def check(self, session) -> list[tuple[str, int, int]]:
+        """Сверить контрольные суммы колонок с SQL: [(колонка, в БД, в зеркале)] для расхождений."""
+        from ..repo import contacts_checksum
+
+        async with self._lock:
+            expected = await contacts_checksum(session)
+            actual = MirrorSnapshot(self.root, self.meta()).checksum()
+        return [(k, v, actual.get(k, 0)) for k, v in expected.items() if actual.get(k, 0) != v]
+
+    def stats(self) -> dict:
+        meta = self.meta()
+        return {
+            "rows": meta["rows"],
+            "last_id": meta["last_id"],
+            "syncs": self.syncs,
+            "rebuilds": self.rebuilds,
+            "appended": self.appended,
+            "rewritten": self.rewritten,
+            "sync_max_s": round(self.sync_seconds_max, 2),
+        }
+
+
+# ---------- чтение ----------
+
+class MirrorSnapshot:
+    """Зеркало на момент meta (только чтение, memmap). Годится для процесса export_pool."""
+
+    def __init__(self, root: str | Path, meta: dict) -> None:
+        root = Path(root)
+        self.rows = rows = meta["rows"]
+        self.cols = {k: _map(root / f"{k}.bin", dt, rows) for k, dt in _FIXED.items()}
+        self._text = {
+            k: (_map(root / f"{k}.off", _OFF, rows), _map(root / f"{k}.len", _LEN, rows),
+                _map(root / f"{k}.blob", np.dtype("u1"), meta["blob"][k]))
+            for k in _TEXT
+        }
+        try:
+            raw = json.loads((root / _AGENTS).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            raw = {}
+        # id -> (tg_user_id, username, name)
+        self.agents: dict[int, tuple] = {int(k): tuple(v) for k, v in raw.items()}
+
+    def select(
+        self, *, since: datetime | None = None, after_id: int | None = None, upto_id: int | None = None,
+    ) -> np.ndarray:
+        """
+        Позиции строк периода (created >= since) с id в (after_id, upto_id], от новых к старым
+        (при равенстве — больший id раньше). Строки лежат по возрастанию id: диапазон — searchsorted.
+        """
+        ids, created = self.cols["id"], self.cols["created"]
+        lo = 0 if after_id is None else int(np.searchsorted(ids, after_id, side="right"))
+        hi = self.rows if upto_id is None else int(np.searchsorted(ids, upto_id, side="right"))
+        idx = np.arange(lo, max(lo, hi))
+        if since is not None:
+            idx = idx[created[idx] >= to_us(since)]
+        order = np.lexsort((-ids[idx], -created[idx]))
+        return idx[order]
+
+    def agent_ids(self, idx: np.ndarray) -> np.ndarray:
+        """agent_id строк; агенты, которых нет в справочнике (удалены), — 0, как у outer join."""
+        agent = self.cols["agent"][idx].astype(np.int64)
+        if len(agent):
+            agent[~np.isin(agent, np.fromiter(self.agents, dtype=np.int64, count=len(self.agents)))] = 0
+        return agent
+
+    def cube(self, idx: np.ndarray) -> list[tuple]:
+        """
+        Счётчики по (agent_id, повторность, статус, флаер, надомка) для строк idx:
+        [(agent_id | None, RepeatTouch | None, TalkStatus | None, FlyerMethod | None, bool, n)].
+        """
+        c = self.cols
+        key = self.agent_ids(idx)
+        for col, base in (("repeat", len(REPEATS)), ("status", len(STATUSES)), ("method", len(METHODS)), ("home", 2)):
+            key = key * base + c[col][idx]
+        uniq, counts = np.unique(key, return_counts=True)
+        out = []
+        for k, n in zip(uniq.tolist(), counts.tolist()):
+            k, home = divmod(k, 2)
+            k, method = divmod(k, len(METHODS))
+            k, status = divmod(k, len(STATUSES))
+            agent_id, repeat = divmod(k, len(REPEATS))
+            out.append((agent_id or None, REPEATS[repeat], STATUSES[status], METHODS[method], bool(home), n))
+        return out
+
+    def text(self, col: str, idx: np.ndarray) -> list[str]:
+        """Значения строковой колонки для строк idx."""
+        off, lens, blob = self._text[col]
+        offs, ns = off[idx].astype(np.int64), lens[idx].astype(np.int64)
+        if not len(idx):
+            return []
+        # одна выборка байтов всей пачки из .blob вместо среза на строку
+        ends = np.cumsum(ns)
+        gather = np.arange(int(ends[-1]), dtype=np.int64) + np.repeat(offs - (ends - ns), ns)
+        data = np.asarray(blob)[gather].tobytes()
+        bounds = [0, *ends.tolist()]
+        return [data[bounds[i]:bounds[i + 1]].decode() for i in range(len(idx))]
+
+    def checksum(self) -> dict[str, int]:
+        """Те же суммы, что repo.contacts_checksum."""
+        c = self.cols
+        out = {"rows": self.rows}
+        for k in ("id", "agent", "repeat", "status", "method", "home"):
+            out[k] = int(c[k].sum(dtype=np.int64))
+        out["created"] = int((c["created"] // 1_000_000).sum(dtype=np.int64))
+        for k in _TEXT:
+            out[k] = int(self._text[k][1].sum(dtype=np.int64))
+        return out
+
+
+def _map(path: Path, dtype: np.dtype, count: int) -> np.ndarray:
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+contact_mirror = ContactMirror()
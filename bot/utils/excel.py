@@ -6,17 +6,34 @@
 - смешанные типы колонок,
 - предупреждения GroupBy.apply,
 - «кривая» шапка и автоширина.
+
+Выгрузка потоковая: хендлер только догоняет колоночное зеркало contact
+(utils.contact_mirror), а render_export в процессе utils.export_pool читает его:
+счётчики summary/pivot считаются векторно (ExportCounters из «куба»), строки
+пачками собираются сразу колонками (export_columns) и идут через ExportSpool в CSV
+на диске и потоком в лист data write-only книгой — память не зависит от числа
+строк, event loop бота не занят.
+
+Дельта-выгрузка (render_delta_export) берёт из зеркала только диапазон id после
+водяного знака администратора; в свойствах книги (keywords) остаётся отметка
+диапазона «contact_id:A-B», по которой режим дописывания продолжает прошлую книгу.
 """
 
 from __future__ import annotations
 
-from typing import Iterable, List, Dict, Any, Tuple
+import csv
+import traceback
+from typing import Iterable, Iterator, List, Dict, Any, Tuple
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from ..models import Contact, Agent, RepeatTouch, TalkStatus, FlyerMethod
+from ..config import EXPORT_CHUNK_SIZE
+from ..models import RepeatTouch, TalkStatus, FlyerMethod
+from .contact_mirror import MirrorSnapshot, REPEATS, STATUSES, METHODS
 
 
 RU_COLUMNS = {
@@ -40,67 +57,369 @@ DATA_ORDER = [
 ]
 
 
-def rows_to_dataframe(rows: Iterable[Tuple[Contact, Agent]]) -> pd.DataFrame:
-    """Сырые строки -> DataFrame с русскими заголовками (лист data)."""
-    data: List[Dict[str, Any]] = []
-    for contact, agent in rows:
-        username = getattr(agent, "username", None) if agent else None
-        if username and not str(username).startswith("@"):
-            username = f"@{username}"
-        created = contact.created_at
-        if isinstance(created, datetime):
-            created = created.replace(microsecond=0)
-        data.append({
-            "agent_id": getattr(agent, "id", None) if agent else None,
-            "agent_tg": getattr(agent, "tg_user_id", None) if agent else None,
-            "agent_username": username,
-            "agent_name": getattr(agent, "name", None) if agent else None,
-            "full_name": contact.full_name,
-            "phone": contact.phone_e164,
-            "repeat_touch": _map_repeat(contact.repeat_touch),
-            "talk_status": _map_status(contact.talk_status),
-            "flyer_method": _map_method(contact.flyer_method),
-            "flyer_number": contact.flyer_number or "",
-            "home_voting": "Да" if bool(contact.home_voting) else "Нет",
-            "created_at": created,
-        })
-    df = pd.DataFrame(data)
-    df = df.reindex(columns=[c for c in DATA_ORDER if c in df.columns])
-    df = df.rename(columns={k: v for k, v in RU_COLUMNS.items() if k in df.columns})
-    return df
-
-
-def write_excel_with_pivot(df: pd.DataFrame, path: str) -> None:
-    """Пишет 4 листа: data, summary, pivot_multi, pivot_flat."""
-    out_path = Path(path).as_posix()
-    with pd.ExcelWriter(out_path, engine="openpyxl") as writer:
-        # data
-        df.to_excel(writer, index=False, sheet_name="data")
-        try:
-            ws_data = writer.book["data"]; ws_data.freeze_panes = "A2"; _autosize(ws_data)
-        except Exception: pass
-
-        # summary
-        summary = _build_summary(df)
-        summary.to_excel(writer, index=False, sheet_name="summary")
-        try:
-            ws_sum = writer.book["summary"]; ws_sum.freeze_panes = "A2"; _autosize(ws_sum)
-        except Exception: pass
-
-        # pivots
-        p_multi, p_flat = _build_pivots(df)
-        p_multi.to_excel(writer, sheet_name="pivot_multi")
-        try:
-            ws = writer.book["pivot_multi"]; _style_pivot(ws)
-        except Exception: pass
-
-        p_flat.to_excel(writer, index=False, sheet_name="pivot_flat")
-        try:
-            ws2 = writer.book["pivot_flat"]; ws2.freeze_panes = "C2"; _autosize(ws2)
-        except Exception: pass
+# значения колонок статуса/флаера в порядке колонок сводных листов
+PIVOT_STATUSES = ["Никого нет", "Отказ", "Согласие"]
+PIVOT_REPEATS = ["Первичное", "Повторное"]
+PIVOT_METHODS = ["В ящик", "На руки", "Нет"]
+# (группа, подзаголовок) колонок pivot_multi после «ID агента» и «Логин (@)»
+PIVOT_COLUMNS = (
+    [(st, rt) for st in PIVOT_STATUSES for rt in PIVOT_REPEATS]
+    + [("Флаеры", fm) for fm in PIVOT_METHODS]
+    + [("Итого", "")]
+)
+SUMMARY_COLUMNS = [
+    "ID агента", "Логин (@)", "Имя агента",
+    "Всего карточек", "Согласие", "Отказ", "Никого нет",
+    "Флаер на руки", "Флаер в ящик", "Флаер нет", "Голосование на дому (Да)",
+]
+
+_STATUS_IDX = {v: i for i, v in enumerate(PIVOT_STATUSES)}
+_REPEAT_IDX = {v: i for i, v in enumerate(PIVOT_REPEATS)}
+_METHOD_IDX = {v: i for i, v in enumerate(PIVOT_METHODS)}
+# позиции счётчиков summary (после «Всего карточек»)
+_SUMMARY_STATUS = {"Согласие": 1, "Отказ": 2, "Никого нет": 3}
+_SUMMARY_METHOD = {"На руки": 4, "В ящик": 5, "Нет": 6}
+
+# колонки листа data (позиции в DATA_ORDER): целые ID и дата создания
+_NUMERIC_COLS = (0, 1)
+_CREATED_COL = 11
+# сколько строк таблицы смотреть для автоширины (_frame_lens)
+_WIDTH_SAMPLE = 20_000
+# отметка диапазона id дельта-выгрузки в свойствах книги
+_RANGE_TAG = "contact_id:"
+
+
+def _username(username):
+    if username and not str(username).startswith("@"):
+        return f"@{username}"
+    return username
+
+
+class _AgentColumns:
+    """Справочник агентов зеркала -> массивы (TG ID, логин с @, имя) для векторной подстановки по agent_id."""
+
+    def __init__(self, agents: Dict[int, Tuple]):
+        self.ids = np.array(sorted(agents), dtype=np.int64)
+        # позиция 0 — «без агента»
+        self.tg = np.array([None] + [agents[k][0] for k in self.ids.tolist()], dtype=object)
+        self.username = np.array([None] + [_username(agents[k][1]) for k in self.ids.tolist()], dtype=object)
+        self.name = np.array([None] + [agents[k][2] for k in self.ids.tolist()], dtype=object)
+
+    def positions(self, agent: np.ndarray) -> np.ndarray:
+        pos = np.searchsorted(self.ids, agent) + 1
+        pos[agent == 0] = 0
+        return pos
+
+
+def export_columns(snap: MirrorSnapshot, part: np.ndarray, agents: _AgentColumns) -> List[List[Any]]:
+    """
+    Строки зеркала part -> колонки листа data (порядок DATA_ORDER) без построчного маппинга:
+    коды перечислений — через таблицы подписей, агенты — через _AgentColumns.
+    Дата создания — строкой «ГГГГ-ММ-ДД чч:мм:сс» (тип восстанавливает ExportSpool.iter_data_rows).
+    """
+    c = snap.cols
+    repeat_labels, status_labels, method_labels = _label_tables()
+    agent = snap.agent_ids(part)
+    pos = agents.positions(agent)
+    # дата — сразу строкой, как её пишет csv (str(datetime) без микросекунд)
+    created = np.char.replace(
+        np.datetime_as_string((c["created"][part] // 1_000_000).astype("datetime64[s]"), unit="s"), "T", " ",
+    )
+    return [
+        [a or None for a in agent.tolist()],
+        agents.tg[pos].tolist(),
+        agents.username[pos].tolist(),
+        agents.name[pos].tolist(),
+        snap.text("full_name", part),
+        snap.text("phone", part),
+        repeat_labels[c["repeat"][part]].tolist(),
+        status_labels[c["status"][part]].tolist(),
+        method_labels[c["method"][part]].tolist(),
+        snap.text("flyer", part),
+        np.where(c["home"][part] == 1, "Да", "Нет").tolist(),
+        created.tolist(),
+    ]
+
+
+class ExportCounters:
+    """
+    Счётчики листов summary/pivot по агентам. Наполняются из «куба» — уже посчитанных
+    групп (агент × повторность × статус × флаер × надомка -> число строк), а не по строке.
+    """
+
+    def __init__(self):
+        # (ID, логин, имя) -> [всего, согласие, отказ, никого, на руки, в ящик, нет, надомка]
+        self._summary: Dict[Tuple, List[int]] = {}
+        # (ID, логин) -> [статус×повторность (6), флаеры (3), итого]
+        self._pivot: Dict[Tuple, List[int]] = {}
+
+    def add_cube(self, cube: Iterable[Tuple], agents: Dict[int, Tuple]) -> None:
+        """cube: (agent_id, повторность, статус, флаер, надомка, n); agents: id -> (tg, username, name)."""
+        for agent_id, repeat_touch, talk_status, flyer_method, home_voting, n in cube:
+            _, username, agent_name = agents.get(agent_id, (None, None, None)) if agent_id else (None, None, None)
+            username = _username(username)
+            repeat_touch = _map_repeat(repeat_touch)
+            talk_status = _map_status(talk_status)
+            flyer_method = _map_method(flyer_method)
+
+            s = self._summary.get((agent_id, username, agent_name))
+            if s is None:
+                s = self._summary[(agent_id, username, agent_name)] = [0] * 8
+            s[0] += n
+            if talk_status in _SUMMARY_STATUS:
+                s[_SUMMARY_STATUS[talk_status]] += n
+            if flyer_method in _SUMMARY_METHOD:
+                s[_SUMMARY_METHOD[flyer_method]] += n
+            if home_voting:
+                s[7] += n
+
+            p = self._pivot.get((agent_id, username))
+            if p is None:
+                p = self._pivot[(agent_id, username)] = [0] * 10
+            if talk_status in _STATUS_IDX and repeat_touch in _REPEAT_IDX:
+                p[_STATUS_IDX[talk_status] * 2 + _REPEAT_IDX[repeat_touch]] += n
+            if flyer_method in _METHOD_IDX:
+                p[6 + _METHOD_IDX[flyer_method]] += n
+            p[9] += n
+
+    def summary_rows(self) -> List[Tuple]:
+        """Лист summary: по строке на (ID, логин, имя), сортировка по ID и логину."""
+        rows = [(*key, *counts) for key, counts in self._summary.items()]
+        rows.sort(key=lambda r: _sort_key(r[0], r[1]))
+        return rows
+
+    def pivot_rows(self) -> List[Tuple]:
+        """Сводные листы: по строке на (ID, логин), колонки — PIVOT_COLUMNS."""
+        return sorted(((*key, *counts) for key, counts in self._pivot.items()),
+                      key=lambda r: _sort_key(r[0], r[1]))
+
+
+class ExportSpool:
+    """
+    Приёмник потоковой выгрузки. Строки сразу уходят в CSV на диске (он же CSV-выгрузка
+    и источник листа data для XLSX); в памяти — только ширины колонок.
+    """
+
+    def __init__(self, csv_path: str):
+        self.csv_path = csv_path
+        self.total = 0
+        self.widths = [len(RU_COLUMNS[c]) for c in DATA_ORDER]
+        self._fh = open(csv_path, "w", encoding="utf-8-sig", newline="")
+        self._csv = csv.writer(self._fh, lineterminator="\n")
+        self._csv.writerow([RU_COLUMNS[c] for c in DATA_ORDER])
+
+    def add_columns(self, cols: List[List[Any]]) -> None:
+        """Пачка в виде колонок (export_columns): CSV одной writerows, ширины — по колонке целиком."""
+        self._csv.writerows(zip(*cols))
+        self.total += len(cols[0])
+        widths = self.widths
+        for i, col in enumerate(cols):
+            if i in _NUMERIC_COLS:
+                top = max(filter(None, col), default=None)  # ID положительные: самый длинный — максимальный
+                n = len(str(top)) if top is not None else 0
+            elif i == _CREATED_COL:
+                n = len(str(col[0])) if col else 0
+            else:
+                n = max(map(len, filter(None, col)), default=0)
+            if n > widths[i]:
+                widths[i] = n
+
+    def add_rows(self, rows: Iterable[Iterable[Any]]) -> None:
+        """Готовые строки листа data (например, из прошлой книги): даты — в том же виде, что у export_columns."""
+        widths = self.widths
+        for row in rows:
+            row = ["" if v is None else v.strftime("%Y-%m-%d %H:%M:%S") if isinstance(v, datetime) else v
+                   for v in row]
+            self._csv.writerow(row)
+            self.total += 1
+            for i, v in enumerate(row):
+                n = len(str(v))
+                if n > widths[i]:
+                    widths[i] = n
+
+    def close(self) -> None:
+        if not self._fh.closed:
+            self._fh.close()
+
+    def iter_data_rows(self) -> Iterator[List[Any]]:
+        """Строки листа data из CSV (после close) с восстановленными типами."""
+        with open(self.csv_path, encoding="utf-8-sig", newline="") as fh:
+            reader = csv.reader(fh)
+            next(reader, None)
+            for row in reader:
+                out: List[Any] = [v if v != "" else None for v in row]
+                for i in (0, 1):
+                    if out[i] is not None:
+                        out[i] = int(out[i])
+                if out[11] is not None:
+                    out[11] = datetime.fromisoformat(out[11])
+                yield out
+
+
+def write_excel_with_pivot(
+    spool: ExportSpool, counters: ExportCounters, path: str, *, id_range: Tuple[int, int] | None = None,
+) -> None:
+    """
+    Пишет 4 листа: data, summary, pivot_multi, pivot_flat — write-only книгой openpyxl.
+    Лист data идёт потоком из CSV спула, сводные — из счётчиков.
+    id_range — диапазон contact.id дельта-выгрузки, сохраняется в свойствах книги.
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    st = _Styles(wb)
+    if id_range is not None:
+        wb.properties.keywords = f"{_RANGE_TAG}{id_range[0]}-{id_range[1]}"
+
+    # data
+    ws = wb.create_sheet("data")
+    _set_widths(ws, [min(max(10, w + 2), 40) for w in spool.widths])
+    ws.freeze_panes = "A2"
+    ws.append([st.header(ws, RU_COLUMNS[c]) for c in DATA_ORDER])
+    for row in spool.iter_data_rows():
+        ws.append(row)
+
+    _write_pivot_sheets(wb, counters, st)
+    wb.save(Path(path).as_posix())
+
+
+def write_pivot_sheets(cube: List[Tuple], agents: Dict[int, Tuple], path: str) -> None:
+    """
+    Только сводные листы (summary, pivot_multi, pivot_flat) по готовому «кубу» счётчиков
+    (repo.contact_cube или MirrorSnapshot.cube) — строки contact не нужны.
+    """
+    from openpyxl import Workbook
+
+    counters = ExportCounters()
+    counters.add_cube(cube, agents)
+    wb = Workbook(write_only=True)
+    _write_pivot_sheets(wb, counters, _Styles(wb))
+    wb.save(Path(path).as_posix())
+
+
+def _write_pivot_sheets(wb, counters: ExportCounters, st: _Styles) -> None:
+    _write_flat(wb, "summary", SUMMARY_COLUMNS, counters.summary_rows(), "A2", st)
+    pivot = counters.pivot_rows()
+    _write_pivot_multi(wb, pivot, st)
+    flat_header = ["ID агента", "Логин (@)"] + [" | ".join(x for x in c if x) for c in PIVOT_COLUMNS]
+    _write_flat(wb, "pivot_flat", flat_header, pivot, "C2", st)
+
+
+def render_export(
+    mirror_root: str,
+    meta: Dict,
+    since: datetime | None,
+    csv_path: str,
+    xlsx_path: str | None,
+) -> Tuple[int, str | None, str | None]:
+    """
+    Рендер выгрузки в процессе пула: зеркало contact (состояние meta, строки с created >= since)
+    -> CSV и, если задан xlsx_path, XLSX. Возвращает (строк, ошибка XLSX, traceback).
+    При ошибке XLSX остаётся готовый CSV.
+    """
+    snap = MirrorSnapshot(mirror_root, meta)
+    idx = snap.select(since=since)
+    spool = ExportSpool(csv_path)
+    try:
+        agents = _AgentColumns(snap.agents)
+        for start in range(0, len(idx), EXPORT_CHUNK_SIZE):
+            spool.add_columns(export_columns(snap, idx[start:start + EXPORT_CHUNK_SIZE], agents))
+    finally:
+        spool.close()
+    if xlsx_path is None:
+        return spool.total, None, None
+    try:
+        counters = ExportCounters()
+        counters.add_cube(snap.cube(idx), snap.agents)
+        write_excel_with_pivot(spool, counters, xlsx_path)
+    except Exception as e:
+        return spool.total, str(e), traceback.format_exc()
+    return spool.total, None, None
+
+
+def read_id_range(path: str) -> Tuple[int, int] | None:
+    """Диапазон contact.id из свойств книги дельта-выгрузки; None — книга не из дельта-выгрузки."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(Path(path).as_posix(), read_only=True)
+    try:
+        tag = wb.properties.keywords or ""
+    finally:
+        wb.close()
+    if not tag.startswith(_RANGE_TAG):
+        return None
+    first, _, last = tag[len(_RANGE_TAG):].partition("-")
+    return int(first), int(last)
+
+
+def _iter_book_rows(path: str) -> Iterator[Tuple]:
+    """Строки листа data прошлой книги (без шапки); шапка должна совпадать с текущей."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(Path(path).as_posix(), read_only=True)
+    try:
+        if "data" not in wb.sheetnames:
+            raise ValueError("в книге нет листа data")
+        rows = wb["data"].iter_rows(values_only=True)
+        if list(next(rows, ())) != [RU_COLUMNS[c] for c in DATA_ORDER]:
+            raise ValueError("шапка листа data не совпадает с текущей выгрузкой")
+        for row in rows:
+            yield row[:len(DATA_ORDER)]
+    finally:
+        wb.close()
+
+
+def render_delta_export(
+    mirror_root: str,
+    meta: Dict,
+    after_id: int,
+    csv_path: str,
+    xlsx_path: str | None,
+    base_path: str | None = None,
+) -> Tuple[int, int, int, str | None, str | None]:
+    """
+    Дельта-выгрузка в процессе пула: строки зеркала с id в (after_id, upto], где upto — последний id
+    зеркала (карточка попадает в contact уже закрытой, id растут в порядке коммитов). С base_path (книга прошлой дельта-выгрузки) after_id
+    берётся из её отметки, а её строки дописываются в лист data после новых; сводные считаются
+    по всему диапазону книги (текущее состояние карточек).
+    Возвращает (новых строк, строк всего, upto, ошибка XLSX, traceback).
+    """
+    snap = MirrorSnapshot(mirror_root, meta)
+    first = after_id + 1
+    if base_path is not None:
+        id_range = read_id_range(base_path)
+        if id_range is None:
+            raise ValueError("это не книга дельта-выгрузки (нет отметки диапазона)")
+        first, after_id = id_range
+    upto = max(meta["last_id"], after_id)
+    idx = snap.select(after_id=after_id, upto_id=upto)
+    if not len(idx):
+        return 0, 0, upto, None, None
+    spool = ExportSpool(csv_path)
+    try:
+        agents = _AgentColumns(snap.agents)
+        for start in range(0, len(idx), EXPORT_CHUNK_SIZE):
+            spool.add_columns(export_columns(snap, idx[start:start + EXPORT_CHUNK_SIZE], agents))
+        if base_path is not None:
+            spool.add_rows(_iter_book_rows(base_path))
+    finally:
+        spool.close()
+    if xlsx_path is None:
+        return len(idx), spool.total, upto, None, None
+    try:
+        counters = ExportCounters()
+        span = idx if base_path is None else snap.select(after_id=first - 1, upto_id=upto)
+        counters.add_cube(snap.cube(span), snap.agents)
+        write_excel_with_pivot(spool, counters, xlsx_path, id_range=(first, upto))
+    except Exception as e:
+        return len(idx), spool.total, upto, str(e), traceback.format_exc()
+    return len(idx), spool.total, upto, None, None
 
 
 def write_admin_summary(stats: List[Dict], path: str) -> None:
+    """Сводка по всем агентам (лист summary) write-only книгой; ширины — по длинам значений колонок."""
+    from openpyxl import Workbook
+
     df = pd.DataFrame(stats, columns=[
         "agent_id","agent_tg","agent_username","agent_name",
         "total","consent","refusal","no_one","hand","mailbox","none","home_yes"
@@ -110,162 +429,152 @@ def write_admin_summary(stats: List[Dict], path: str) -> None:
         "total":"Всего карточек","consent":"Согласие","refusal":"Отказ","no_one":"Никого нет",
         "hand":"Флаер на руки","mailbox":"Флаер в ящик","none":"Флаер нет","home_yes":"Голосование на дому (Да)"
     })
-    with pd.ExcelWriter(path, engine="openpyxl") as w:
-        df.to_excel(w, index=False, sheet_name="summary")
-        try:
-            ws = w.book["summary"]; ws.freeze_panes = "A2"; _autosize(ws)
-        except Exception: pass
+    wb = Workbook(write_only=True)
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    _write_flat(wb, "summary", list(df.columns), rows, "A2", _Styles(wb), lens=_frame_lens(df))
+    wb.save(Path(path).as_posix())
 
 
 # ---------- helpers ----------
 
-def _build_summary(df: pd.DataFrame) -> pd.DataFrame:
-    """Плоская сводка по агентам без GroupBy.apply предупреждений."""
-    if df.empty:
-        return pd.DataFrame(columns=[
-            "ID агента","Логин (@)","Имя агента",
-            "Всего карточек","Согласие","Отказ","Никого нет",
-            "Флаер на руки","Флаер в ящик","Флаер нет","Голосование на дому (Да)"
-        ])
-
-    # Счётчики через agg по Series — без future warning
-    g = df.groupby(["ID агента","Логин (@)","Имя агента"], dropna=False, sort=False)
-
-    res = g.agg(
-        **{
-            "Всего карточек": ("ФИО избирателя", "size"),
-            "Согласие": ("Статус общения", lambda s: (s == "Согласие").sum()),
-            "Отказ": ("Статус общения", lambda s: (s == "Отказ").sum()),
-            "Никого нет": ("Статус общения", lambda s: (s == "Никого нет").sum()),
-            "Флаер на руки": ("Способ передачи флаера", lambda s: (s == "На руки").sum()),
-            "Флаер в ящик": ("Способ передачи флаера", lambda s: (s == "В ящик").sum()),
-            "Флаер нет": ("Способ передачи флаера", lambda s: (s == "Нет").sum()),
-            "Голосование на дому (Да)": ("Голосование на дому", lambda s: (s == "Да").sum()),
-        }
-    ).reset_index()
-
-    int_cols = ["Всего карточек","Согласие","Отказ","Никого нет","Флаер на руки","Флаер в ящик","Флаер нет","Голосование на дому (Да)"]
-    for c in int_cols:
-        res[c] = res[c].astype(int)
-
-    # стабильная сортировка
-    return res.sort_values(by=["ID агента","Логин (@)"], kind="mergesort")
-
-
-def _build_pivots(df: pd.DataFrame):
-    """Две сводные: многоуровневая и плоская. Нормализуем до 2-уровневых колонок и убираем дубли."""
-    from pandas import Categorical, MultiIndex, Index
-
-    if df.empty:
-        return pd.DataFrame([["Нет данных"]]), pd.DataFrame([["Нет данных"]])
-
-    data = df.copy()
-    data["Статус общения"] = Categorical(data["Статус общения"], categories=["Никого нет","Отказ","Согласие"], ordered=True)
-    data["Повторность"] = Categorical(data["Повторность"], categories=["Первичное","Повторное"], ordered=True)
-    data["Способ передачи флаера"] = Categorical(data["Способ передачи флаера"], categories=["В ящик","На руки","Нет"], ordered=True)
-
-    p_status = pd.pivot_table(
-        data, index=["ID агента","Логин (@)"], columns=["Статус общения","Повторность"],
-        values="ФИО избирателя", aggfunc="size", fill_value=0, dropna=False, observed=False
-    )
+def _sort_key(agent_id, username) -> Tuple:
+    # пустые ID/логины — в конец, как у pandas sort_values
+    return (agent_id is None, agent_id or 0, username is None, username or "")
+
+
+class _Styles:
+    """
+    Именованные стили книги: шапка и ячейки сводных таблиц регистрируются один раз,
+    ячейки ссылаются на них по имени. Тело листа data не оформляется.
+    """
+
+    HEADER = "export_header"
+    CELL = "export_cell"
+    CELL_LEFT = "export_cell_left"
+
+    def __init__(self, wb):
+        from openpyxl.styles import Alignment, Font, Border, Side, NamedStyle
+        from openpyxl.styles.fonts import DEFAULT_FONT
+        side = Side(style="thin")
+        thin = Border(left=side, right=side, top=side, bottom=side)
+        center = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        for name, font, alignment in (
+            (self.HEADER, Font(bold=True), center),
+            (self.CELL, DEFAULT_FONT, center),
+            (self.CELL_LEFT, DEFAULT_FONT, Alignment(vertical="center")),
+        ):
+            wb.add_named_style(NamedStyle(name=name, font=font, alignment=alignment, border=thin))
+
+    def header(self, ws, value):
+        from openpyxl.cell import WriteOnlyCell
+        cell = WriteOnlyCell(ws, value)
+        cell.style = self.HEADER
+        return cell
+
+    def body(self, ws, value, *, centered: bool):
+        from openpyxl.cell import WriteOnlyCell
+        cell = WriteOnlyCell(ws, value)
+        cell.style = self.CELL if centered else self.CELL_LEFT
+        return cell
+
+
+def _max_lens(rows: Iterable[Iterable[Any]], ncols: int) -> List[int]:
+    lens = [0] * ncols
+    for row in rows:
+        for i, v in enumerate(row):
+            if v is not None:
+                lens[i] = max(lens[i], len(str(v)))
+    return lens
+
+
+def _set_widths(ws, widths: List[int]) -> None:
+    from openpyxl.utils import get_column_letter
+    for i, w in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(i)].width = w
+
+
+def _frame_lens(df: pd.DataFrame) -> List[int]:
+    """
+    Длина самого длинного str(значения) по колонкам (с заголовком), пустые не считаются.
+    Векторно по колонке; у больших таблиц — по начальным строкам и случайной выборке.
+    """
+    if len(df) > _WIDTH_SAMPLE:
+        df = pd.concat([df.head(_WIDTH_SAMPLE // 2), df.sample(_WIDTH_SAMPLE // 2, random_state=0)])
+    lens = []
+    for name in df.columns:
+        values = df[name].dropna()
+        n = int(values.astype(str).str.len().max()) if len(values) else 0
+        lens.append(max(len(str(name)), n))
+    return lens
+
+
+def _write_flat(
+    wb, title: str, header: List[str], rows: Iterable[Tuple], freeze: str, st: _Styles,
+    *, lens: List[int] | None = None,
+) -> None:
+    """Плоский лист: жирная шапка, ширина колонки — по самому длинному значению (10..40)."""
+    ws = wb.create_sheet(title)
+    if lens is None:
+        rows = list(rows)
+        lens = _max_lens([header, *rows], len(header))
+    _set_widths(ws, [min(max(10, n + 2), 40) for n in lens])
+    ws.freeze_panes = freeze
+    ws.append([st.header(ws, v) for v in header])
+    for row in rows:
+        ws.append(list(row))
+
+
+def _write_pivot_multi(wb, rows: List[Tuple], st: _Styles) -> None:
+    """Двухуровневая шапка (группа / подзаголовок), рамки и центровка счётчиков, закреплены C3."""
+    ws = wb.create_sheet("pivot_multi")
+    top = ["ID агента", "Логин (@)"]
+    sub: List[Any] = [None, None]
+    prev = None
+    for group, name in PIVOT_COLUMNS:
+        top.append(group if group != prev else None)
+        sub.append(name or None)
+        prev = group
+    if not rows:
+        rows = [("Нет данных",)]
+    ncols = len(top)
+    lens = _max_lens([top, sub, *rows], ncols)
+    _set_widths(ws, [min(n + 2, 24) for n in lens])
+    ws.freeze_panes = "C3"
 
-    p_flyer = pd.pivot_table(
-        data, index=["ID агента","Логин (@)"], columns=["Способ передачи флаера"],
-        values="ФИО избирателя", aggfunc="size", fill_value=0, dropna=False, observed=False
+    # объединения: ID/логин/«Итого» на две строки, группы — на свои колонки
+    ws.merged_cells.add("A1:A2")
+    ws.merged_cells.add("B1:B2")
+    col = 3
+    while col <= ncols:
+        span = 1
+        while col + span <= ncols and top[col + span - 1] is None:
+            span += 1
+        if span > 1:
+            ws.merged_cells.add(f"{_col(col)}1:{_col(col + span - 1)}1")
+        elif sub[col - 1] is None:
+            ws.merged_cells.add(f"{_col(col)}1:{_col(col)}2")
+        col += span
+
+    ws.append([st.header(ws, v) for v in top])
+    ws.append([st.header(ws, v) for v in sub])
+    for row in rows:
+        ws.append([st.body(ws, v, centered=i >= 2) for i, v in enumerate(row)])
+
+
+def _col(idx: int) -> str:
+    from openpyxl.utils import get_column_letter
+    return get_column_letter(idx)
+
+
+@lru_cache(maxsize=None)
+def _label_tables() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Подписи по кодам зеркала (utils.contact_mirror): повторность, статус, флаер."""
+    return (
+        np.array([_map_repeat(v) for v in REPEATS], dtype=object),
+        np.array([_map_status(v) for v in STATUSES], dtype=object),
+        np.array([_map_method(v) for v in METHODS], dtype=object),
     )
 
-    # Приводим к int
-    p_status = p_status.astype(int) if not p_status.empty else p_status
-    p_flyer = p_flyer.astype(int) if not p_flyer.empty else p_flyer
-
-    # Группа «Флаеры» как MultiIndex
-    if not p_flyer.empty:
-        p_flyer.columns = MultiIndex.from_product([["Флаеры"], p_flyer.columns])
-
-    totals = data.groupby(["ID агента","Логин (@)"]).size()
-    # totals — всегда двухуровневый
-    totals.index = pd.MultiIndex.from_tuples(totals.index, names=["ID агента","Логин (@)"])
-    totals.name = ("Итого", "")
-
-    # Собираем
-    parts = [x for x in [p_status, p_flyer] if x is not None and not x.empty]
-    pivot = pd.concat(parts + [totals], axis=1).fillna(0)
-
-    # Нормализуем колонки в два уровня
-    if not isinstance(pivot.columns, MultiIndex):
-        pivot.columns = MultiIndex.from_tuples([(str(c), "") for c in pivot.columns])
-    elif pivot.columns.nlevels == 1:
-        pivot.columns = MultiIndex.from_tuples([(str(c), "") for c in pivot.columns])
-
-    # Схлопываем дубли колонок корректно (без смешения типов уровней)
-    if pivot.columns.duplicated().any():
-        pivot = pivot.T.groupby(level=[0, 1]).sum().T
-
-    pivot = pivot.astype(int)
-
-    # Красивый порядок колонок
-    plan = []
-    for st in ["Никого нет","Отказ","Согласие"]:
-        for rt in ["Первичное","Повторное"]:
-            plan.append((st, rt))
-    for fm in ["В ящик","На руки","Нет"]:
-        plan.append(("Флаеры", fm))
-    plan.append(("Итого",""))
-
-    ordered = [c for c in plan if c in pivot.columns]
-    tail = [c for c in pivot.columns if c not in ordered]
-    pivot = pivot.loc[:, ordered + tail]
-
-    # Плоская версия
-    p_flat = pivot.copy()
-    p_flat.columns = [" | ".join([str(x) for x in c if str(x)]) for c in p_flat.columns]
-    p_flat = p_flat.reset_index()
-
-    return pivot, p_flat
-
-
-def _autosize(ws) -> None:
-    from openpyxl.styles import Alignment, Font, Border, Side
-    center = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    bold = Font(bold=True)
-    thin = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
-    for c in range(1, ws.max_column + 1):
-        cell = ws.cell(row=1, column=c); cell.alignment = center; cell.font = bold; cell.border = thin
-    for col in ws.columns:
-        max_len = 0; col_letter = col[0].column_letter
-        for cell in col:
-            v = cell.value
-            l = len(str(v)) if v is not None else 0
-            if l > max_len: max_len = l
-        ws.column_dimensions[col_letter].width = min(max(10, max_len + 2), 40)
-
-
-def _style_pivot(ws) -> None:
-    from openpyxl.styles import Alignment, Font, Border, Side
-    max_col = ws.max_column; max_row = ws.max_row
-    if max_row >= 2:
-        ws.merge_cells(start_row=1, start_column=1, end_row=2, end_column=1)
-        ws.merge_cells(start_row=1, start_column=2, end_row=2, end_column=2)
-    center = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    left = Alignment(vertical="center")
-    bold = Font(bold=True)
-    thin = Border(left=Side(style="thin"), right=Side(style="thin"), top=Side(style="thin"), bottom=Side(style="thin"))
-    for r in (1, 2):
-        for c in range(1, max_col + 1):
-            cell = ws.cell(row=r, column=c); cell.alignment = center; cell.font = bold; cell.border = thin
-    for r in range(3, max_row + 1):
-        for c in range(1, max_col + 1):
-            cell = ws.cell(row=r, column=c); cell.alignment = center if c > 2 else left; cell.border = thin
-    for c in range(1, max_col + 1):
-        max_len = 0
-        for r in range(1, max_row + 1):
-            v = ws.cell(row=r, column=c).value
-            if v is None: continue
-            max_len = max(max_len, len(str(v)))
-        col_letter = ws.cell(row=1, column=c).column_letter
-        ws.column_dimensions[col_letter].width = min(max_len + 2, 24)
-    ws.freeze_panes = "C3"
-
 
 def _map_repeat(v: RepeatTouch | str | None) -> str:
     s = getattr(v, "value", v) or ""
@@ -0,0 +1,122 @@
+# bot/utils/export_pack.py
+"""
+Упаковка готовой выгрузки перед отправкой в Telegram.
+
+Файл потоком сжимается в zip (deflate) и, если архив больше EXPORT_PART_BYTES
+(у Bot API лимит на документ — 50 МБ), сразу режется на нумерованные части
+name.zip.001, name.zip.002, … без промежуточного целого архива. Части склеиваются
+обычным copy /b / cat; список частей с размерами и SHA-256 — в manifest_text().
+Функции уровня модуля: pack_export выполняется в процессе utils.export_pool.
+"""
+from __future__ import annotations
+
+import hashlib
+import html
+import shutil
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+
+_COPY_CHUNK = 1024 * 1024
+
+
+@dataclass
+class PackedPart:
+    path: str
+    size: int
+    sha256: str
+
+
+class _PartWriter:
+    """Файлоподобный приёмник: пишет в name.001, name.002, … по part_bytes байт (без seek — zip в потоковом режиме)."""
+
+    def __init__(self, base: Path, part_bytes: int):
+        self.base = base
+        self.part_bytes = part_bytes
+        self.parts: list[PackedPart] = []
+        self._pos = 0
+        self._fh = None
+        self._left = 0
+        self._hash = None
+
+    def _roll(self) -> None:
+        self._close_part()
+        path = self.base.with_name(f"{self.base.name}.{len(self.parts) + 1:03d}")
+        self._fh = open(path, "wb")
+        self._left = self.part_bytes
+        self._hash = hashlib.sha256()
+        self.parts.append(PackedPart(str(path), 0, ""))
+
+    def _close_part(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            part = self.parts[-1]
+            part.size = self.part_bytes - self._left
+            part.sha256 = self._hash.hexdigest()
+            self._fh = None
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        while view:
+            if self._fh is None or self._left == 0:
+                self._roll()
+            chunk = view[: self._left]
+            self._fh.write(chunk)
+            self._hash.update(chunk)
+            self._left -= len(chunk)
+            view = view[len(chunk):]
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        if self._fh is not None:
+            self._fh.flush()
+
+    def close(self) -> None:
+        self._close_part()
+
+
+def pack_export(src: str, part_bytes: int) -> tuple[list[PackedPart], int, int]:
+    """
+    src -> src.zip рядом с исходником; архив больше part_bytes — части src.zip.001, .002, …
+    Исходник удаляется. Возвращает (части по порядку, байт до сжатия, байт после).
+    """
+    src_path = Path(src)
+    raw = src_path.stat().st_size
+    base = src_path.with_name(src_path.name + ".zip")
+    out = _PartWriter(base, part_bytes)
+    try:
+        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            with open(src_path, "rb") as fh, zf.open(src_path.name, "w", force_zip64=True) as dst:
+                shutil.copyfileobj(fh, dst, _COPY_CHUNK)
+    finally:
+        out.close()
+    src_path.unlink()
+    parts = out.parts
+    if len(parts) == 1:
+        # одна часть — обычный .zip без номера
+        Path(parts[0].path).rename(base)
+        parts[0].path = str(base)
+    return parts, raw, sum(p.size for p in parts)
+
+
+def manifest_text(title: str, parts: list[PackedPart], raw: int) -> str:
+    """Сообщение-манифест для многотомной выгрузки: части, размеры, SHA-256 и как склеить."""
+    names = [Path(p.path).name for p in parts]
+    archive = names[0].rsplit(".", 1)[0]
+    lines = [f"🧾 <b>{html.escape(title)}</b> — частей: {len(parts)}, исходный файл {_mb(raw)}."]
+    for i, (name, p) in enumerate(zip(names, parts), 1):
+        lines.append(f"{i}. <code>{html.escape(name)}</code> — {_mb(p.size)}, SHA-256 <code>{p.sha256[:16]}…</code>")
+    lines.append(
+        "Склеить в архив:\n"
+        f"Windows: <code>copy /b {'+'.join(names)} {archive}</code>\n"
+        f"Linux/macOS: <code>cat {archive}.0* &gt; {archive}</code>"
+    )
+    return "\n".join(lines)
+
+
+def _mb(n: int) -> str:
+    return f"{n / 1024 / 1024:.1f} МБ"
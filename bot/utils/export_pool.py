@@ -0,0 +1,79 @@
+# bot/utils/export_pool.py
+"""
+Пул процессов для рендера выгрузок (CSV/XLSX, сводки).
+
+pandas/openpyxl-работа занимает CPU на секунды; в процессе бота она останавливала бы
+event loop для всех агентов. Хендлер только готовит данные (дозаливает зеркало
+contact, собирает цифры), а рендер уходит сюда: функции получают простые значения
+(пути, кортежи, словари) и возвращают результат, который можно передать через pickle.
+Открывается/закрывается в bot/main.py; счётчики — в stats().
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable
+
+from ..config import EXPORT_POOL_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class ExportPool:
+    """Ограниченный ProcessPoolExecutor (spawn: без унаследованных соединений и потоков бота)."""
+
+    def __init__(self, workers: int = EXPORT_POOL_WORKERS) -> None:
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+
+        self.jobs = 0
+        self.errors = 0
+        self.busy = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+
+    def start(self) -> None:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Выполнить fn(*args) в процессе пула; fn — функция уровня модуля."""
+        if self._pool is None:
+            self.start()
+        self.jobs += 1
+        self.busy += 1
+        t0 = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.busy -= 1
+            dt = time.perf_counter() - t0
+            self.seconds_total += dt
+            self.seconds_max = max(self.seconds_max, dt)
+            logger.debug("[export] %s took %.2f s", getattr(fn, "__name__", fn), dt)
+
+    def stats(self) -> dict:
+        return {
+            "jobs": self.jobs,
+            "errors": self.errors,
+            "busy": self.busy,
+            "seconds_avg": round(self.seconds_total / self.jobs, 2) if self.jobs else 0.0,
+            "seconds_max": round(self.seconds_max, 2),
+        }
+
+
+export_pool = ExportPool()
@@ -0,0 +1,42 @@
+# bot/utils/flyers.py
+from __future__ import annotations
+
+FLYER_MIN = 1
+FLYER_MAX = 60_000
+
+
+class FlyerBitmap:
+    """
+    Битовая карта занятых номеров флаеров в диапазоне FLYER_MIN..FLYER_MAX (~7.5 КБ).
+    Это только быстрый пре-фильтр: установленный бит = номер точно занят,
+    сброшенный бит ничего не гарантирует — решает атомарная вставка в flyer_claim.
+    """
+
+    def __init__(self, size: int = FLYER_MAX) -> None:
+        self._size = size
+        self._bits = bytearray(size // 8 + 1)
+        self.warmed = False
+
+    def _in_range(self, n: int) -> bool:
+        return FLYER_MIN <= n <= self._size
+
+    def __contains__(self, n: int) -> bool:
+        if not self._in_range(n):
+            return False
+        return bool(self._bits[n >> 3] & (1 << (n & 7)))
+
+    def add(self, n: int) -> None:
+        if self._in_range(n):
+            self._bits[n >> 3] |= 1 << (n & 7)
+
+    def discard(self, n: int) -> None:
+        if self._in_range(n):
+            self._bits[n >> 3] &= ~(1 << (n & 7)) & 0xFF
+
+    def clear(self) -> None:
+        self._bits = bytearray(self._size // 8 + 1)
+        self.warmed = False
+
+
+# общий для процесса экземпляр; прогревается при старте (repo.warm_flyer_bitmap)
+flyer_bitmap = FlyerBitmap()
@@ -0,0 +1,182 @@
+# bot/utils/query_plans.py
+"""
+Проверка планов запросов repo.py на полный проход по таблице.
+
+Каждый сценарий вызывает настоящие функции repo на временной засеянной базе (файл или
+":memory:" — tests/test_query_plans.py); все
+выполненные SELECT/UPDATE/DELETE перехватываются и прогоняются через EXPLAIN QUERY PLAN.
+Строка плана «SCAN <таблица>» без индекса — ошибка, если таблица не указана
+в разрешённых для сценария (например, выгрузка «за весь период» обязана читать всё).
+
+Запуск: python -m bot.cli query-plans
+"""
+from __future__ import annotations
+
+import os
+import re
+import tempfile
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from .. import models, repo
+from ..db import install_sqlite_hooks
+from ..migrations import run_migrations
+
+_TABLE_SCAN = re.compile(r"^SCAN (\w+)$")
+_CHECKED_VERBS = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+# сколько строк засеять (для выбора плана важны индексы, а не объём)
+SEED_AGENTS = 30
+SEED_CONTACTS = 600
+
+
+@dataclass
+class PlanProblem:
+    scenario: str
+    sql: str
+    plan: list[str] = field(default_factory=list)
+
+
+async def _seed(session: AsyncSession) -> None:
+    now = datetime.utcnow()
+    for i in range(1, SEED_AGENTS + 1):
+        session.add(models.Agent(id=i, tg_user_id=1000 + i, username=f"User{i}", name=f"Agent {i}"))
+    session.add(models.Visit(id=1, agent_id=1))
+    for i in range(SEED_CONTACTS):
+        created = now - timedelta(hours=i % 240)
+        session.add(models.Contact(
+            visit_id=1,
+            agent_id=1 + i % SEED_AGENTS,
+            full_name="Иванов Иван Иванович",
+            phone_e164="+79990000000",
+            phone_hash=repo.phone_hash("+79990000000"),
+            talk_status=list(models.TalkStatus)[i % 3],
+            flyer_method=list(models.FlyerMethod)[i % 3],
+            home_voting=bool(i % 2),
+            created_at=created,
+            closed_at=created if i % 5 else None,
+        ))
+    await session.flush()
+    for n in range(1, 50):
+        await repo.claim_flyer_number(session, n, None)
+    await repo.enqueue_lottery_webhook(session, contact_id=1, phone="+79990000000", code="1", voting_at_home=False)
+    await repo.add_brigadier(session, 1001)
+    await repo.set_brig_login(session, 1001, True)
+    for tg in (1002, 1003, 1004):
+        await repo.set_brig_member(session, 1001, tg)
+    await repo.block_member(session, member_tg_id=1005, blocked_by=1001)
+    await repo.rebuild_agent_day_stats(session)
+    await repo.rebuild_agent_day_cube(session)
+    await session.commit()
+
+
+async def _drain(parts) -> None:
+    async for _ in parts:
+        pass
+
+
+# (название, вызов, таблицы, которые сценарию разрешено читать целиком)
+Scenario = tuple[str, Callable[[AsyncSession], Awaitable[object]], frozenset[str]]
+
+SCENARIOS: list[Scenario] = [
+    ("get_or_create_agent", lambda s: repo.get_or_create_agent(s, 1001, name="Agent 1"), frozenset()),
+    ("get_access_flags", lambda s: repo.get_access_flags(s, 1001), frozenset()),
+    ("get_agent_by_username", lambda s: repo.get_agent_by_username(s, "@user7"), frozenset()),
+    ("close_visit", lambda s: repo.close_visit(s, 1), frozenset()),
+    ("save_contact", lambda s: repo.save_contact(
+        s, visit_id=1, agent_id=2, full_name="Петров Пётр Петрович", phone_e164="+79990000001",
+        created_at=datetime.utcnow(), talk_status="CONSENT", flyer_method="HAND", flyer_number=7,
+        home_voting=True), frozenset()),
+    ("close_abandoned_contacts", lambda s: repo.close_abandoned_contacts(
+        s, before=datetime.utcnow() - timedelta(hours=12), limit=100), frozenset()),
+    ("close_abandoned_visits", lambda s: repo.close_abandoned_visits(
+        s, before=datetime.utcnow() - timedelta(hours=12), limit=100), frozenset()),
+    ("flyer_exists", lambda s: repo.flyer_exists(s, 30_000), frozenset()),
+    ("release_flyer_number", lambda s: repo.release_flyer_number(s, 40), frozenset()),
+    ("get_next_flyer_number", lambda s: repo.get_next_flyer_number(s), frozenset()),
+    ("warm_flyer_bitmap", lambda s: repo.warm_flyer_bitmap(s), frozenset()),
+    ("list_due_webhooks", lambda s: repo.list_due_webhooks(s, limit=10, exclude_ids=[5]), frozenset()),
+    ("mark_webhook_sent", lambda s: repo.mark_webhook_sent(s, 1), frozenset()),
+    ("get_webhook_status", lambda s: repo.get_webhook_status(s, 1), frozenset()),
+    ("iter_contacts_after", lambda s: _drain(repo.iter_contacts_after(s, 500)), frozenset()),
+    ("iter_contacts_updated", lambda s: _drain(repo.iter_contacts_updated(
+        s, since=datetime.utcnow() - timedelta(minutes=5), max_id=500)), frozenset()),
+    ("count_contacts", lambda s: repo.count_contacts(s, max_id=500), frozenset()),
+    ("contacts_checksum", lambda s: repo.contacts_checksum(s), frozenset({"contact"})),
+    ("agents_directory", lambda s: repo.agents_directory(s), frozenset({"agent"})),
+    ("contact_cube(7)", lambda s: repo.contact_cube(s, days=7), frozenset()),
+    ("contact_cube(all)", lambda s: repo.contact_cube(s, days=None), frozenset({"agent_day_cube"})),
+    ("get_export_mark", lambda s: repo.get_export_mark(s, 1001), frozenset()),
+    ("set_export_mark", lambda s: repo.set_export_mark(s, 1001, 300), frozenset()),
+    ("export_watermark(7)", lambda s: repo.export_watermark(s, days=7), frozenset()),
+    ("export_watermark(all)", lambda s: repo.export_watermark(s, days=None), frozenset({"contact"})),
+    ("agent_stats_last24h", lambda s: repo.agent_stats_last24h(s, 3), frozenset()),
+    ("agents_stats_for_period(7)", lambda s: repo.agents_stats_for_period(s, 7), frozenset({"agent"})),
+    ("agents_stats_for_period(all)", lambda s: repo.agents_stats_for_period(s, None),
+     frozenset({"agent", "agent_day_stats"})),
+    ("agents_stats_for_period(agent)", lambda s: repo.agents_stats_for_period(s, 30, agent_ids=[3]), frozenset()),
+    ("brigade_stats_for_period", lambda s: repo.brigade_stats_for_period(s, 1001, 7), frozenset()),
+    ("is_brigadier_allowed", lambda s: repo.is_brigadier_allowed(s, 1001), frozenset()),
+    ("is_brig_logged_in", lambda s: repo.is_brig_logged_in(s, 1001), frozenset()),
+    ("is_member_blocked", lambda s: repo.is_member_blocked(s, 1005), frozenset()),
+    ("list_brigadiers", lambda s: repo.list_brigadiers(s), frozenset({"brigadiers", "brig_members"})),
+    ("remove_brig_member", lambda s: repo.remove_brig_member(s, 1001, 1004), frozenset()),
+    ("unblock_member", lambda s: repo.unblock_member(s, member_tg_id=1005), frozenset()),
+    ("demote_brigadier", lambda s: repo.demote_brigadier(s, 1001), frozenset()),
+]
+
+
+async def check_query_plans(
+    *, in_memory: bool = False, scenarios: list[Scenario] | None = None,
+) -> tuple[int, list[PlanProblem]]:
+    """
+    Прогнать сценарии (по умолчанию SCENARIOS). Возвращает (число проверенных запросов, найденные проблемы).
+    in_memory=True — схема в ":memory:" на одном общем соединении, без временного файла.
+    """
+    path = None
+    if in_memory:
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    else:
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    install_sqlite_hooks(engine, pragmas=False)
+    captured: list[tuple[str, object]] = []
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(_CHECKED_VERBS):
+            captured.append((statement, parameters))
+
+    checked = 0
+    problems: list[PlanProblem] = []
+    try:
+        async with engine.begin() as conn:
+            await run_migrations(conn)
+        sessions = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        async with sessions() as session:
+            await _seed(session)
+
+        for name, call, allowed in (SCENARIOS if scenarios is None else scenarios):
+            captured.clear()
+            async with sessions() as session:
+                await call(session)
+                conn = await session.connection()
+                for sql, params in list(captured):
+                    res = await conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params)
+                    plan = [row[3] for row in res.all()]
+                    checked += 1
+                    scans = {m.group(1) for m in map(_TABLE_SCAN.match, plan) if m}
+                    if scans - allowed:
+                        problems.append(PlanProblem(name, " ".join(sql.split()), plan))
+                await session.rollback()
+    finally:
+        await engine.dispose()
+        if path is not None:
+            os.unlink(path)
+    return checked, problems
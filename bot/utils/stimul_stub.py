@@ -0,0 +1,80 @@
+# bot/utils/stimul_stub.py
+"""
+Локальная заглушка Stimul API для офлайн-проверки доставки вебхуков.
+
+Запуск:
+    python -m bot.utils.stimul_stub --port 8088 --fail-rate 0.3 --latency-ms 50
+и в окружении бота:
+    STIMUL_API_URL=http://127.0.0.1:8088/pub-api/v1/arch/set-lottery-code
+
+Отвечает 200 на валидный payload, 400 на невалидный и 503 с вероятностью --fail-rate.
+По Ctrl+C печатает счётчики.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+PATH = "/pub-api/v1/arch/set-lottery-code"
+
+
+def make_app(*, fail_rate: float = 0.0, latency_ms: int = 0) -> web.Application:
+    stats = {"requests": 0, "ok": 0, "bad_request": 0, "failed": 0, "codes": set()}
+
+    async def set_lottery_code(request: web.Request) -> web.Response:
+        stats["requests"] += 1
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        try:
+            data = await request.json()
+        except Exception:
+            stats["bad_request"] += 1
+            return web.json_response({"error": "invalid json"}, status=400)
+
+        phone = str(data.get("phone", ""))
+        code = str(data.get("code", ""))
+        if len(phone) != 10 or not phone.isdigit() or not code or not isinstance(data.get("voting_at_home"), bool):
+            stats["bad_request"] += 1
+            return web.json_response({"error": "invalid payload"}, status=400)
+
+        if fail_rate and random.random() < fail_rate:
+            stats["failed"] += 1
+            return web.json_response({"error": "temporarily unavailable"}, status=503)
+
+        stats["ok"] += 1
+        stats["codes"].add(code)
+        return web.json_response({"status": "ok"})
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response({**stats, "codes": len(stats["codes"])})
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post(PATH, set_lottery_code)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Local Stimul API stand-in")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8088)
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="доля ответов 503 (0..1)")
+    ap.add_argument("--latency-ms", type=int, default=0, help="искусственная задержка ответа")
+    args = ap.parse_args()
+
+    app = make_app(fail_rate=args.fail_rate, latency_ms=args.latency_ms)
+    print(f"Stimul stub: http://{args.host}:{args.port}{PATH}")
+    try:
+        web.run_app(app, host=args.host, port=args.port, print=None)
+    finally:
+        s = app["stats"]
+        print(f"requests={s['requests']} ok={s['ok']} failed={s['failed']} "
+              f"bad_request={s['bad_request']} unique_codes={len(s['codes'])}")
+
+
+if __name__ == "__main__":
+    main()
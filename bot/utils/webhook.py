@@ -1,43 +1,131 @@
 # bot/utils/webhook.py
 from __future__ import annotations
+import logging
+import time
+from typing import NamedTuple
 import aiohttp
+from ..config import (
+    STIMUL_API_URL, STIMUL_POOL_LIMIT, STIMUL_POOL_LIMIT_PER_HOST,
+    STIMUL_DNS_CACHE_TTL, STIMUL_KEEPALIVE_TIMEOUT,
+)
 from .phone import normalize_phone, phone_for_api
 
-STIMUL_API_URL = "https://stimul.app/pub-api/v1/arch/set-lottery-code"
+logger = logging.getLogger(__name__)
+
 TIMEOUT = 10  # сек
 
-async def send_lottery_code(phone_raw: str, code: str, voting_at_home: bool):
+# 4xx, которые повтор может исправить; остальные 4xx — ошибка запроса, повтор её не изменит
+RETRYABLE_4XX = frozenset({408, 425, 429})
+
+
+class PostResult(NamedTuple):
+    ok: bool
+    msg: str
+    retry: bool  # False — повторять бессмысленно (постоянная 4xx)
+
+
+def is_retryable_status(status: int) -> bool:
+    """Повторять ли запрос после неуспешного ответа: всё, кроме 4xx, и 4xx из RETRYABLE_4XX."""
+    return not 400 <= status < 500 or status in RETRYABLE_4XX
+
+def build_lottery_payload(phone_raw: str, code: str, voting_at_home: bool) -> tuple[dict | None, str]:
     """
-    Шлёт на внешний сервис JSON:
+    Собирает JSON для внешнего сервиса:
       {
         "phone": "1234567890",          # 10 цифр, без +7
         "code": "12345",                # строка
         "voting_at_home": true/false    # bool
       }
-    Возвращает (ok: bool, msg: str).
+    Возвращает (payload | None, msg). None — данные невалидны, повтор не поможет.
     """
     # 1) нормализуем к +7XXXXXXXXXX
     e164 = normalize_phone(phone_raw)
     if not e164:
-        return False, f"[webhook] fail: phone is empty or invalid after normalization (raw='{phone_raw or ''}')"
+        return None, f"[webhook] fail: phone is empty or invalid after normalization (raw='{phone_raw or ''}')"
 
     # 2) переводим к 10 цифрам без +7
     phone10 = phone_for_api(e164)
     if not phone10:
-        return False, "[webhook] fail: cannot build 10-digit phone for API"
+        return None, "[webhook] fail: cannot build 10-digit phone for API"
 
-    payload = {
+    return {
         "phone": phone10,
         "code": str(code).strip(),
         "voting_at_home": bool(voting_at_home),
-    }
+    }, "[webhook] ok"
+
+
+class StimulClient:
+    """
+    Долгоживущий HTTP-клиент Stimul: один ClientSession на процесс,
+    пул keep-alive соединений, кеш DNS и лимит соединений на хост.
+    Открывается/закрывается в bot/main.py; счётчики — в stats().
+    """
+
+    def __init__(self, url: str = STIMUL_API_URL, *, timeout: float = TIMEOUT) -> None:
+        self.url = url
+        self.timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+
+        self.requests = 0
+        self.ok = 0
+        self.http_errors = 0
+        self.exc_errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=STIMUL_POOL_LIMIT,
+            limit_per_host=STIMUL_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=STIMUL_DNS_CACHE_TTL,
+            keepalive_timeout=STIMUL_KEEPALIVE_TIMEOUT,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
-    try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=TIMEOUT)) as s:
-            async with s.post(STIMUL_API_URL, json=payload) as r:
+    async def post(self, payload: dict) -> PostResult:
+        """POST payload. Сетевые ошибки и таймауты — с retry=True."""
+        if self._session is None or self._session.closed:
+            await self.start()
+        self.requests += 1
+        t0 = time.perf_counter()
+        try:
+            async with self._session.post(self.url, json=payload) as r:
                 body = await r.text()
                 if 200 <= r.status < 300:
-                    return True, "[webhook] ok"
-                return False, f"[webhook] fail: HTTP {r.status}: {body}"
-    except Exception as e:
-        return False, f"[webhook] fail: {e!r}"
+                    self.ok += 1
+                    return PostResult(True, "[webhook] ok", False)
+                self.http_errors += 1
+                return PostResult(False, f"[webhook] fail: HTTP {r.status}: {body}", is_retryable_status(r.status))
+        except Exception as e:
+            self.exc_errors += 1
+            return PostResult(False, f"[webhook] fail: {e!r}", True)
+        finally:
+            dt = time.perf_counter() - t0
+            self.latency_total += dt
+            self.latency_max = max(self.latency_max, dt)
+            logger.debug("[webhook] POST %s took %.1f ms", self.url, dt * 1000)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "ok": self.ok,
+            "http_errors": self.http_errors,
+            "exc_errors": self.exc_errors,
+            "latency_avg_ms": round(self.latency_total / self.requests * 1000, 1) if self.requests else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 1),
+        }
+
+
+stimul_client = StimulClient()
+
@@ -0,0 +1,179 @@
+# bot/write_queue.py
+"""
+Групповой коммит записей опроса.
+
+SQLite пускает одного писателя: когда много агентов одновременно закрывают карточки,
+короткие транзакции хендлеров выстраиваются на блокировке записи файла, а при
+долгом ожидании ловят «database is locked». Вместо этого хендлер отдаёт намерение —
+async-функцию fn(session, *args, **kwargs) из repo или своего модуля — в очередь,
+и ждёт результат:
+
+    contact_id = await write_queue.submit(save_contact, visit_id=..., ...)
+
+Единственный писатель забирает из очереди всё, что пришло за WRITE_BATCH_WINDOW после
+первой записи (не больше WRITE_BATCH_MAX), выполняет намерения по порядку в одной
+транзакции — каждое в своём SAVEPOINT, чтобы ошибка одного не откатывала соседей, —
+и делает один коммит (явный BEGIN — bot/db.py install_sqlite_hooks, иначе pysqlite коммитит
+на каждом RELEASE SAVEPOINT). Будущее вызывающего получает результат только после коммита.
+При остановке очередь дописывается до конца; новые записи после stop() не принимаются.
+
+Ждать submit() с незакоммиченными изменениями в своей сессии нельзя: её транзакция держит
+блокировку записи SQLite, писатель упрётся в неё и через busy_timeout получит «database is locked».
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from .config import WRITE_BATCH_WINDOW, WRITE_BATCH_MAX, WRITE_QUEUE_MAXSIZE
+from .db import async_session
+
+logger = logging.getLogger(__name__)
+
+WriteFn = Callable[..., Awaitable[Any]]
+
+
+@dataclass
+class _Intent:
+    fn: WriteFn
+    args: tuple
+    kwargs: dict
+    future: asyncio.Future = field(repr=False)
+
+
+class WriteQueue:
+    def __init__(
+        self,
+        *,
+        window: float = WRITE_BATCH_WINDOW,
+        max_batch: int = WRITE_BATCH_MAX,
+        maxsize: int = WRITE_QUEUE_MAXSIZE,
+        session_factory: async_sessionmaker[AsyncSession] = async_session,
+    ) -> None:
+        self.window = window
+        self.max_batch = max_batch
+        self.maxsize = maxsize
+        self.session_factory = session_factory
+        self._queue: asyncio.Queue[_Intent | None] | None = None
+        self._task: asyncio.Task | None = None
+        self._closed = True
+
+        # счётчики для логов/диагностики
+        self.ops = 0
+        self.failed = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.commit_total_s = 0.0
+
+    # ---- жизненный цикл
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.Queue(self.maxsize)
+            self._closed = False
+            self._task = asyncio.create_task(self._run(), name="write-queue")
+
+    async def stop(self) -> None:
+        """Перестать принимать записи, дописать уже принятые и остановить писателя."""
+        if self._task is None:
+            return
+        self._closed = True
+        await self._queue.put(None)
+        try:
+            await self._task
+        finally:
+            self._task = None
+
+    # ---- API для хендлеров
+
+    async def submit(self, fn: WriteFn, /, *args, **kwargs) -> Any:
+        """Выполнить await fn(session, *args, **kwargs) в ближайшем групповом коммите и вернуть результат."""
+        if self._closed:
+            raise RuntimeError("write queue is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Intent(fn, args, kwargs, future))
+        return await future
+
+    # ---- писатель
+
+    async def _run(self) -> None:
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            if self._queue.qsize() < self.max_batch - 1:
+                # даём попутчикам подойти
+                await asyncio.sleep(self.window)
+            stopping = False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                intent = self._queue.get_nowait()
+                if intent is None:
+                    stopping = True
+                    break
+                batch.append(intent)
+            await self._commit(batch)
+            if stopping:
+                # всё, что пришло до stop(), уже в batch; после — submit не принимает
+                return
+
+    async def _commit(self, batch: list[_Intent]) -> None:
+        results: list[tuple[_Intent, BaseException | None, Any]] = []
+        started = time.perf_counter()
+        try:
+            async with self.session_factory() as session:
+                for intent in batch:
+                    if intent.future.cancelled():
+                        # вызывающий ушёл раньше, чем дошла очередь
+                        continue
+                    results.append(await self._apply(session, intent))
+                await session.commit()
+        except Exception as e:
+            logger.exception("Write batch of %d failed", len(batch))
+            self.failed += len(batch)
+            for intent in batch:
+                if not intent.future.done():
+                    intent.future.set_exception(e)
+            return
+        finally:
+            self.commit_total_s += time.perf_counter() - started
+
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for intent, error, result in results:
+            self.ops += 1
+            if intent.future.done():
+                continue
+            if error is not None:
+                self.failed += 1
+                intent.future.set_exception(error)
+            else:
+                intent.future.set_result(result)
+
+    @staticmethod
+    async def _apply(session: AsyncSession, intent: _Intent) -> tuple[_Intent, BaseException | None, Any]:
+        try:
+            async with session.begin_nested():
+                result = await intent.fn(session, *intent.args, **intent.kwargs)
+        except Exception as e:
+            return intent, e, None
+        return intent, None, result
+
+    def stats(self) -> dict:
+        return {
+            "ops": self.ops,
+            "failed": self.failed,
+            "batches": self.batches,
+            "avg_batch": round(self.ops / self.batches, 1) if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "commit_avg_ms": round(self.commit_total_s / self.batches * 1e3, 2) if self.batches else 0,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+write_queue = WriteQueue()
@@ -0,0 +1,97 @@
+# scripts/_bench.py
+"""
+Общее для замеров scripts/bench_*.py: временная база со схемой бота (run_migrations)
+и синтетическими закрытыми карточками. Рабочие data.db / fsm.db замеры не трогают.
+"""
+from __future__ import annotations
+
+import hashlib
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from bot import models  # noqa: F401 — таблицы в Base.metadata
+from bot.db import install_sqlite_hooks
+from bot.migrations import run_migrations
+from bot.repo import rebuild_agent_day_cube, rebuild_agent_day_stats
+
+_TS = "%Y-%m-%d %H:%M:%S.%f"
+CARDS_PER_VISIT = 5
+
+
+def make_engine(path: str | Path, *, pragmas: bool = True) -> AsyncEngine:
+    """Движок как у бота (явный BEGIN; pragmas=True — профиль SQLite из config.py)."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    install_sqlite_hooks(engine, pragmas=pragmas)
+    return engine
+
+
+def sessions(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+
+def _seed(path: Path, *, agents: int, contacts: int, days: int, rnd: random.Random) -> None:
+    now = datetime.utcnow()
+    conn = sqlite3.connect(path)
+    try:
+        conn.executemany(
+            "INSERT INTO agent (id, tg_user_id, username, name, admin_logged_in, created_at) VALUES (?, ?, ?, ?, 0, ?)",
+            [(i, 10_000 + i, f"user{i}", f"Агент {i}", now.strftime(_TS)) for i in range(1, agents + 1)],
+        )
+        visits = contacts // CARDS_PER_VISIT + 1
+        conn.executemany(
+            "INSERT INTO visit (id, agent_id, started_at, closed_at) VALUES (?, ?, ?, ?)",
+            [(v, v % agents + 1, now.strftime(_TS), now.strftime(_TS)) for v in range(1, visits + 1)],
+        )
+        phash = hashlib.sha256(b"+79990000000").hexdigest()
+        repeats = [None, *(e.name for e in models.RepeatTouch)]
+        statuses = [None, *(e.name for e in models.TalkStatus)]
+        methods = [None, *(e.name for e in models.FlyerMethod)]
+        span = days * 86_400
+
+        def rows():
+            for i in range(1, contacts + 1):
+                visit = i // CARDS_PER_VISIT + 1
+                created = (now - timedelta(seconds=rnd.randrange(span))).strftime(_TS)
+                method = rnd.choice(methods)
+                yield (
+                    visit, visit % agents + 1, "Иванов Иван Иванович", f"+7999{i:07d}", phash,
+                    rnd.choice(repeats), rnd.choice(statuses), 1, 0, method,
+                    str(i) if method in ("HAND", "MAILBOX") else None, rnd.random() < 0.3,
+                    created, created, created,
+                )
+
+        conn.executemany(
+            "INSERT INTO contact (visit_id, agent_id, full_name, phone_e164, phone_hash, repeat_touch, talk_status, "
+            "door_photo, mailbox_photo, flyer_method, flyer_number, home_voting, created_at, closed_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows(),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def make_db(path: str | Path, *, agents: int, contacts: int, days: int = 40, seed: int = 1) -> None:
+    """
+    Схема бота + agents агентов и contacts закрытых карточек за последние days дней
+    + роллапы agent_day_stats и agent_day_cube.
+    """
+    path = Path(path)
+    t0 = time.perf_counter()
+    engine = make_engine(path, pragmas=False)
+    try:
+        async with engine.begin() as conn:
+            await run_migrations(conn)
+        _seed(path, agents=agents, contacts=contacts, days=days, rnd=random.Random(seed))
+        async with sessions(engine)() as session:
+            await rebuild_agent_day_stats(session)
+            await rebuild_agent_day_cube(session)
+            await session.commit()
+    finally:
+        await engine.dispose()
+    print(f"seeded {contacts} contacts / {agents} agents in {time.perf_counter() - t0:.1f}s")
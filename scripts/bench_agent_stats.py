@@ -0,0 +1,91 @@
+# scripts/bench_agent_stats.py
+"""
+Замер сводок агентов: прежний способ (все Contact периода ORM-объектами, подсчёт в Python)
+против repo.agents_stats_for_period / agent_stats_last24h (agent_day_stats + краевой GROUP BY).
+Результаты сверяются; время и пик памяти (tracemalloc) — по каждому периоду.
+
+    python -m scripts.bench_agent_stats --agents 200 --contacts 100000
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import select
+
+from bot import repo
+from bot.models import Agent, Contact
+
+from ._bench import make_db, make_engine, sessions
+
+
+async def _orm_stats(session, days: int | None) -> dict[int, list[int]]:
+    """Как было до SQL-агрегации: Contact целиком в память и счёт по полям."""
+    q = select(Contact)
+    if days is not None:
+        q = q.where(Contact.created_at >= datetime.utcnow() - timedelta(days=days))
+    out: dict[int, list[int]] = {}
+    for c in (await session.execute(q)).scalars().all():
+        s = out.setdefault(c.agent_id, [0] * 8)
+        s[0] += 1
+        s[1] += c.talk_status is not None and c.talk_status.value == "CONSENT"
+        s[2] += c.talk_status is not None and c.talk_status.value == "REFUSAL"
+        s[3] += c.talk_status is not None and c.talk_status.value == "NO_ONE"
+        s[4] += c.flyer_method is not None and c.flyer_method.value == "HAND"
+        s[5] += c.flyer_method is not None and c.flyer_method.value == "MAILBOX"
+        s[6] += c.flyer_method is not None and c.flyer_method.value == "NONE"
+        s[7] += bool(c.home_voting)
+    # справочник агентов, как и раньше
+    (await session.execute(select(Agent))).scalars().all()
+    return out
+
+
+async def _sql_stats(session, days: int | None) -> dict[int, list[int]]:
+    keys = ("total", "consent", "refusal", "no_one", "hand", "mailbox", "none", "home_yes")
+    rows = await repo.agents_stats_for_period(session, days)
+    return {r["agent_id"]: [r[k] for k in keys] for r in rows if r["total"]}
+
+
+async def _measure(factory, fn, *args):
+    async with factory() as session:
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        result = await fn(session, *args)
+        dt = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, dt, peak
+
+
+async def main(agents: int, contacts: int, days: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.db"
+        await make_db(path, agents=agents, contacts=contacts, days=days)
+        engine = make_engine(path)
+        factory = sessions(engine)
+        try:
+            print(f"{'period':>10}  {'before ms':>10} {'MB':>7}  {'after ms':>9} {'MB':>6}")
+            for period in (None, 7, 1):
+                old, t_old, m_old = await _measure(factory, _orm_stats, period)
+                new, t_new, m_new = await _measure(factory, _sql_stats, period)
+                assert old == new, f"results differ for days={period}"
+                label = "all time" if period is None else f"{period} d"
+                print(f"{label:>10}  {t_old * 1e3:10.0f} {m_old / 2**20:7.1f}  {t_new * 1e3:9.0f} {m_new / 2**20:6.1f}")
+            _, t24, _ = await _measure(factory, repo.agent_stats_last24h, 1)
+            print(f"agent_stats_last24h: {t24 * 1e3:.1f} ms")
+        finally:
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--agents", type=int, default=200)
+    ap.add_argument("--contacts", type=int, default=100_000)
+    ap.add_argument("--days", type=int, default=40, help="за сколько дней раскидать карточки")
+    args = ap.parse_args()
+    asyncio.run(main(args.agents, args.contacts, args.days))
@@ -0,0 +1,109 @@
+# scripts/bench_export_columns.py
+"""
+Замер ядра выгрузки (CSV + ширины колонок, без openpyxl): построчная сборка строк
+(как было: кортеж на строку, _map_* на ячейку, ширина по ячейке) против колоночной
+export_columns / ExportSpool.add_columns. Зеркало contact строится из временной базы;
+CSV обоих способов сверяются побайтно.
+
+    python -m scripts.bench_export_columns --contacts 100000
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import filecmp
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from bot.config import EXPORT_CHUNK_SIZE
+from bot.utils import excel
+from bot.utils.contact_mirror import ContactMirror, MirrorSnapshot, REPEATS, STATUSES, METHODS, from_us
+
+from ._bench import make_db, make_engine, sessions
+
+
+def _rowwise(snap: MirrorSnapshot, idx, csv_path: str) -> excel.ExportSpool:
+    """Прежний путь: MirrorSnapshot.iter_rows + export_row + ExportSpool.add."""
+    spool = excel.ExportSpool(csv_path)
+    c, agents, widths = snap.cols, snap.agents, spool.widths
+    for start in range(0, len(idx), EXPORT_CHUNK_SIZE):
+        part = idx[start:start + EXPORT_CHUNK_SIZE]
+        names, phones, flyers = (snap.text(k, part) for k in ("full_name", "phone", "flyer"))
+        for i, (a, rt, ts, fm, hv, cr) in enumerate(zip(
+            snap.agent_ids(part).tolist(), c["repeat"][part].tolist(), c["status"][part].tolist(),
+            c["method"][part].tolist(), c["home"][part].tolist(), c["created"][part].tolist(),
+        )):
+            tg, username, name = agents[a] if a else (None, None, None)
+            created = from_us(cr)
+            if isinstance(created, datetime):
+                created = created.replace(microsecond=0)
+            row = (
+                a or None, tg, excel._username(username), name, names[i], phones[i],
+                excel._map_repeat(REPEATS[rt]), excel._map_status(STATUSES[ts]), excel._map_method(METHODS[fm]),
+                flyers[i] or "", "Да" if hv else "Нет", created,
+            )
+            spool._csv.writerow(row)
+            spool.total += 1
+            for j, v in enumerate(row):
+                if v is not None:
+                    n = len(str(v))
+                    if n > widths[j]:
+                        widths[j] = n
+    spool.close()
+    return spool
+
+
+def _columnwise(snap: MirrorSnapshot, idx, csv_path: str) -> excel.ExportSpool:
+    """Текущий путь render_export: export_columns + ExportSpool.add_columns."""
+    spool = excel.ExportSpool(csv_path)
+    agents = excel._AgentColumns(snap.agents)
+    for start in range(0, len(idx), EXPORT_CHUNK_SIZE):
+        spool.add_columns(excel.export_columns(snap, idx[start:start + EXPORT_CHUNK_SIZE], agents))
+    spool.close()
+    return spool
+
+
+def _best(fn, *args, repeat: int) -> tuple[float, excel.ExportSpool]:
+    best, spool = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        spool = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, spool
+
+
+async def main(agents: int, contacts: int, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        await make_db(tmp / "bench.db", agents=agents, contacts=contacts)
+        engine = make_engine(tmp / "bench.db")
+        try:
+            mirror = ContactMirror(tmp / "mirror")
+            async with sessions(engine)() as session:
+                meta = await mirror.sync(session)
+        finally:
+            await engine.dispose()
+
+        snap = MirrorSnapshot(mirror.root, meta)
+        idx = snap.select()
+        t_old, old = _best(_rowwise, snap, idx, str(tmp / "rows.csv"), repeat=repeat)
+        t_new, new = _best(_columnwise, snap, idx, str(tmp / "cols.csv"), repeat=repeat)
+        same = filecmp.cmp(tmp / "rows.csv", tmp / "cols.csv", shallow=False) and old.widths == new.widths
+
+        print(f"rows={len(idx)} (best of {repeat})")
+        print(f"  row-wise     {t_old:6.2f} s")
+        print(f"  column-wise  {t_new:6.2f} s  ({t_old / t_new:.1f}x)")
+        print(f"  CSV and widths identical: {same}")
+        if not same:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--agents", type=int, default=200)
+    ap.add_argument("--contacts", type=int, default=100_000)
+    ap.add_argument("--repeat", type=int, default=2)
+    args = ap.parse_args()
+    asyncio.run(main(args.agents, args.contacts, args.repeat))
@@ -0,0 +1,120 @@
+# scripts/bench_export_styles.py
+"""
+Замер оформления листов выгрузки на синтетических строках:
+- summary: прежний pandas to_excel + _autosize (обход каждой ячейки) против write_admin_summary;
+- pivot_multi: Alignment/Font/Border на каждой ячейке против именованных стилей книги (_Styles).
+
+    python -m scripts.bench_export_styles --rows 1000 10000 100000
+"""
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+
+from bot.utils import excel
+
+_SUMMARY_KEYS = ["agent_id", "agent_tg", "agent_username", "agent_name",
+                 "total", "consent", "refusal", "no_one", "hand", "mailbox", "none", "home_yes"]
+
+
+def _stats(n: int) -> list[dict]:
+    return [dict(agent_id=i, agent_tg=10_000 + i, agent_username=f"@user{i}", agent_name=f"Агент номер {i}",
+                 total=i % 500, consent=i % 100, refusal=i % 50, no_one=i % 70, hand=i % 30, mailbox=i % 20,
+                 none=i % 10, home_yes=i % 5) for i in range(n)]
+
+
+def _pivot(n: int) -> list[tuple]:
+    return [(i, f"@user{i}", *[(i * k) % 97 for k in range(10)]) for i in range(n)]
+
+
+def _summary_before(stats: list[dict], path: str) -> None:
+    """write_admin_summary до именованных стилей: pandas to_excel и стиль/ширина по каждой ячейке."""
+    from openpyxl.styles import Alignment, Border, Font, Side
+
+    df = pd.DataFrame(stats, columns=_SUMMARY_KEYS).rename(columns=dict(zip(_SUMMARY_KEYS, [
+        "ID агента", "TG ID", "Логин (@)", "Имя агента", "Всего карточек", "Согласие", "Отказ", "Никого нет",
+        "Флаер на руки", "Флаер в ящик", "Флаер нет", "Голосование на дому (Да)",
+    ])))
+    with pd.ExcelWriter(path, engine="openpyxl") as w:
+        df.to_excel(w, index=False, sheet_name="summary")
+        ws = w.book["summary"]
+        ws.freeze_panes = "A2"
+        center = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        side = Side(style="thin")
+        thin = Border(left=side, right=side, top=side, bottom=side)
+        for c in range(1, ws.max_column + 1):
+            cell = ws.cell(row=1, column=c)
+            cell.alignment, cell.font, cell.border = center, Font(bold=True), thin
+        for col in ws.columns:
+            width = max(len(str(cell.value)) if cell.value is not None else 0 for cell in col)
+            ws.column_dimensions[col[0].column_letter].width = min(max(10, width + 2), 40)
+
+
+class _CellStyles:
+    """Прежний _Styles: свои Alignment/Font/Border на каждую ячейку."""
+
+    def __init__(self):
+        from openpyxl.styles import Alignment, Border, Font, Side
+        side = Side(style="thin")
+        self.center = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        self.left = Alignment(vertical="center")
+        self.bold = Font(bold=True)
+        self.thin = Border(left=side, right=side, top=side, bottom=side)
+
+    def header(self, ws, value):
+        from openpyxl.cell import WriteOnlyCell
+        cell = WriteOnlyCell(ws, value)
+        cell.alignment, cell.font, cell.border = self.center, self.bold, self.thin
+        return cell
+
+    def body(self, ws, value, *, centered: bool):
+        from openpyxl.cell import WriteOnlyCell
+        cell = WriteOnlyCell(ws, value)
+        cell.alignment, cell.border = (self.center if centered else self.left), self.thin
+        return cell
+
+
+def _pivot_with(styles, rows: list[tuple], path: str) -> None:
+    wb = Workbook(write_only=True)
+    excel._write_pivot_multi(wb, rows, styles(wb))
+    wb.save(path)
+
+
+def _timed(fn, *args) -> float:
+    t0 = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t0
+
+
+def main(sizes: list[int]) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"{'rows':>8}  {'summary before':>14} {'after':>8}  {'pivot before':>12} {'after':>8}")
+        for n in sizes:
+            stats, pivot = _stats(n), _pivot(n)
+            s_old = _timed(_summary_before, stats, str(tmp / "s_old.xlsx"))
+            s_new = _timed(excel.write_admin_summary, stats, str(tmp / "s_new.xlsx"))
+            p_old = _timed(_pivot_with, lambda wb: _CellStyles(), pivot, str(tmp / "p_old.xlsx"))
+            p_new = _timed(_pivot_with, excel._Styles, pivot, str(tmp / "p_new.xlsx"))
+            print(f"{n:8}  {s_old:13.2f}s {s_new:7.2f}s  {p_old:11.2f}s {p_new:7.2f}s")
+
+        # оформление то же: шрифт/рамка/выравнивание ячеек и ширины колонок
+        for old, new in (("s_old", "s_new"), ("p_old", "p_new")):
+            a, b = load_workbook(tmp / f"{old}.xlsx").active, load_workbook(tmp / f"{new}.xlsx").active
+            for ca, cb in zip(a[1] + a[2], b[1] + b[2]):
+                assert (ca.font.b, ca.border.left.style, ca.alignment.horizontal) == \
+                       (cb.font.b, cb.border.left.style, cb.alignment.horizontal), (old, ca.coordinate)
+            assert a.freeze_panes == b.freeze_panes
+        print("styles, freeze panes: same")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000])
+    args = ap.parse_args()
+    main(args.rows)
@@ -0,0 +1,130 @@
+# scripts/bench_sqlite_pragmas.py
+"""
+Замер чтения во время записи. Писатели — в этом процессе через WriteQueue (как в боте),
+читатели — отдельные процессы на том же файле: выгрузка (полный проход по contact пачками)
+и сводка (GROUP BY за 7 дней). Режимы:
+  default — без профиля (журнал отката, настройки SQLite по умолчанию);
+  profile — профиль sqlite_pragmas() из bot/db.py (WAL и т.д., см. SQLITE_* в config.py).
+Каждый режим — на своей копии одной и той же засеянной базы.
+
+    python -m scripts.bench_sqlite_pragmas --contacts 100000 --seconds 10
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import multiprocessing as mp
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bot.routers.flow import _finish_card
+from bot.write_queue import WriteQueue
+
+from ._bench import make_db, make_engine, sessions
+
+WRITERS = 20
+
+
+def _reader(kind: str, path: str, stop_at: float, out) -> None:
+    conn = sqlite3.connect(path, timeout=10)
+    done = errors = 0
+    since = (datetime.utcnow() - timedelta(days=7)).isoformat(" ")
+    while time.time() < stop_at:
+        try:
+            if kind == "export":
+                cur = conn.execute("SELECT * FROM contact ORDER BY id")
+                while cur.fetchmany(2000):
+                    time.sleep(0.001)  # рендер пачки
+            else:
+                conn.execute(
+                    "SELECT agent_id, count(*), sum(talk_status = 'CONSENT') FROM contact "
+                    "WHERE created_at >= ? GROUP BY agent_id", (since,),
+                ).fetchall()
+            done += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    out.put((kind, done, errors))
+
+
+async def run(path: Path, mode: str, seconds: float, exports: int, summaries: int, agents: int) -> None:
+    engine = make_engine(path, pragmas=mode == "profile")
+    queue = WriteQueue(session_factory=sessions(engine))
+    await queue.start()
+    async with engine.connect() as conn:
+        journal = (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar()
+
+    stop_at = time.time() + seconds
+    out = mp.Queue()
+    procs = [mp.Process(target=_reader, args=(k, str(path), stop_at, out))
+             for k in ["export"] * exports + ["summary"] * summaries]
+    for p in procs:
+        p.start()
+
+    lat: list[float] = []
+    errors: dict[str, int] = {}
+
+    async def writer(w: int) -> None:
+        i = w
+        while time.time() < stop_at:
+            i += WRITERS
+            visit = i % 1000 + 1
+            data = {"visit_id": visit, "agent_id": visit % agents + 1,
+                    "phone": "+79990001122", "lottery_code": None,
+                    "card": {"full_name": "Сидоров Сидор Сидорович", "phone_e164": "+79990001122",
+                             "created_at": datetime.utcnow(), "talk_status": "CONSENT", "flyer_method": "NONE"}}
+            t0 = time.perf_counter()
+            try:
+                await queue.submit(_finish_card, data, False)
+            except Exception as e:
+                key = type(e).__name__ + (" (locked)" if "locked" in str(e) else "")
+                errors[key] = errors.get(key, 0) + 1
+                continue
+            lat.append(time.perf_counter() - t0)
+
+    await asyncio.gather(*(writer(w) for w in range(WRITERS)))
+    await queue.stop()
+    res = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+    await engine.dispose()
+
+    lat.sort()
+    n = len(lat)
+    summaries_done = sum(r[1] for r in res if r[0] == "summary")
+    print(f"{mode:8} {journal:8} {n / seconds:9.0f} {lat[n // 2] * 1e3 if n else 0:9.0f} "
+          f"{lat[-1] * 1e3 if n else 0:9.0f} {summaries_done / seconds:12.1f}  "
+          f"{errors or '-'} / reader errors {sum(r[2] for r in res)}")
+
+
+async def main(agents: int, contacts: int, seconds: float, exports: int, summaries: int) -> None:
+    logging.disable(logging.ERROR)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        await make_db(tmp / "seed.db", agents=agents, contacts=contacts)
+        print(f"{WRITERS} writers, {exports} export + {summaries} summary readers, {seconds:.0f}s per mode")
+        print(f"{'mode':8} {'journal':8} {'writes/s':>9} {'p50 ms':>9} {'max ms':>9} {'summaries/s':>12}  errors")
+        for mode in ("default", "profile"):
+            path = tmp / f"{mode}.db"
+            shutil.copyfile(tmp / "seed.db", path)
+            if mode == "default":
+                # WAL сохраняется в файле: «до профиля» — журнал отката
+                conn = sqlite3.connect(path)
+                conn.execute("PRAGMA journal_mode=DELETE")
+                conn.close()
+            await run(path, mode, seconds, exports, summaries, agents)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--agents", type=int, default=200)
+    ap.add_argument("--contacts", type=int, default=100_000)
+    ap.add_argument("--seconds", type=float, default=10.0)
+    ap.add_argument("--exports", type=int, default=2)
+    ap.add_argument("--summaries", type=int, default=2)
+    args = ap.parse_args()
+    asyncio.run(main(args.agents, args.contacts, args.seconds, args.exports, args.summaries))
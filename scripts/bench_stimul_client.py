@@ -0,0 +1,79 @@
+# scripts/bench_stimul_client.py
+"""
+Замер: ClientSession на каждый вызов (как было в send_lottery_code) против общего
+StimulClient с keep-alive пулом. Сервер — локальная заглушка bot/utils/stimul_stub.py.
+
+    python -m scripts.bench_stimul_client --calls 500 --concurrency 1
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from bot.utils.stimul_stub import PATH, make_app
+from bot.utils.webhook import StimulClient
+
+PAYLOAD = {"phone": "9990001122", "code": "123", "voting_at_home": False}
+
+
+async def _per_call(url: str) -> None:
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+        async with session.post(url, json=PAYLOAD) as r:
+            await r.text()
+            r.raise_for_status()
+
+
+async def _run(call, calls: int, concurrency: int) -> float:
+    """Сделать calls вызовов в concurrency потоков; среднее время на вызов, мс."""
+    it = iter(range(calls))
+
+    async def worker():
+        for _ in it:
+            await call()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return (time.perf_counter() - t0) / calls * 1e3
+
+
+async def main(calls: int, concurrency: int) -> None:
+    runner = web.AppRunner(make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{PATH}"
+
+    client = StimulClient(url)
+    await client.start()
+
+    async def pooled():
+        res = await client.post(PAYLOAD)
+        assert res.ok, res.msg
+
+    try:
+        # прогрев: импорт/резолв/первое соединение не в замере
+        await _per_call(url)
+        await pooled()
+        per_call = await _run(lambda: _per_call(url), calls, concurrency)
+        shared = await _run(pooled, calls, concurrency)
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+    print(f"calls={calls} concurrency={concurrency}")
+    print(f"  session per call  {per_call:6.2f} ms/call")
+    print(f"  pooled client     {shared:6.2f} ms/call  ({per_call / shared:.1f}x)")
+    print(f"  client stats      {client.stats()}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--calls", type=int, default=500)
+    ap.add_argument("--concurrency", type=int, default=1)
+    args = ap.parse_args()
+    asyncio.run(main(args.calls, args.concurrency))
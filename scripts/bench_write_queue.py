@@ -0,0 +1,105 @@
+# scripts/bench_write_queue.py
+"""
+Нагрузочный замер группового коммита: N агентов одновременно записывают по --cards готовых
+карточек (_finish_card из routers/flow.py). direct — прежний путь, своя сессия и коммит
+на карточку; queue — через WriteQueue. Транзакции считаются по BEGIN на проводе.
+
+    python -m scripts.bench_write_queue --agents 50 200 1000 --cards 5
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import event
+
+from bot.routers.flow import _finish_card
+from bot.write_queue import WriteQueue
+
+from ._bench import CARDS_PER_VISIT, make_db, make_engine, sessions
+
+SEED_AGENTS = 200
+
+
+def _card(i: int) -> dict:
+    visit = i % (SEED_AGENTS * 10) + 1
+    return {
+        "visit_id": visit, "agent_id": visit % SEED_AGENTS + 1,
+        "phone": "+79990001122", "lottery_code": None,
+        "card": {"full_name": "Сидоров Сидор Сидорович", "phone_e164": "+79990001122",
+                 "created_at": datetime.utcnow(), "door_photo": True, "talk_status": "CONSENT",
+                 "flyer_method": "NONE", "home_voting": bool(i % 2)},
+    }
+
+
+async def run(path: Path, mode: str, agents: int, cards: int) -> None:
+    engine = make_engine(path)
+    factory = sessions(engine)
+    begins = [0]
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _count(conn, cursor, statement, *args):
+        begins[0] += statement.startswith("BEGIN")
+
+    queue = WriteQueue(session_factory=factory)
+    lat: list[float] = []
+    errors: dict[str, int] = {}
+    seq = iter(range(10**9))
+
+    async def one(data: dict) -> None:
+        t0 = time.perf_counter()
+        try:
+            if mode == "direct":
+                async with factory() as session:
+                    await _finish_card(session, data, True)
+                    await session.commit()
+            else:
+                await queue.submit(_finish_card, data, True)
+        except Exception as e:
+            key = type(e).__name__ + (" (locked)" if "locked" in str(e) else "")
+            errors[key] = errors.get(key, 0) + 1
+            return
+        lat.append(time.perf_counter() - t0)
+
+    async def agent() -> None:
+        for _ in range(cards):
+            await one(_card(next(seq)))
+
+    if mode == "queue":
+        await queue.start()
+    begins[0] = 0
+    t0 = time.perf_counter()
+    await asyncio.gather(*(agent() for _ in range(agents)))
+    wall = time.perf_counter() - t0
+    if mode == "queue":
+        await queue.stop()
+    await engine.dispose()
+
+    lat.sort()
+    n = len(lat)
+    q = lambda p: lat[min(n - 1, int(n * p))] * 1e3 if n else float("nan")
+    print(f"{agents:6}  {mode:6} {n / wall:8.0f} {q(.5):7.0f} {q(.95):7.0f} {begins[0]:8}  {errors or '-'}")
+
+
+async def main(agent_counts: list[int], cards: int) -> None:
+    logging.disable(logging.ERROR)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.db"
+        await make_db(path, agents=SEED_AGENTS, contacts=SEED_AGENTS * 10 * CARDS_PER_VISIT)
+        print(f"{'agents':>6}  {'mode':6} {'cards/s':>8} {'p50 ms':>7} {'p95 ms':>7} {'BEGINs':>8}  errors")
+        for agents in agent_counts:
+            for mode in ("direct", "queue"):
+                await run(path, mode, agents, cards)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--agents", type=int, nargs="+", default=[50, 200, 1000])
+    ap.add_argument("--cards", type=int, default=5, help="карточек на агента")
+    args = ap.parse_args()
+    asyncio.run(main(args.agents, args.cards))
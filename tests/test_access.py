@@ -0,0 +1,44 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot import access
+from bot.access import AccessCache, AccessContext, invalidate_access
+from bot.db import install_sqlite_hooks
+
+
+def _ctx(tg_user_id: int) -> AccessContext:
+    return AccessContext(tg_user_id=tg_user_id, agent_id=None, is_admin=False, is_brig=True, is_blocked=False)
+
+
+def test_rollback_drops_pending_invalidation(monkeypatch):
+    cache = AccessCache()
+    monkeypatch.setattr(access, "access_cache", cache)
+
+    async def main():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        install_sqlite_hooks(engine, pragmas=False)
+        sessions = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        try:
+            async with sessions() as session:
+                await session.connection()
+                invalidate_access(session, 1)
+                await session.rollback()
+                assert "access_invalidate" not in session.info
+
+                # после отката в кеш легло актуальное состояние; чужой коммит сессии его не сбрасывает
+                cache.put(_ctx(1))
+                await session.connection()
+                await session.commit()
+                assert cache.get(1) == _ctx(1)
+
+                # без отката сброс повторяется после коммита
+                await session.connection()
+                invalidate_access(session, 1)
+                cache.put(_ctx(1))
+                await session.commit()
+                assert cache.get(1) is None
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot import repo
+from bot.db import install_sqlite_hooks
+from bot.migrations import run_migrations
+from bot.models import Agent, Contact, FlyerMethod, RepeatTouch, TalkStatus, Visit
+
+
+async def _scan(session, days):
+    """Куб прямым GROUP BY по contact — как считался до agent_day_cube."""
+    home = case((Contact.home_voting.is_(True), 1), else_=0)
+    keys = (Agent.id, Contact.repeat_touch, Contact.talk_status, Contact.flyer_method, home)
+    q = select(*keys, func.count()).select_from(Contact).join(Agent, Contact.agent_id == Agent.id, isouter=True)
+    if days is not None:
+        q = q.where(Contact.created_at >= datetime.utcnow() - timedelta(days=days))
+    return {(a, rt, ts, fm, bool(h)): n for a, rt, ts, fm, h, n in await session.execute(q.group_by(*keys))}
+
+
+def test_contact_cube_from_rollup_matches_contact_scan(tmp_path):
+    rnd = random.Random(7)
+    now = datetime.utcnow()
+
+    def pick(enum_cls):
+        return rnd.choice([None, *enum_cls])
+
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'data.db'}")
+        install_sqlite_hooks(engine, pragmas=False)
+        sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        try:
+            async with engine.begin() as conn:
+                await run_migrations(conn)
+            async with sessions() as session:
+                session.add_all([Agent(id=i, tg_user_id=1000 + i) for i in (1, 2, 3)])
+                session.add(Visit(id=1, agent_id=1))
+                await session.flush()
+                # закрытые карточки за 10 дней — через save_contact, как пишет бот
+                for i in range(400):
+                    await repo.save_contact(
+                        session, visit_id=1, agent_id=rnd.choice((1, 2, 3)), full_name="Иванов Иван",
+                        phone_e164=f"+7999{i:07d}", created_at=now - timedelta(minutes=rnd.randrange(10 * 1440)),
+                        repeat_touch=pick(RepeatTouch), talk_status=pick(TalkStatus),
+                        flyer_method=pick(FlyerMethod), home_voting=rnd.choice((None, False, True)),
+                    )
+                # незакрытые карточки прежних версий: старые закроет уборщик, свежие остаются открытыми
+                session.add_all([
+                    Contact(visit_id=1, agent_id=rnd.choice((1, 2, 3)), full_name="Открытая",
+                            phone_e164="+79990000000", phone_hash="h",
+                            created_at=now - timedelta(minutes=rnd.randrange(10 * 1440)),
+                            repeat_touch=pick(RepeatTouch), talk_status=pick(TalkStatus),
+                            flyer_method=pick(FlyerMethod), home_voting=rnd.choice((None, True)))
+                    for _ in range(60)
+                ])
+                await session.flush()
+                assert await repo.close_abandoned_contacts(session, before=now - timedelta(days=4), limit=1000)
+                await session.commit()
+
+                assert await repo.check_agent_day_cube(session) == []
+                for days in (None, 1, 3, 30):
+                    cube = await repo.contact_cube(session, days=days)
+                    assert {row[:5]: row[5] for row in cube} == await _scan(session, days), days
+                    assert len(cube) == len({row[:5] for row in cube})
+
+                # пересборка даёт тот же куб
+                before = sorted(map(repr, await repo.contact_cube(session, days=None)))
+                await repo.rebuild_agent_day_cube(session)
+                assert sorted(map(repr, await repo.contact_cube(session, days=None))) == before
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot import repo
+from bot.db import install_sqlite_hooks
+from bot.migrations import run_migrations
+from bot.models import Agent, Contact, FlyerMethod, RepeatTouch, TalkStatus, Visit
+from bot.utils.contact_mirror import ContactMirror
+
+
+def _contacts(n: int, *, start: int, created: datetime) -> list[Contact]:
+    return [
+        Contact(
+            visit_id=1, agent_id=1 + i % 3, full_name=f"Иванов {i}", phone_e164=f"+7999{i:07d}", phone_hash="h",
+            repeat_touch=list(RepeatTouch)[i % len(RepeatTouch)], talk_status=list(TalkStatus)[i % len(TalkStatus)],
+            flyer_method=list(FlyerMethod)[i % len(FlyerMethod)], home_voting=bool(i % 2),
+            created_at=created + timedelta(seconds=i), closed_at=created + timedelta(seconds=i),
+            updated_at=created + timedelta(seconds=i),
+        )
+        for i in range(start, start + n)
+    ]
+
+
+def test_mirror_checksums_follow_updates_and_deletes(tmp_path):
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'data.db'}")
+        install_sqlite_hooks(engine, pragmas=False)
+        session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        mirror = ContactMirror(tmp_path / "mirror")
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+        try:
+            async with engine.begin() as conn:
+                await run_migrations(conn)
+            async with session_factory() as session:
+                session.add_all([Agent(id=i, tg_user_id=1000 + i, name=f"Агент {i}") for i in (1, 2, 3)])
+                session.add(Visit(id=1, agent_id=1))
+                session.add_all(_contacts(300, start=0, created=hour_ago))
+                # старая незакрытая карточка — её закроет close_abandoned_contacts
+                session.add(Contact(visit_id=1, agent_id=2, full_name="Открытая", phone_e164="+79990000000",
+                                    phone_hash="h", created_at=hour_ago, updated_at=hour_ago))
+                await session.commit()
+
+                await mirror.sync(session)
+                assert await mirror.check(session) == []
+
+                # правки на месте: статус/имя/флаер — через onupdate, как в боте
+                await session.execute(
+                    update(Contact).where(Contact.id % 7 == 0)
+                    .values(talk_status=TalkStatus.CONSENT, full_name="Переименованный Длинный Контакт")
+                )
+                await session.execute(update(Contact).where(Contact.id == 11).values(home_voting=None))
+                assert await repo.claim_flyer_number(session, 777, 12)
+                assert await repo.close_abandoned_contacts(session, before=datetime.utcnow(), limit=10) == 1
+                session.add_all(_contacts(20, start=300, created=hour_ago))
+                await session.commit()
+
+                meta = await mirror.sync(session)
+                assert (mirror.rebuilds, meta["rows"]) == (0, 321)
+                assert mirror.rewritten >= 300 // 7
+                assert await mirror.check(session) == []
+
+                # удаление: сумма строк до last_id расходится — зеркало пересобирается
+                await session.execute(delete(Contact).where(Contact.id.in_([5, 150])))
+                await session.execute(update(Contact).where(Contact.id == 6).values(full_name="После удаления"))
+                await session.commit()
+
+                meta = await mirror.sync(session)
+                assert (mirror.rebuilds, meta["rows"]) == (1, 319)
+                assert await mirror.check(session) == []
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+import asyncio
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot.db import install_sqlite_hooks
+from bot.migrations import run_migrations
+from bot.utils.contact_mirror import ContactMirror
+from bot.utils.excel import render_export
+from bot.utils.export_pool import ExportPool
+
+ROWS = 5_000
+TICK = 0.01
+# потолок задержки event loop, пока процесс пула рендерит выгрузку
+LAG_CEILING = 0.25
+
+
+def _seed(path) -> None:
+    now = datetime.utcnow()
+    ts = lambda minutes: (now - timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S.%f")
+    conn = sqlite3.connect(path)
+    try:
+        conn.executemany(
+            "INSERT INTO agent (id, tg_user_id, username, name, admin_logged_in, created_at) VALUES (?, ?, ?, ?, 0, ?)",
+            [(i, 1000 + i, f"user{i}", f"Агент {i}", ts(0)) for i in range(1, 21)],
+        )
+        conn.execute("INSERT INTO visit (id, agent_id, started_at) VALUES (1, 1, ?)", (ts(0),))
+        conn.executemany(
+            "INSERT INTO contact (visit_id, agent_id, full_name, phone_e164, phone_hash, talk_status, door_photo,"
+            " mailbox_photo, flyer_method, home_voting, created_at, closed_at, updated_at)"
+            " VALUES (1, ?, ?, ?, 'h', ?, 1, 0, ?, ?, ?, ?, ?)",
+            [(1 + i % 20, "Иванов Иван Иванович", f"+7999{i:07d}", ("CONSENT", "REFUSAL", "NO_ONE")[i % 3],
+              ("HAND", "MAILBOX", "NONE")[i % 3], i % 2, *[ts(i)] * 3)
+             for i in range(ROWS)],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_export_render_keeps_event_loop_responsive(tmp_path):
+    async def build_mirror():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'data.db'}")
+        install_sqlite_hooks(engine, pragmas=False)
+        try:
+            async with engine.begin() as conn:
+                await run_migrations(conn)
+            _seed(tmp_path / "data.db")
+            mirror = ContactMirror(tmp_path / "mirror")
+            async with async_sessionmaker(engine, class_=AsyncSession)() as session:
+                return mirror, await mirror.sync(session)
+        finally:
+            await engine.dispose()
+
+    async def main():
+        mirror, meta = await build_mirror()
+        pool = ExportPool(workers=1)
+        pool.start()
+        # процесс пула поднимается заранее: замер — только рендер
+        await pool.run(time.sleep, 0)
+        lags: list[float] = []
+        done = asyncio.Event()
+
+        async def ticker():
+            while not done.is_set():
+                t0 = time.perf_counter()
+                await asyncio.sleep(TICK)
+                lags.append(time.perf_counter() - t0 - TICK)
+
+        task = asyncio.create_task(ticker())
+        t0 = time.perf_counter()
+        try:
+            result = await pool.run(
+                render_export, str(mirror.root), meta, None,
+                str(tmp_path / "export.csv"), str(tmp_path / "export.xlsx"),
+            )
+        finally:
+            elapsed = time.perf_counter() - t0
+            done.set()
+            await task
+            pool.close()
+        return result, elapsed, lags
+
+    (total, xlsx_error, _), elapsed, lags = asyncio.run(main())
+    assert total == ROWS and xlsx_error is None
+    # рендер заметно дольше потолка: тот же рендер прямо в event loop тест бы не прошёл
+    assert elapsed > LAG_CEILING
+    assert len(lags) > 10
+    assert max(lags) < LAG_CEILING, f"event loop stalled for {max(lags) * 1e3:.0f} ms"
@@ -0,0 +1,113 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendDocument
+
+from bot import exports
+from bot.exports import ExportJob, ExportJobs, ExportResult, _Waiter
+from bot.utils.artifact_cache import ArtifactCache
+
+KEY = ("agent_export", 1, "today")
+
+
+class FakeBot:
+    """send_document: file_id из stale отклоняется, остальные отправки — новый file_id."""
+
+    def __init__(self, stale: set[str]) -> None:
+        self.stale = stale
+        self.sent: list[object] = []
+        self._n = 0
+
+    async def send_document(self, chat_id, document, caption=None):
+        if isinstance(document, str) and document in self.stale:
+            raise TelegramBadRequest(SendDocument(chat_id=chat_id, document=document), "wrong file identifier")
+        self.sent.append(document)
+        self._n += 1
+        return SimpleNamespace(document=SimpleNamespace(file_id=document if isinstance(document, str) else f"new{self._n}"))
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+    async def delete_message(self, *args, **kwargs):
+        pass
+
+
+def test_cached_file_id_rejected_falls_back_to_upload(tmp_path, monkeypatch):
+    cache = ArtifactCache(tmp_path / "cache")
+    monkeypatch.setattr(exports, "artifact_cache", cache)
+    entry = cache.put(KEY, "wm", caption="Выгрузка", filename="export.xlsx", data=b"xlsx")
+    cache.set_file_id(KEY, "wm", "stale-id")
+    bot = FakeBot(stale={"stale-id"})
+
+    asyncio.run(ExportJobs()._send_cached(_Waiter(bot=bot, user_id=1, chat_id=1), KEY, "wm", entry))
+
+    assert len(bot.sent) == 1 and not isinstance(bot.sent[0], str)
+    assert cache.get(KEY, "wm").file_id == "new1"
+
+
+def test_delivery_reuploads_when_shared_file_id_rejected(tmp_path, monkeypatch):
+    cache = ArtifactCache(tmp_path / "cache")
+    monkeypatch.setattr(exports, "artifact_cache", cache)
+    path = tmp_path / "export.xlsx"
+    path.write_bytes(b"xlsx")
+    # первый получатель загружает файл и получает file_id, второй им не может воспользоваться
+    first = FakeBot(stale=set())
+    second = FakeBot(stale={"new1"})
+    job = ExportJob(key=KEY, title="Выгрузка", build=None, waiters=[
+        _Waiter(bot=first, user_id=1, chat_id=1), _Waiter(bot=second, user_id=2, chat_id=2),
+    ])
+
+    asyncio.run(ExportJobs()._deliver(job, ExportResult(text="Выгрузка", path=path, filename="export.xlsx")))
+
+    assert len(first.sent) == 1 and len(second.sent) == 1
+    assert not isinstance(second.sent[0], str)
+
+
+def test_second_merge_upload_with_another_book_is_not_dropped(tmp_path, monkeypatch):
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+
+    from bot.routers import admin
+
+    jobs = ExportJobs(tmp_dir=tmp_path / "tmp")
+    monkeypatch.setattr(admin, "export_jobs", jobs)
+    books: list[str] = []
+    release = asyncio.Event()
+
+    async def build(job, *, tg_user_id, fmt, base_file_id=None):
+        books.append(base_file_id)
+        await release.wait()
+        return ExportResult("готово")
+
+    monkeypatch.setattr(admin, "_build_delta_export", build)
+    bot, answers = FakeBot(stale=set()), []
+
+    def upload(file_id):
+        async def answer(text, **kwargs):
+            answers.append(text)
+            return SimpleNamespace(message_id=len(answers))
+        doc = SimpleNamespace(file_name="export_new.xlsx", file_size=1024,
+                              file_id=file_id, file_unique_id=f"u-{file_id}")
+        return SimpleNamespace(bot=bot, from_user=SimpleNamespace(id=7), chat=SimpleNamespace(id=7),
+                               document=doc, answer=answer)
+
+    async def main():
+        state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=7, user_id=7))
+        access = SimpleNamespace(is_admin=True)
+        await admin.admin_export_merge_do(upload("book1"), state, access)
+        await asyncio.sleep(0)
+        # пока первая книга дописывается, админ присылает другую — и ту же ещё раз
+        await admin.admin_export_merge_do(upload("book2"), state, access)
+        await admin.admin_export_merge_do(upload("book1"), state, access)
+        await asyncio.sleep(0)
+        running = set(books)
+        release.set()
+        await asyncio.gather(*jobs._tasks)
+        return running
+
+    assert asyncio.run(main()) == {"book1", "book2"}
+    assert books.count("book1") == 1
+    assert jobs.submitted == 2 and jobs.rejected == 0
+    assert any("уже собирается" in a for a in answers)
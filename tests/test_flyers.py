@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot import models, repo
+from bot.db import Base, install_sqlite_hooks
+from bot.routers import flow
+from bot.states import Survey
+from bot.utils.flyers import FlyerBitmap
+from bot.write_queue import WriteQueue
+
+
+def test_claim_sets_bit_only_after_commit(tmp_path, monkeypatch):
+    bitmap = FlyerBitmap()
+    monkeypatch.setattr(repo, "flyer_bitmap", bitmap)
+
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'flyers.db'}")
+        install_sqlite_hooks(engine, pragmas=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=[models.FlyerClaim.__table__])
+        sessions = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        try:
+            async with sessions() as session:
+                assert await repo.claim_flyer_number(session, 10, None)
+                assert 10 not in bitmap
+                await session.rollback()
+            assert 10 not in bitmap
+
+            async with sessions() as session:
+                assert await repo.claim_flyer_number(session, 10, None)
+                assert 10 not in bitmap
+                await session.commit()
+            assert 10 in bitmap
+
+            # номер занят в БД, но бита нет (например, до прогрева) — конфликт ставит бит сразу
+            bitmap.clear()
+            async with sessions() as session:
+                assert not await repo.claim_flyer_number(session, 10, None)
+                assert 10 in bitmap
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_second_flyer_input_releases_first_claim(tmp_path, monkeypatch):
+    bitmap = FlyerBitmap()
+    monkeypatch.setattr(repo, "flyer_bitmap", bitmap)
+    answers: list[str] = []
+
+    def message(text):
+        async def answer(msg, **kwargs):
+            answers.append(msg)
+        return SimpleNamespace(text=text, answer=answer)
+
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'flyers.db'}")
+        install_sqlite_hooks(engine, pragmas=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=[models.FlyerClaim.__table__])
+        sessions = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        queue = WriteQueue(window=0.01, session_factory=sessions)
+        monkeypatch.setattr(flow, "write_queue", queue)
+        await queue.start()
+
+        async def claimed():
+            async with sessions() as session:
+                return sorted((await session.execute(select(models.FlyerClaim.number))).scalars())
+
+        state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=1, user_id=1))
+        await state.set_state(Survey.waiting_flyer_number)
+        await state.update_data(card={"phone_e164": "+79990001122", "flyer_method": "HAND"})
+        try:
+            # агент ввёл номер, потом (ещё на том же шаге) — другой: первый освобождается
+            await flow.flyer_number_input(message("10"), state)
+            await flow.flyer_number_input(message("11"), state)
+            assert await claimed() == [11]
+            assert (await state.get_value("card"))["flyer_number"] == 11
+            assert 10 not in bitmap and 11 in bitmap
+
+            # свой же номер ещё раз — не «уже использовался»
+            answers.clear()
+            await flow.flyer_number_input(message("11"), state)
+            assert not any("уже использовался" in a for a in answers)
+            assert await claimed() == [11]
+
+            # два ввода одновременно — номер занимает только один из них
+            await asyncio.gather(
+                flow.flyer_number_input(message("20"), state), flow.flyer_number_input(message("21"), state),
+            )
+            held = (await state.get_value("card"))["flyer_number"]
+            assert held in (20, 21)
+            assert await claimed() == [held]
+        finally:
+            await queue.stop()
+            await engine.dispose()
+
+    asyncio.run(main())
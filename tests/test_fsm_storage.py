@@ -0,0 +1,179 @@
+import asyncio
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.fsm_storage import SQLiteStorage, pending_fsm_keys
+
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def _age(path, user_id: int) -> None:
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("UPDATE fsm SET updated_at = 0 WHERE key LIKE ?", (f"%:{user_id}:%",))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_expire_returns_erased_data_and_restore_puts_it_back(tmp_path):
+    path = str(tmp_path / "fsm.db")
+
+    async def main():
+        storage = SQLiteStorage(path)
+        card = {"full_name": "Иванов Иван Иванович", "phone_e164": "+79990001122"}
+        await storage.set_state(_key(1), "Survey:waiting_home_voting")
+        await storage.update_data(_key(1), {"visit_id": 7, "card": card})
+        await storage.update_data(_key(2), {"visit_id": 8})
+        _age(path, 1)
+
+        expired = await storage.expire(1.0)
+        assert [(r.state, r.data) for r in expired] == [("Survey:waiting_home_voting", {"visit_id": 7, "card": card})]
+        assert await storage.get_data(_key(1)) == {}
+        assert await storage.get_data(_key(2)) == {"visit_id": 8}
+
+        await storage.restore(expired)
+        storage._cache.clear()
+        assert await storage.get_state(_key(1)) == "Survey:waiting_home_voting"
+        assert (await storage.get_data(_key(1)))["card"] == card
+        await storage.close()
+
+    asyncio.run(main())
+
+
+def test_expire_skips_key_changed_in_current_update(tmp_path):
+    path = str(tmp_path / "fsm.db")
+
+    async def main():
+        storage = SQLiteStorage(path)
+        await storage.update_data(_key(1), {"visit_id": 7})
+        _age(path, 1)
+
+        keys: set[str] = set()
+        token = pending_fsm_keys.set(keys)
+        try:
+            await storage.update_data(_key(1), {"visit_id": 9})
+            assert await storage.expire(1.0) == []
+        finally:
+            pending_fsm_keys.reset(token)
+        await storage.flush(keys)
+
+        storage._cache.clear()
+        assert await storage.get_data(_key(1)) == {"visit_id": 9}
+        await storage.close()
+
+    asyncio.run(main())
+
+
+def test_failed_flush_keeps_keys_for_next_flush(tmp_path):
+    path = str(tmp_path / "fsm.db")
+
+    async def main():
+        storage = SQLiteStorage(path)
+        await storage.update_data(_key(1), {"visit_id": 7})
+
+        keys: set[str] = set()
+        token = pending_fsm_keys.set(keys)
+        try:
+            await storage.update_data(_key(1), {"visit_id": 9})
+        finally:
+            pending_fsm_keys.reset(token)
+
+        db = await storage._conn()
+        await db.execute("CREATE TRIGGER fsm_ro BEFORE UPDATE ON fsm BEGIN SELECT RAISE(ABORT, 'read-only'); END")
+        await db.commit()
+        with pytest.raises(sqlite3.IntegrityError):
+            await storage.flush(keys)
+        # несброшенный ключ не вытесняется из памяти
+        storage.ttl = -1
+        assert storage.trim() == 0
+
+        await db.execute("DROP TRIGGER fsm_ro")
+        await db.commit()
+        # следующий flush — другого ключа — дописывает и упавший
+        await storage.update_data(_key(2), {"visit_id": 8})
+
+        storage._cache.clear()
+        assert await storage.get_data(_key(1)) == {"visit_id": 9}
+        assert await storage.get_data(_key(2)) == {"visit_id": 8}
+        await storage.close()
+
+    asyncio.run(main())
+
+
+def test_expire_leaves_card_to_pending_submit(tmp_path, monkeypatch):
+    from aiogram.fsm.context import FSMContext
+    from sqlalchemy import func, select
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+    from bot import sweeper as sweeper_mod
+    from bot.db import install_sqlite_hooks
+    from bot.migrations import run_migrations
+    from bot.models import Agent, Contact, Visit
+    from bot.routers import flow
+    from bot.write_queue import WriteQueue
+
+    path = str(tmp_path / "fsm.db")
+
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'data.db'}")
+        install_sqlite_hooks(engine, pragmas=False)
+        async with engine.begin() as conn:
+            await run_migrations(conn)
+        sessions = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        async with sessions() as session:
+            session.add_all([Agent(id=1, tg_user_id=1), Visit(id=1, agent_id=1)])
+            await session.commit()
+
+        storage = SQLiteStorage(path)
+        queue = WriteQueue(window=0.01, session_factory=sessions)
+        monkeypatch.setattr(flow, "write_queue", queue)
+        monkeypatch.setattr(sweeper_mod, "fsm_storage", storage)
+        monkeypatch.setattr(sweeper_mod, "async_session", sessions)
+        await queue.start()
+
+        state = FSMContext(storage, _key(1))
+        card = {"full_name": "Иванов Иван Иванович", "phone_e164": "+79990001122",
+                "created_at": datetime.utcnow() - timedelta(hours=2), "talk_status": "CONSENT"}
+        await state.update_data(visit_id=1, agent_id=1, card=card)
+        # агент долго молчал, потом нажал «Отмена» — и уборщик пришёл, пока карточка пишется
+        _age(path, 1)
+        entered, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_save(session, data):
+            entered.set()
+            await release.wait()
+            return await flow._save_card(session, data)
+
+        try:
+            submit = asyncio.create_task(flow._submit_card(state, slow_save))
+            await entered.wait()
+            # шаги прохода уборщика: стирание — пока хендлер пишет, запись стёртого — после
+            expired = await storage.expire(time.time() - 60)
+            assert expired == []
+            release.set()
+            assert await submit
+            assert await sweeper_mod.Sweeper()._save_cards(expired) == 0
+            # стёртая уборщиком строка вернулась в файл — уже без карточки
+            storage._cache.clear()
+            assert await storage.get_data(_key(1)) == {"visit_id": 1, "agent_id": 1, "card": None}
+
+            # следующий проход стирает опрос, но карточку второй раз не пишет
+            _age(path, 1)
+            done = await sweeper_mod.Sweeper(abandon_after=60).sweep()
+            assert (done["fsm_expired"], done["cards"]) == (1, 0)
+            async with sessions() as session:
+                assert await session.scalar(select(func.count(Contact.id))) == 1
+        finally:
+            release.set()
+            await queue.stop()
+            await storage.close()
+            await engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import asyncio
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from bot import db
+from bot.db import install_sqlite_hooks
+from bot.migrations import LATEST_VERSION
+
+# схема до версионных миграций: agent без username/admin_logged_in, бригадиры в старых вариантах,
+# contact без updated_at, номера флаеров только строкой в contact
+LEGACY = """
+CREATE TABLE agent (id INTEGER PRIMARY KEY, tg_user_id INTEGER UNIQUE, name VARCHAR(255), phone VARCHAR(32),
+                    created_at DATETIME);
+CREATE TABLE visit (id INTEGER PRIMARY KEY, agent_id INTEGER, address VARCHAR(255),
+                    started_at DATETIME, closed_at DATETIME);
+CREATE TABLE contact (id INTEGER PRIMARY KEY, visit_id INTEGER, agent_id INTEGER, full_name VARCHAR(255),
+                      phone_e164 VARCHAR(32), phone_hash VARCHAR(64), repeat_touch VARCHAR(9),
+                      talk_status VARCHAR(7), door_photo BOOLEAN, mailbox_photo BOOLEAN, flyer_method VARCHAR(7),
+                      flyer_number VARCHAR(64), home_voting BOOLEAN, created_at DATETIME, closed_at DATETIME);
+CREATE TABLE brigadiers (id INTEGER PRIMARY KEY, tg_id BIGINT);
+CREATE TABLE brig_sessions (brig_tg_id BIGINT PRIMARY KEY, logged_in INTEGER, updated_at DATETIME);
+
+INSERT INTO agent VALUES (1, 1001, 'Агент 1', NULL, '2024-09-01 08:00:00.000000');
+INSERT INTO agent VALUES (2, 1002, 'Агент 2', NULL, '2024-09-01 08:00:00.000000');
+INSERT INTO visit VALUES (1, 1, NULL, '2024-09-02 10:00:00.000000', '2024-09-02 11:00:00.000000');
+INSERT INTO contact VALUES (1, 1, 1, 'Иванов Иван Иванович', '+79990000001', 'h1', 'PRIMARY', 'CONSENT', 1, 0,
+                            'HAND', '007', 1, '2024-09-02 10:05:00.000000', '2024-09-02 10:10:00.000000');
+INSERT INTO contact VALUES (2, 1, 1, 'Петров Пётр Петрович', '+79990000002', 'h2', 'PRIMARY', 'REFUSAL', 1, 0,
+                            'MAILBOX', '7', 0, '2024-09-02 10:20:00.000000', '2024-09-02 10:25:00.000000');
+INSERT INTO contact VALUES (3, 1, 2, 'Сидоров Сидор Сидорович', '+79990000003', 'h3', 'SECONDARY', 'NO_ONE', 1, 0,
+                            'NONE', 'abc', NULL, '2024-09-02 10:30:00.000000', NULL);
+INSERT INTO brigadiers VALUES (1, 5001);
+INSERT INTO brigadiers VALUES (2, 5002);
+INSERT INTO brig_sessions VALUES (5001, 1, '2024-09-01 09:00:00.000000');
+"""
+
+
+def test_legacy_database_boots_twice(tmp_path, monkeypatch):
+    path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY)
+    conn.close()
+
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        install_sqlite_hooks(engine, pragmas=False)
+        monkeypatch.setattr(db, "engine", engine)
+        statements: list[str] = []
+        event.listen(engine.sync_engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        try:
+            await db.init_db()
+            first = list(statements)
+            statements.clear()
+            await db.init_db()
+            return first, list(statements)
+        finally:
+            await engine.dispose()
+
+    first, second = asyncio.run(main())
+    assert any(s.lstrip().upper().startswith("ALTER") for s in first)
+    # второй старт: только сверка версии и отпечатка, без DDL и PRAGMA table_info
+    ddl = [s for s in second if s.lstrip().upper().startswith(("CREATE", "ALTER", "DROP", "INSERT", "UPDATE"))]
+    assert ddl == []
+    assert not any("table_info" in s for s in second)
+
+    conn = sqlite3.connect(path)
+    try:
+        q = lambda sql: conn.execute(sql).fetchall()
+        assert q("SELECT max(version), count(*) FROM schema_version") == [(LATEST_VERSION, LATEST_VERSION)]
+        # строки на месте, новые колонки заполнены значениями по умолчанию
+        assert q("SELECT id, tg_user_id, name, username, admin_logged_in FROM agent ORDER BY id") == [
+            (1, 1001, "Агент 1", None, 0), (2, 1002, "Агент 2", None, 0),
+        ]
+        assert q("SELECT id, flyer_number FROM contact ORDER BY id") == [(1, "007"), (2, "7"), (3, "abc")]
+        assert q("SELECT count(*) FROM contact WHERE updated_at IS NULL") == [(0,)]
+        assert q("SELECT brig_tg_id FROM brigadiers ORDER BY 1") == [(5001,), (5002,)]
+        assert q("SELECT brig_tg_id, logged_in FROM brig_sessions") == [(5001, 1)]
+        assert [r[1] for r in q("PRAGMA table_info(brig_sessions)")] == ["brig_tg_id", "logged_in"]
+        # «007» и «7» — один номер, за ранним контактом; нечисловой не переносится
+        assert q("SELECT number, contact_id FROM flyer_claim") == [(7, 1)]
+        # роллап — только закрытые карточки
+        assert q("SELECT agent_id, day, total, consent, refusal FROM agent_day_stats") == [(1, "2024-09-02", 2, 1, 1)]
+        assert q("SELECT agent_id, day, repeat, status, method, home, n FROM agent_day_cube ORDER BY status") == [
+            (1, "2024-09-02", 1, 2, 2, 0, 1), (1, "2024-09-02", 1, 3, 1, 1, 1),
+        ]
+    finally:
+        conn.close()
@@ -0,0 +1,29 @@
+import asyncio
+
+from sqlalchemy import select
+
+from bot import models
+from bot.utils.query_plans import check_query_plans
+
+
+def test_repo_queries_use_indexes():
+    checked, problems = asyncio.run(check_query_plans(in_memory=True))
+
+    assert checked > 0
+    # при падении видно сценарий, SQL и план
+    assert problems == [], "\n".join(f"[{p.scenario}] {p.sql}\n    " + "\n    ".join(p.plan) for p in problems)
+
+
+def test_full_scan_is_reported():
+    # по full_name индекса нет — SQLite обязан пройти contact целиком
+    scenarios = [
+        ("by_full_name", lambda s: s.execute(select(models.Contact.id).where(models.Contact.full_name == "x")),
+         frozenset()),
+        ("by_full_name(allowed)", lambda s: s.execute(select(models.Contact.id).where(models.Contact.full_name == "x")),
+         frozenset({"contact"})),
+    ]
+    checked, problems = asyncio.run(check_query_plans(in_memory=True, scenarios=scenarios))
+
+    assert checked == 2
+    assert [p.scenario for p in problems] == ["by_full_name"]
+    assert "SCAN contact" in problems[0].plan
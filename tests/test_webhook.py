@@ -0,0 +1,55 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from bot.utils.webhook import StimulClient
+
+
+def _post_with_status(status: int):
+    async def handler(request):
+        await request.json()
+        return web.Response(status=status, text="body")
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/hook", handler)
+        server = TestServer(app)
+        await server.start_server()
+        client = StimulClient(str(server.make_url("/hook")))
+        try:
+            return await client.post({"phone": "9990001122", "code": "1", "voting_at_home": False})
+        finally:
+            await client.close()
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def test_success():
+    assert _post_with_status(200).ok
+
+
+def test_permanent_client_errors_are_not_retried():
+    for status in (400, 401, 404, 422):
+        res = _post_with_status(status)
+        assert not res.ok and not res.retry, status
+        assert f"HTTP {status}" in res.msg
+
+
+def test_server_errors_and_throttling_are_retried():
+    for status in (500, 503, 429, 408):
+        res = _post_with_status(status)
+        assert not res.ok and res.retry, status
+
+
+def test_network_error_is_retried():
+    async def main():
+        client = StimulClient("http://127.0.0.1:9/hook", timeout=2)
+        try:
+            return await client.post({})
+        finally:
+            await client.close()
+
+    res = asyncio.run(main())
+    assert not res.ok and res.retry
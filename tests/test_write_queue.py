@@ -0,0 +1,97 @@
+import asyncio
+import sqlite3
+
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from bot.db import install_sqlite_hooks
+from bot.write_queue import WriteQueue
+
+
+def _run_batch(db_path, intents):
+    """Отдать intents в одну пачку WriteQueue; вернуть (результаты, число коммитов движка)."""
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        install_sqlite_hooks(engine, pragmas=False)
+        commits = []
+        event.listen(engine.sync_engine, "commit", lambda conn: commits.append(1))
+        async with engine.begin() as conn:
+            await conn.execute(text("CREATE TABLE t (x INTEGER)"))
+        commits.clear()
+
+        queue = WriteQueue(
+            window=0.05, max_batch=100,
+            session_factory=async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession),
+        )
+        await queue.start()
+        try:
+            results = await asyncio.gather(
+                *(queue.submit(fn, *args) for fn, *args in intents), return_exceptions=True,
+            )
+        finally:
+            await queue.stop()
+            await engine.dispose()
+        return results, len(commits), queue.stats()
+
+    return asyncio.run(main())
+
+
+def _outside_count(db_path) -> int:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT count(*) FROM t").fetchone()[0]
+    finally:
+        conn.close()
+
+
+async def _insert(session, x):
+    await session.execute(text("INSERT INTO t VALUES (:x)"), {"x": x})
+    return x
+
+
+async def _fail(session):
+    await session.execute(text("INSERT INTO t VALUES (-1)"))
+    raise ValueError("boom")
+
+
+def test_batch_is_invisible_until_single_commit(tmp_path):
+    db_path = tmp_path / "wq.db"
+
+    async def peek(session):
+        # пачка ещё не закоммичена: чужое соединение не должно видеть ни одной записи
+        return _outside_count(db_path)
+
+    intents = [(_insert, i) for i in range(5)] + [(peek,)]
+    results, commits, stats = _run_batch(db_path, intents)
+
+    assert results == [0, 1, 2, 3, 4, 0]
+    assert commits == 1
+    assert stats["batches"] == 1
+    assert _outside_count(db_path) == 5
+
+
+def test_failed_intent_rolls_back_only_itself(tmp_path):
+    db_path = tmp_path / "wq.db"
+    results, commits, stats = _run_batch(db_path, [(_insert, 1), (_fail,), (_insert, 2)])
+
+    assert results[0] == 1 and results[2] == 2
+    assert isinstance(results[1], ValueError)
+    assert commits == 1
+    assert stats["failed"] == 1
+    conn = sqlite3.connect(db_path)
+    try:
+        assert sorted(r[0] for r in conn.execute("SELECT x FROM t")) == [1, 2]
+    finally:
+        conn.close()
+
+
+def test_submit_after_stop_is_rejected():
+    async def main():
+        queue = WriteQueue()
+        await queue.start()
+        await queue.stop()
+        with pytest.raises(RuntimeError):
+            await queue.submit(_insert, 1)
+
+    asyncio.run(main())